@@ -1,33 +1,39 @@
 #!/usr/bin/env python3
+import sys
+import time
 import tqdm
 from argparse import ArgumentParser
 
 from panda import Panda
+from can_log import CanLog, RecordingPanda
 from tp20 import TP20Transport
 from kwp2000 import KWP2000Client, ECU_IDENTIFICATION_TYPE
-
-try:
-    from panda.ccp import CcpClient, BYTE_ORDER
-except ImportError:
-    from panda.python.ccp import CcpClient, BYTE_ORDER
-
-CHUNK_SIZE = 4
+from memory_reader import dump_memory, open_reader
+from metrics import Metrics
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--bus", default=0, type=int, help="CAN bus number to use")
     parser.add_argument("--start-address", default=0, type=int, help="start address")
     parser.add_argument("--end-address", default=0x5FFFF, type=int, help="end address (inclusive)")
+    parser.add_argument("--mode", default="auto", choices=["auto", "kwp", "ccp"], help="read using KWP2000, CCP or KWP2000 with CCP as fallback")
     parser.add_argument("--output", required=True, help="output file")
+    parser.add_argument("--no-resume", action="store_true", help="start over instead of resuming an interrupted dump")
+    parser.add_argument("--record", help="record all CAN frames of the session to this log, see can_log.py")
+    parser.add_argument("--metrics", help="write protocol counters and latencies to this file, Prometheus format if it ends in .prom")
     args = parser.parse_args()
 
     p = Panda()
+    if args.record:
+        p = RecordingPanda(p, CanLog.create(args.record))
     p.can_clear(0xFFFF)
     p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
 
     print("Connecting using KWP2000...")
-    tp20 = TP20Transport(p, 0x9, bus=args.bus)
+    metrics = Metrics() if args.metrics else None
+    tp20 = TP20Transport(p, 0x9, bus=args.bus, threaded=True, metrics=metrics)
     kwp_client = KWP2000Client(tp20)
+    print(f"TP2.0 timing: block size {tp20.block_size}, T1 {tp20.t1 * 1000:.1f} ms, T3 {tp20.t3 * 1000:.1f} ms")
 
     print("Reading ecu identification & flash status")
     ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
@@ -36,19 +42,21 @@ if __name__ == "__main__":
     status = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH)
     print("Flash status", status)
 
-    print("\nConnecting using CCP...")
-    client = CcpClient(p, 1746, 1747, byte_order=BYTE_ORDER.LITTLE_ENDIAN, bus=args.bus)
-    client.connect(0x0)
+    reader = open_reader(p, args.bus, kwp_client, args.start_address, args.mode)
+    if reader is None:
+        sys.exit(1)
 
-    progress = tqdm.tqdm(total=args.end_address - args.start_address)
+    print(f"Reading using {reader.name}")
+    size = args.end_address - args.start_address + 1
+    progress = tqdm.tqdm(total=size)
 
-    addr = args.start_address
-    client.set_memory_transfer_address(0, 0, addr)
+    start = time.monotonic()
+    read = dump_memory(reader, args.output, args.start_address, size, resume=not args.no_resume, progress=progress.update)
 
-    with open(args.output, "wb") as f:
-        while addr < args.end_address:
-            f.write(client.upload(CHUNK_SIZE)[:CHUNK_SIZE])
-            f.flush()
+    progress.close()
+    elapsed = time.monotonic() - start
+    print(f"Read {read} bytes in {elapsed:.1f} s ({read / elapsed:.0f} B/s)")
 
-            addr += CHUNK_SIZE
-            progress.update(CHUNK_SIZE)
+    if metrics is not None:
+        metrics.write(args.metrics)
+        print(f"Metrics written to {args.metrics}")
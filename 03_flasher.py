@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
-import time
+import mmap
 import tqdm
 import sys
 import struct
 from argparse import ArgumentParser
+from typing import Any, Callable, Iterator, List, Optional, Tuple
 
 from panda import Panda  # type: ignore
-from tp20 import TP20Transport
+from tp20 import TP20Transport, MAX_PAYLOAD_LEN
 from kwp2000 import ACCESS_TYPE, ROUTINE_CONTROL_TYPE, KWP2000Client, SESSION_TYPE, ECU_IDENTIFICATION_TYPE
-
-CHUNK_SIZE = 240
+from can_log import CanLog, RecordingPanda
+from memory_reader import kwp_reader, verify_memory
+from metrics import Metrics
+from patcher import Image, crc16_update
 
 
 def compute_key(seed):
@@ -25,54 +28,160 @@ def compute_key(seed):
     return key
 
 
-if __name__ == "__main__":
-    parser = ArgumentParser()
-    parser.add_argument("--bus", default=0, type=int, help="CAN bus number to use")
-    parser.add_argument("--input", required=True, help="input to flash")
-    parser.add_argument("--start-address", default=0x5E000, type=int, help="start address")
-    parser.add_argument("--end-address", default=0x5EFFF, type=int, help="end address (inclusive)")
-    args = parser.parse_args()
+class FlashChecksum:
+    def __init__(self):
+        """Additive checksum used by the ECU and CRC16 of the data sent so far"""
+        self.sum = 0
+        self.crc = 0
 
-    with open(args.input, "rb") as input_fw:
-        input_fw_s = input_fw.read()
+    def update(self, chunk: Image):
+        self.sum = (self.sum + sum(chunk)) & 0xFFFF
+        self.crc = crc16_update(chunk, self.crc)
 
-    assert args.start_address < args.end_address
-    assert args.end_address < len(input_fw_s)
-    assert input_fw_s[-4:] != b"Ende", "Firmware is not patched"
 
-    print("\n[READY TO FLASH]")
-    print("WARNING! USE AT YOUR OWN RISK! THIS COULD BREAK YOUR ECU AND REQUIRE REPLACEMENT!")
-    print("before proceeding:")
-    print("* put vehicle in park, and accessory mode (your engine should not be running)")
-    print("* ensure battery is fully charged. A full flash can take up to 15 minutes")
-    resp = input("continue [y/n]")
-    if resp.lower() != "y":
-        sys.exit(1)
+def iter_chunks(data: Image, size: int, checksum: Optional[FlashChecksum] = None) -> Iterator[memoryview]:
+    """Yields data in chunks of size bytes without copying it. checksum is updated
+    with every chunk before it is yielded"""
+    view = memoryview(data)
+    for i in range(0, len(view), size):
+        chunk = view[i : i + size]
+        if checksum is not None:
+            checksum.update(chunk)
+        yield chunk
 
-    p = Panda()
+
+def transfer(kwp_client: KWP2000Client, to_flash: Image, transfer_size: int, progress: Optional[Callable[[int], Any]] = None) -> FlashChecksum:
+    """Send data to the ECU in blocks of transfer_size bytes after a request download.
+    Returns the checksums of the data that was sent"""
+    checksum = FlashChecksum()
+    for chunk in iter_chunks(to_flash, transfer_size, checksum):
+        kwp_client.transfer_data(chunk)
+
+        if progress is not None:
+            progress(len(chunk))
+
+    return checksum
+
+
+def plan_sectors(reference: Image, image: Image, start_address: int, end_address: int, sector_size: int) -> List[Tuple[int, int]]:
+    """Returns the (start, end) address ranges (inclusive) of the sectors between
+    start_address and end_address that differ between reference and image.
+    Adjacent changed sectors are merged into a single range"""
+    assert start_address % sector_size == 0, "Start address is not aligned to a sector"
+    assert (end_address + 1) % sector_size == 0, "End address is not aligned to a sector"
+
+    reference_view, image_view = memoryview(reference), memoryview(image)
+    ranges: List[Tuple[int, int]] = []
+    for sector in range(start_address, end_address + 1, sector_size):
+        sector_end = sector + sector_size
+        if reference_view[sector:sector_end] == image_view[sector:sector_end]:
+            continue
+
+        if ranges and ranges[-1][1] + 1 == sector:
+            ranges[-1] = (ranges[-1][0], sector_end - 1)
+        else:
+            ranges.append((sector, sector_end - 1))
+
+    return ranges
+
+
+def flash_range(kwp_client: KWP2000Client, image: Image, start_address: int, end_address: int, chunk_size: int = 0):
+    """Erase and program a single range. The ECU needs to be in the programming
+    session with security access"""
+    print(f"\nFlashing {hex(start_address)} - {hex(end_address)}")
+
+    print("\nRequest download")
+    size = end_address - start_address + 1
+    max_chunk_size = kwp_client.request_download(start_address, size)
+    print(f"Chunk size: {max_chunk_size}")
+
+    # Leave room for the service id, the ECU may count it in the block length
+    transfer_size = chunk_size or min(max_chunk_size - 1, MAX_PAYLOAD_LEN - 1)
+    assert max_chunk_size >= transfer_size, "Chosen chunk size too large"
+    print(f"Transfer size: {transfer_size}")
+
+    print("\nErase flash")
+    f_routine = kwp_client.erase_flash(start_address, end_address)
+    print("F_routine", f_routine)
+    print("Done. Waiting to reconnect...")
+
+    elapsed = kwp_client.transport.reconnect()
+    print(f"Reconnected after {elapsed * 1000:.0f} ms")
+
+    # The ECU may still be busy with the routines, keep the channel open while it answers response pending
+    tp20 = kwp_client.transport
+    print("\nRequest erase results")
+    tp20.start_keep_alive()
+    try:
+        result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH)
+    finally:
+        tp20.stop_keep_alive()
+    assert result == b"\x00", "Erase failed"
+
+    print("\nTransfer data")
+    to_flash = memoryview(image)[start_address : end_address + 1]
+
+    progress = tqdm.tqdm(total=len(to_flash))
+    checksum = transfer(kwp_client, to_flash, transfer_size, progress.update)
+    progress.close()
+    print(f"Checksum: {checksum.sum:04x}, CRC16: {checksum.crc:04x}")
+
+    print("\nRequest transfer exit")
+    kwp_client.request_transfer_exit()
+
+    print("\nStart checksum check")
+    tp20.start_keep_alive()
+    try:
+        kwp_client.calculate_flash_checksum(start_address, end_address, checksum.sum)
+
+        print("\nRequest checksum results")
+        result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM)
+    finally:
+        tp20.stop_keep_alive()
+    assert result == b"\x00", "Checksum check failed"
+
+    print(f"\nUSB transactions: {tp20.usb_transactions}")
+
+
+def verify(kwp_client: KWP2000Client, image: Image, ranges: List[Tuple[int, int]]) -> bool:
+    """Read back the flashed ranges and compare them with the image. Returns False
+    if the ECU does not support reading memory using KWP2000, raises on a mismatch"""
+    reader = kwp_reader(kwp_client, ranges[0][0])
+    if reader is None:
+        print("ECU does not support reading memory using KWP2000, use 04_verify.py")
+        return False
+
+    print(f"Reading using {reader.name}")
+    progress = tqdm.tqdm(total=sum(end - start + 1 for start, end in ranges))
+    mismatch = verify_memory(reader, image, ranges, progress=progress.update)
+    progress.close()
+
+    if mismatch is not None:
+        addresses = ", ".join(hex(addr) for addr, _, _ in mismatch[:16])
+        raise RuntimeError(f"Verification failed, {len(mismatch)} bytes differ in the first bad block: {addresses}")
+    return True
+
+
+def flash(
+    p: Panda, bus: int, image: Image, ranges: List[Tuple[int, int]], chunk_size: int = 0, read_back: bool = False, metrics: Optional[Metrics] = None
+) -> bytes:
+    """Enter the programming session, unlock the ECU and flash every range. With
+    read_back the flashed ranges are read back and compared with the image.
+    Returns the ECU identification read before flashing"""
     p.can_clear(0xFFFF)
     p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
 
     print("Connecting...")
-    tp20 = TP20Transport(p, 0x9, bus=args.bus)
+    tp20 = TP20Transport(p, 0x9, bus=bus, threaded=True, metrics=metrics)
     kwp_client = KWP2000Client(tp20)
+    print(f"TP2.0 timing: block size {tp20.block_size}, T1 {tp20.t1 * 1000:.1f} ms, T3 {tp20.t3 * 1000:.1f} ms")
 
     print("\nEntering programming mode")
     kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
     print("Done. Waiting to reconnect...")
 
-    for i in range(10):
-        time.sleep(1)
-        print(f"\nReconnecting... {i}")
-
-        p.can_clear(0xFFFF)
-        try:
-            tp20 = TP20Transport(p, 0x9, bus=args.bus)
-            break
-        except Exception as e:
-            print(e)
-
-    kwp_client = KWP2000Client(tp20)
+    elapsed = tp20.reconnect()
+    print(f"Reconnected after {elapsed * 1000:.0f} ms")
 
     print("\nReading ecu identification & flash status")
     ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
@@ -93,62 +202,84 @@ if __name__ == "__main__":
     print("\n Send key")
     kwp_client.security_access(ACCESS_TYPE.PROGRAMMING_SEND_KEY, key)
 
-    print("\nRequest download")
-    size = args.end_address - args.start_address + 1
-    chunk_size = kwp_client.request_download(args.start_address, size)
-    print(f"Chunk size: {chunk_size}")
-    assert chunk_size >= CHUNK_SIZE, "Chosen chunk size too large"
-
-    print("\nErase flash")
-    f_routine = kwp_client.erase_flash(args.start_address, args.end_address)
-    print("F_routine", f_routine)
-    print("Done. Waiting to reconnect...")
-
-    for i in range(10):
-        time.sleep(1)
-        print(f"\nReconnecting... {i}")
+    for start, end in ranges:
+        flash_range(kwp_client, image, start, end, chunk_size)
 
-        p.can_clear(0xFFFF)
+    try:
+        if read_back:
+            print("\nVerify")
+            if verify(kwp_client, image, ranges):
+                print("Flash contents match the image")
+    finally:
+        print("\nStop communication")
         try:
-            tp20 = TP20Transport(p, 0x9, bus=args.bus)
-            break
-        except Exception as e:
-            print(e)
+            kwp_client.stop_communication()
+        finally:
+            tp20.close()
+    return ident
 
-    kwp_client = KWP2000Client(tp20)
-
-    print("\nRequest erase results")
-    result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH)
-    assert result == b"\x00", "Erase failed"
 
-    print("\nTransfer data")
-    to_flash = input_fw_s[args.start_address : args.end_address + 1]
-    checksum = sum(to_flash) & 0xFFFF
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--bus", default=0, type=int, help="CAN bus number to use")
+    parser.add_argument("--input", required=True, help="input to flash")
+    parser.add_argument("--start-address", default=0x5E000, type=int, help="start address")
+    parser.add_argument("--end-address", default=0x5EFFF, type=int, help="end address (inclusive)")
+    parser.add_argument("--chunk-size", default=0, type=int, help="bytes per transfer, defaults to the largest block the ECU accepts")
+    parser.add_argument("--reference", help="dump of the current ECU contents, only sectors that differ from it are flashed")
+    parser.add_argument("--sector-size", default=0x1000, type=int, help="flash sector size used with --reference")
+    parser.add_argument("--verify", action="store_true", help="read back the flashed ranges after flashing")
+    parser.add_argument("--dry-run", action="store_true", help="print which ranges would be flashed and exit")
+    parser.add_argument("--record", help="record all CAN frames of the session to this log, see can_log.py")
+    parser.add_argument("--metrics", help="write protocol counters and latencies to this file, Prometheus format if it ends in .prom")
+    args = parser.parse_args()
 
-    progress = tqdm.tqdm(total=len(to_flash))
+    # The input is mapped instead of read, data is sent straight from the mapping
+    input_fw = open(args.input, "rb")
+    input_fw_s = mmap.mmap(input_fw.fileno(), 0, access=mmap.ACCESS_READ)
 
-    while to_flash:
-        chunk = to_flash[:CHUNK_SIZE]
-        kwp_client.transfer_data(chunk)
+    assert args.start_address < args.end_address
+    assert args.end_address < len(input_fw_s)
+    assert input_fw_s[-4:] != b"Ende", "Firmware is not patched"
 
-        # Keep channel alive
-        tp20.can_send(b"\xa3")
-        tp20.can_recv()
+    if args.reference:
+        reference_fw = open(args.reference, "rb")
+        reference_fw_s = mmap.mmap(reference_fw.fileno(), 0, access=mmap.ACCESS_READ)
 
-        to_flash = to_flash[CHUNK_SIZE:]
-        progress.update(CHUNK_SIZE)
+        assert len(reference_fw_s) == len(input_fw_s), "Reference and input have a different size"
+        ranges = plan_sectors(reference_fw_s, input_fw_s, args.start_address, args.end_address, args.sector_size)
+    else:
+        ranges = [(args.start_address, args.end_address)]
 
-    print("\nRequest transfer exit")
-    kwp_client.request_transfer_exit()
+    print("\nFlash plan:")
+    for start, end in ranges:
+        print(f"* {hex(start)} - {hex(end)} ({end - start + 1} bytes)")
+    print(f"{sum(end - start + 1 for start, end in ranges)} of {args.end_address - args.start_address + 1} bytes")
 
-    print("\nStart checksum check")
-    kwp_client.calculate_flash_checksum(args.start_address, args.end_address, checksum)
+    if not ranges:
+        print("Nothing to flash")
+        sys.exit(0)
+    if args.dry_run:
+        sys.exit(0)
 
-    print("\nRequest checksum results")
-    result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM)
-    assert result == b"\x00", "Checksum check failed"
+    print("\n[READY TO FLASH]")
+    print("WARNING! USE AT YOUR OWN RISK! THIS COULD BREAK YOUR ECU AND REQUIRE REPLACEMENT!")
+    print("before proceeding:")
+    print("* put vehicle in park, and accessory mode (your engine should not be running)")
+    print("* ensure battery is fully charged. A full flash can take up to 15 minutes")
+    resp = input("continue [y/n]")
+    if resp.lower() != "y":
+        sys.exit(1)
 
-    print("\nStop communication")
-    kwp_client.stop_communication()
+    metrics = Metrics() if args.metrics else None
+    p = Panda()
+    if args.record:
+        p = RecordingPanda(p, CanLog.create(args.record))
+    try:
+        flash(p, args.bus, input_fw_s, ranges, args.chunk_size, args.verify, metrics)
+    finally:
+        if metrics is not None:
+            metrics.write(args.metrics)
+            print(f"Metrics written to {args.metrics}")
 
     print("\nDone!")
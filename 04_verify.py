@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import importlib
+import mmap
+import sys
+import time
+import tqdm
+from argparse import ArgumentParser
+
+from panda import Panda  # type: ignore
+from tp20 import TP20Transport
+from kwp2000 import KWP2000Client
+from memory_reader import open_reader, verify_memory
+
+flasher = importlib.import_module("03_flasher")
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--bus", default=0, type=int, help="CAN bus number to use")
+    parser.add_argument("--input", required=True, help="image that was flashed")
+    parser.add_argument("--start-address", default=0x5E000, type=int, help="start address")
+    parser.add_argument("--end-address", default=0x5EFFF, type=int, help="end address (inclusive)")
+    parser.add_argument("--reference", help="dump from before flashing, only sectors that differ from it are read back")
+    parser.add_argument("--sector-size", default=0x1000, type=int, help="flash sector size used with --reference")
+    parser.add_argument("--mode", default="auto", choices=["auto", "kwp", "ccp"], help="read using KWP2000, CCP or KWP2000 with CCP as fallback")
+    args = parser.parse_args()
+
+    input_fw = open(args.input, "rb")
+    input_fw_s = mmap.mmap(input_fw.fileno(), 0, access=mmap.ACCESS_READ)
+    assert args.end_address < len(input_fw_s)
+
+    if args.reference:
+        reference_fw = open(args.reference, "rb")
+        reference_fw_s = mmap.mmap(reference_fw.fileno(), 0, access=mmap.ACCESS_READ)
+
+        assert len(reference_fw_s) == len(input_fw_s), "Reference and input have a different size"
+        ranges = flasher.plan_sectors(reference_fw_s, input_fw_s, args.start_address, args.end_address, args.sector_size)
+    else:
+        ranges = [(args.start_address, args.end_address)]
+
+    if not ranges:
+        print("Nothing to verify")
+        sys.exit(0)
+
+    p = Panda()
+    p.can_clear(0xFFFF)
+    p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
+
+    print("Connecting...")
+    kwp_client = KWP2000Client(TP20Transport(p, 0x9, bus=args.bus, threaded=True))
+
+    reader = open_reader(p, args.bus, kwp_client, ranges[0][0], args.mode)
+    if reader is None:
+        sys.exit(1)
+
+    print(f"Reading using {reader.name}")
+    size = sum(end - start + 1 for start, end in ranges)
+    progress = tqdm.tqdm(total=size)
+
+    start = time.monotonic()
+    mismatch = verify_memory(reader, input_fw_s, ranges, progress=progress.update)
+    progress.close()
+    elapsed = time.monotonic() - start
+
+    if mismatch is not None:
+        print(f"\nMismatch, {len(mismatch)} bytes differ in the first bad block:")
+        for addr, read, expected in mismatch:
+            print(f"* {hex(addr)}: read {read:02x}, expected {expected:02x}")
+        sys.exit(1)
+
+    print(f"\nVerified {size} bytes in {elapsed:.1f} s, flash contents match {args.input}")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Record the CAN traffic of a session and replay it. RecordingPanda sits between
+the transport and the panda and appends every frame sent and received to a
+binary log. ReplayPanda plays a log back to the transport: received frames are
+released after the frame sent before them, either at once or with their
+recorded delay, so a recorded session can be run again through changed code.
+
+./can_log.py info dump.canlog
+./can_log.py print dump.canlog
+./can_log.py replay dump.canlog --record replayed.canlog -- 01_dump.py --output replayed.bin
+"""
+import atexit
+import bisect
+import os
+import struct
+import time
+from argparse import REMAINDER, ArgumentParser
+from array import array
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+MAGIC = b"PQCANLOG"
+LOG_VERSION = 1
+
+# magic, version, wall clock time the log was started
+HEADER = struct.Struct("<8sBd")
+# seconds since the start, direction, bus, address, length, data padded to 8 bytes
+RECORD = struct.Struct("<dBBHB8s")
+
+RX = 0
+TX = 1
+
+FLUSH_INTERVAL = 256
+
+
+class ReplayMismatchError(Exception):
+    pass
+
+
+class CanLog:
+    def __init__(self, path: Optional[str] = None):
+        """Frames of a session, stored column wise in arrays. Records in the file
+        have a fixed size, so record n is found at HEADER.size + n * RECORD.size
+        and records can be looked up by time with a binary search on times"""
+        self.path = path
+        self.started = time.time()
+        self.times = array("d")
+        self.directions = array("B")
+        self.buses = array("B")
+        self.addrs = array("H")
+        self.lengths = array("B")
+        self.data = bytearray()
+
+        self.t0 = time.monotonic()
+        self.flushed = 0
+
+    @classmethod
+    def create(cls, path: str) -> "CanLog":
+        """New log, frames are appended to path as they are recorded"""
+        log = cls(path)
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, LOG_VERSION, log.started))
+        return log
+
+    @classmethod
+    def load(cls, path: str) -> "CanLog":
+        with open(path, "rb") as f:
+            magic, version, started = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != LOG_VERSION:
+                raise ValueError(f"{path} is not a version {LOG_VERSION} CAN log")
+            body = f.read()
+
+        # Ignore a partial record at the end, left when the recording was killed
+        body = body[: len(body) - len(body) % RECORD.size]
+
+        log = cls()
+        log.started = started
+        for t, direction, bus, addr, length, dat in RECORD.iter_unpack(body):
+            log.times.append(t)
+            log.directions.append(direction)
+            log.buses.append(bus)
+            log.addrs.append(addr)
+            log.lengths.append(length)
+            log.data += dat
+        return log
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def append(self, direction: int, bus: int, addr: int, dat: bytes, t: Optional[float] = None):
+        if len(dat) > 8:
+            raise ValueError(f"Frame of {len(dat)} bytes, only classic CAN frames can be logged")
+
+        self.times.append(time.monotonic() - self.t0 if t is None else t)
+        self.directions.append(direction)
+        self.buses.append(bus)
+        self.addrs.append(addr)
+        self.lengths.append(len(dat))
+        self.data += bytes(dat).ljust(8, b"\x00")
+
+        if self.path is not None and len(self.times) - self.flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Append the records not yet written to the file"""
+        if self.path is None or self.flushed == len(self.times):
+            return
+
+        with open(self.path, "ab") as f:
+            f.write(b"".join(RECORD.pack(*self[i]) for i in range(self.flushed, len(self.times))))
+        self.flushed = len(self.times)
+
+    def __getitem__(self, i: int) -> Tuple[float, int, int, int, int, bytes]:
+        """(time, direction, bus, address, length, data padded to 8 bytes)"""
+        return self.times[i], self.directions[i], self.buses[i], self.addrs[i], self.lengths[i], bytes(self.data[i * 8 : i * 8 + 8])
+
+    def frame(self, i: int) -> bytes:
+        return bytes(self.data[i * 8 : i * 8 + self.lengths[i]])
+
+    def frames(self, start: float = 0.0, end: float = float("inf")) -> Iterator[Tuple[float, int, int, int, bytes]]:
+        """(time, direction, bus, address, data) of the frames between start and end seconds"""
+        for i in range(bisect.bisect_left(self.times, start), bisect.bisect_right(self.times, end)):
+            yield self.times[i], self.directions[i], self.buses[i], self.addrs[i], self.frame(i)
+
+    def summary(self) -> Dict[str, Any]:
+        """Duration, frame and byte counts and the largest gap between frames, to compare sessions"""
+        tx = [i for i in range(len(self)) if self.directions[i] == TX]
+        gaps = [b - a for a, b in zip(self.times, self.times[1:])]
+        return {
+            "seconds": self.times[-1] - self.times[0] if len(self) else 0.0,
+            "frames_sent": len(tx),
+            "frames_received": len(self) - len(tx),
+            "bytes_sent": sum(self.lengths[i] for i in tx),
+            "bytes_received": sum(self.lengths) - sum(self.lengths[i] for i in tx),
+            "max_gap": max(gaps, default=0.0),
+        }
+
+
+class RecordingPanda:
+    def __init__(self, panda: Any, log: CanLog):
+        """Passes everything to panda and records the frames sent and received in log.
+        The log is flushed at exit, so a session that fails is recorded in full"""
+        self.panda = panda
+        self.log = log
+        atexit.register(self.close)
+
+    def can_send(self, addr: int, dat: bytes, bus: int, timeout: int = 0):
+        self.log.append(TX, bus, addr, dat)
+        return self.panda.can_send(addr, dat, bus, timeout)
+
+    def can_send_many(self, arr, timeout: int = 0):
+        for addr, _, dat, bus in arr:
+            self.log.append(TX, bus, addr, dat)
+        return self.panda.can_send_many(arr, timeout=timeout)
+
+    def can_recv(self):
+        msgs = self.panda.can_recv()
+        for addr, _, dat, bus in msgs:
+            self.log.append(RX, bus, addr, dat)
+        return msgs
+
+    def close(self):
+        self.log.flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.panda, name)
+
+
+class ReplayPanda:
+    SAFETY_ALLOUTPUT = 17
+
+    def __init__(self, log: CanLog, realtime: bool = False, strict: bool = True):
+        """Stand-in for a panda playing back log. Every frame sent is matched with
+        the next frame sent in the log, after which the frames received up to the
+        following frame sent are returned by can_recv. With realtime they are held
+        back for their recorded delay after the frame sent, otherwise they are
+        returned at once. A frame that does not match raises ReplayMismatchError,
+        unless strict is False, then it is recorded in mismatches"""
+        self.log = log
+        self.realtime = realtime
+        self.strict = strict
+        self.pos = 0
+        self.pending: Deque[Tuple[float, int, bytes, int]] = deque()
+        self.mismatches: List[Tuple[int, int, int, bytes]] = []
+        self.safety_mode: Optional[int] = None
+        self._release(None)
+
+    @property
+    def done(self) -> bool:
+        return self.pos == len(self.log) and not self.pending
+
+    def _release(self, sent_at: Optional[float]):
+        now = time.monotonic()
+        log = self.log
+        while self.pos < len(log) and log.directions[self.pos] == RX:
+            due = now + log.times[self.pos] - sent_at if self.realtime and sent_at is not None else now
+            self.pending.append((due, log.addrs[self.pos], log.frame(self.pos), log.buses[self.pos]))
+            self.pos += 1
+
+    def _transmit(self, addr: int, dat: bytes, bus: int):
+        log = self.log
+        if self.pos == len(log):
+            if self.strict:
+                raise ReplayMismatchError(f"Frame {hex(addr)} {bytes(dat).hex()} sent after the end of the log")
+            self.mismatches.append((len(log), bus, addr, bytes(dat)))
+            return
+
+        if (log.buses[self.pos], log.addrs[self.pos], log.frame(self.pos)) != (bus, addr, bytes(dat)):
+            expected = f"{hex(log.addrs[self.pos])} {log.frame(self.pos).hex()}"
+            if self.strict:
+                raise ReplayMismatchError(f"Frame {self.pos}: sent {hex(addr)} {bytes(dat).hex()}, log has {expected}")
+            self.mismatches.append((self.pos, bus, addr, bytes(dat)))
+
+        self.pos += 1
+        self._release(log.times[self.pos - 1])
+
+    def set_safety_mode(self, mode: int):
+        self.safety_mode = mode
+
+    def can_clear(self, bus: int):
+        # Frames in the log were received by the transport, clearing would lose them
+        pass
+
+    def can_send(self, addr: int, dat: bytes, bus: int, timeout: int = 0):
+        self._transmit(addr, dat, bus)
+
+    def can_send_many(self, arr, timeout: int = 0):
+        for addr, _, dat, bus in arr:
+            self._transmit(addr, dat, bus)
+
+    def can_recv(self) -> List[Tuple[int, int, bytearray, int]]:
+        now = time.monotonic()
+        msgs = []
+        while self.pending and self.pending[0][0] <= now:
+            _, addr, dat, bus = self.pending.popleft()
+            msgs.append((addr, 0, bytearray(dat), bus))
+        return msgs
+
+
+def print_frames(log: CanLog):
+    for t, direction, bus, addr, dat in log.frames():
+        print(f"{t:12.6f} {'TX' if direction == TX else 'RX'} {bus} {addr:03X} [{len(dat)}] {dat.hex(' ')}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    info = sub.add_parser("info", help="print a summary of one or more logs")
+    info.add_argument("logs", nargs="+")
+
+    dump = sub.add_parser("print", help="print every frame in a log")
+    dump.add_argument("log")
+
+    replay = sub.add_parser("replay", help="run a script against a recorded session")
+    replay.add_argument("log")
+    replay.add_argument("--realtime", action="store_true", help="hold back received frames for their recorded delay")
+    replay.add_argument("--lenient", action="store_true", help="continue when a frame sent differs from the log")
+    replay.add_argument("--record", help="record the replayed session to this log, to compare timing")
+    replay.add_argument("script", help="script to run")
+    replay.add_argument("args", nargs=REMAINDER, help="arguments for the script")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        summaries = [CanLog.load(path).summary() for path in args.logs]
+        print(f"{'':<16}" + "".join(f"{os.path.basename(path)[:20]:>22}" for path in args.logs))
+        for key in summaries[0]:
+            print(f"{key:<16}" + "".join(f"{s[key]:>22.3f}" if isinstance(s[key], float) else f"{s[key]:>22}" for s in summaries))
+
+    elif args.command == "print":
+        print_frames(CanLog.load(args.log))
+
+    else:
+        from panda_sim import run_script
+
+        p = ReplayPanda(CanLog.load(args.log), args.realtime, not args.lenient)
+        panda: Any = p
+        if args.record:
+            panda = RecordingPanda(p, CanLog.create(args.record))
+
+        start = time.monotonic()
+        try:
+            run_script(panda, args.script, args.args)
+        finally:
+            print(f"\n[REPLAY] {time.monotonic() - start:.2f} s, {p.pos} of {len(p.log)} frames replayed, {len(p.mismatches)} mismatches")
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Host side microbenchmarks for the TP 2.0 framing, KWP2000 encoding, checksum
+patching and the flasher transfer loop. No panda is needed, everything runs
+against in-memory stand-ins.
+
+PYTHONPATH=. extras/benchmark.py --json bench.json
+"""
+import importlib
+import json
+import platform
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Any, Callable, List, Optional, TypedDict
+
+from kwp2000 import ECU_IDENTIFICATION_TYPE, KWP2000Client, NegativeResponseError
+from panda_sim import SimEcu, SimPanda
+import patcher
+from tp20 import TP20Transport, frame_blocks
+
+flasher = importlib.import_module("03_flasher")
+
+
+class AckPanda:
+    def __init__(self):
+        """Acks every frame that asks for it, and returns queued frames on can_recv"""
+        self.rx: List[Any] = []
+
+    def can_send(self, addr: int, dat: bytes, bus: int, timeout: int = 0):
+        if addr == 0x200:
+            self.rx.append((0x209, 0, b"\x00\xd0\x00\x03\x40\x07\x01", bus))
+        elif dat[0] == 0xA0:
+            self.rx.append((0x300, 0, b"\xa1\x0f\x8a\xff\x00\xff", bus))
+        elif dat[0] >> 4 in (0x0, 0x1):
+            self.rx.append((0x300, 0, bytes([0xB0 | ((dat[0] + 1) & 0xF)]), bus))
+
+    def can_send_many(self, arr, timeout: int = 0):
+        for addr, _, dat, bus in arr:
+            self.can_send(addr, dat, bus)
+
+    def can_recv(self):
+        rx, self.rx = self.rx, []
+        return rx
+
+
+class ConstantTransport(TP20Transport):
+    def __init__(self, resp: bytes):
+        """Returns the same response to every request, no channel is opened"""
+        self.resp = resp
+        self.metrics = None
+
+    def send(self, dat: bytes):
+        pass
+
+    def recv(self, timeout: Optional[float] = None) -> bytes:
+        return self.resp
+
+
+class BenchResult(TypedDict):
+    name: str
+    ops: int
+    seconds: float
+    cpu_seconds: float
+    ops_per_s: float
+    bytes_per_s: float
+    alloc_peak_bytes: int
+    alloc_blocks_retained: int
+
+
+def bench(name: str, fn: Callable[[], Any], number: int, bytes_per_op: int = 0) -> BenchResult:
+    fn()  # Warm up
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(number):
+        fn()
+    cpu = time.process_time() - cpu_start
+    elapsed = time.perf_counter() - start
+
+    # Measure allocations in a separate run, tracing slows down everything
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    base = tracemalloc.get_traced_memory()[0]
+    for _ in range(number):
+        fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+
+    result: BenchResult = {
+        "name": name,
+        "ops": number,
+        "seconds": elapsed,
+        "cpu_seconds": cpu,
+        "ops_per_s": number / elapsed,
+        "bytes_per_s": bytes_per_op * number / elapsed,
+        "alloc_peak_bytes": peak - base,
+        "alloc_blocks_retained": blocks,
+    }
+    print(f"{name:<32} {result['ops_per_s']:>12.1f} ops/s {result['bytes_per_s'] / 1e6:>8.2f} MB/s {result['alloc_peak_bytes']:>10} B peak")
+    return result
+
+
+def bench_tp20(number: int) -> List[BenchResult]:
+    p = AckPanda()
+    tp20 = TP20Transport(p, 0x9)
+    results = []
+
+    for size in (8, 240, 4096):
+        dat = bytes(size)
+        results.append(bench(f"tp20.send {size} B", lambda: tp20.send(dat), number, size))
+
+    for size in (8, 240, 4096):
+        dat = bytes(size)
+
+        def recv():
+            # The transport checks sequence numbers, so continue where the last message ended
+            p.rx.extend((0x300, 0, frame, 0) for block in frame_blocks(dat, tp20.rx_next, 0) for frame in block)
+            tp20.recv()
+
+        results.append(bench(f"tp20.recv {size} B", recv, number, size))
+
+    return results
+
+
+def bench_kwp(number: int) -> List[BenchResult]:
+    results = []
+
+    kwp_client = KWP2000Client(ConstantTransport(b"\x76"))
+    chunk = bytes(240)
+    results.append(bench("kwp.transfer_data 240 B", lambda: kwp_client.transfer_data(chunk), number, len(chunk)))
+
+    kwp_client = KWP2000Client(ConstantTransport(b"\x5a\x9b" + bytes(40)))
+    results.append(bench("kwp.read_ecu_identification", lambda: kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), number))
+
+    kwp_client = KWP2000Client(ConstantTransport(b"\x7f\x36\x72"))
+
+    def nrc():
+        try:
+            kwp_client.transfer_data(chunk)
+        except NegativeResponseError:
+            pass
+
+    results.append(bench("kwp.transfer_data NRC", nrc, number))
+    return results
+
+
+def bench_patcher(number: int) -> List[BenchResult]:
+    image = bytearray(range(256)) * (0x60000 // 256)
+    config = patcher.checksums["3501"]
+    patcher.update_checksums(image, config)
+
+    original = bytearray(image)
+    for addr, orig, _ in patcher.patches["3501"]:
+        original[addr : addr + len(orig)] = orig
+    patcher.update_checksums(original, config)
+
+    return [
+        bench("patcher.crc16 0x60000 B", lambda: patcher.crc16(image), number, len(image)),
+        bench("patcher.verify_checksums 3501", lambda: patcher.verify_checksums(image, config), number, len(image)),
+        bench("patcher.update_checksums 3501", lambda: patcher.update_checksums(image, config), number, len(image)),
+        bench("patcher.patch 3501", lambda: patcher.patch(original, "3501"), number, len(original)),
+        bench("patcher.patch 3501 no verify", lambda: patcher.patch(original, "3501", verify=False), number, len(original)),
+    ]
+
+
+def bench_flasher(number: int, size: int) -> List[BenchResult]:
+    ecu = SimEcu(bytes(0x60000), latency=0.0, frame_gap=0.0, t3=0x00)
+    p = SimPanda(frame_time=0.0)
+    p.attach(ecu)
+
+    ecu.session = 0x85
+    ecu.unlocked = True
+    kwp_client = KWP2000Client(TP20Transport(p, 0x9))
+    data = bytes(range(256)) * (size // 256)
+
+    def flash():
+        chunk_size = kwp_client.request_download(0x5E000 - size, size)
+        flasher.transfer(kwp_client, data, chunk_size - 1)
+        kwp_client.request_transfer_exit()
+
+    return [bench(f"flasher.transfer {size} B", flash, number, size)]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--number", default=100, type=int, help="iterations per benchmark")
+    parser.add_argument("--flash-size", default=0x1000, type=int, help="bytes per simulated flash")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    results += bench_tp20(args.number)
+    results += bench_kwp(args.number * 10)
+    results += bench_patcher(max(args.number // 10, 1))
+    results += bench_flasher(max(args.number // 10, 1), args.flash_size)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=2)
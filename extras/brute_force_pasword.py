@@ -1,61 +1,224 @@
 #!/usr/bin/env python3
+import json
+import os
 import struct
+import time
 from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Optional
 
 from kwp2000 import ACCESS_TYPE, SESSION_TYPE, KWP2000Client, NegativeResponseError
 from panda import Panda
-from tp20 import TP20Transport
+from tp20 import MessageTimeoutError, TP20Transport
 from tqdm import tqdm
 
+CHECKPOINT_INTERVAL = 64
+MAX_RECONNECTS = 10
+
 
 def login(kwp_client, password):
     seed = kwp_client.security_access(ACCESS_TYPE.REQUEST_SEED)
     seed_int = struct.unpack(">I", seed)[0]
-    key = struct.pack(">I", seed_int + password)
+    key = struct.pack(">I", (seed_int + password) & 0xFFFF_FFFF)
     kwp_client.security_access(ACCESS_TYPE.SEND_KEY, key)
 
 
-if __name__ == "__main__":
-    parser = ArgumentParser()
-    parser.add_argument("--known-password", default=40168, help="Kwown password")
-    parser.add_argument("--target-mode", default=0x86, help="Target diagnostics mode")
-    args = parser.parse_args()
+class SearchCheckpoint:
+    def __init__(self, path: Optional[str], start: int, end: int):
+        """Progress of the search over [start, end), stored as JSON in path"""
+        self.path = path
+        self.start = start
+        self.end = end
+        self.next = start
+        self.found: List[Dict[str, Any]] = []
+        self.reconnects = 0
 
-    p = Panda()
-    p.can_clear(0xFFFF)
-    p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
+    def load(self) -> bool:
+        if self.path is None or not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as f:
+            state = json.load(f)
+
+        if (state["start"], state["end"]) != (self.start, self.end):
+            raise ValueError(f"Checkpoint {self.path} is for a different range, remove it to start over")
+
+        self.next = state["next"]
+        self.found = state["found"]
+        self.reconnects = state["reconnects"]
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+
+        state = {"start": self.start, "end": self.end, "next": self.next, "found": self.found, "reconnects": self.reconnects}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
 
-    tp20 = TP20Transport(p, 0x9)
-    kwp_client = KWP2000Client(tp20)
 
-    for password in tqdm(range(0x10000)):
+class PasswordSearch:
+    def __init__(self, p: Panda, known_password: int, target_mode: int, max_attempts: int = 3, bus: int = 0):
+        """Tries passwords for security access and target_mode. The ECU refuses seeds
+        after max_attempts failed logins, so its attempt counter is reset by logging
+        in with known_password only when one attempt is left"""
+        self.p = p
+        self.bus = bus
+        self.known_password = known_password
+        self.target_mode = SESSION_TYPE(target_mode)
+        self.max_attempts = max_attempts
+
+        # Unknown after connecting, so reset before the first candidate
+        self.attempts = max_attempts
+        self.kwp_client: Optional[KWP2000Client] = None
+
+        self.exchanges = 0
+        self.resets = 0
+        self.rtts: List[float] = []
+
+    def connect(self):
+        """Open the channel, or open it again on the same transport after a timeout"""
+        if self.kwp_client is None:
+            self.p.can_clear(0xFFFF)
+            self.kwp_client = KWP2000Client(TP20Transport(self.p, 0x9, bus=self.bus, threaded=True))
+        else:
+            elapsed = self.kwp_client.transport.reconnect()
+            print(f"Reconnected after {elapsed * 1000:.0f} ms")
+        self.attempts = self.max_attempts
+
+    def reset_attempts(self):
+        assert self.kwp_client is not None
+
         # Clear attempts by doing a sucesful login
         try:
-            login(kwp_client, args.known_password)
-        except NegativeResponseError:
-            pass
+            self.exchanges += 2
+            login(self.kwp_client, self.known_password)
+        except NegativeResponseError as e:
+            raise RuntimeError(f"Login with the known password failed, attempts are not reset: {e}")
 
         # Clear login state by doing a failed mode set
         try:
-            kwp_client.diagnostic_session_control(args.target_mode)
+            self.exchanges += 1
+            self.kwp_client.diagnostic_session_control(self.target_mode)
         except NegativeResponseError:
             pass
 
+        self.attempts = 0
+        self.resets += 1
+
+    def try_password(self, password: int) -> List[str]:
+        """Returns what password is valid for: "login" and/or the target mode"""
+        assert self.kwp_client is not None
+        if self.attempts + 1 >= self.max_attempts:
+            self.reset_attempts()
+
+        valid = []
+
         # Check if password is valid
         try:
-            login(kwp_client, password)
-            print(f"Valid password {password}")
+            self.exchanges += 2
+            login(self.kwp_client, password)
+            valid.append("login")
+            self.attempts = 0
         except NegativeResponseError:
-            pass
+            self.attempts += 1
+            return valid
 
-        # Try entering target mode
+        # Try entering target mode, this also clears the login state if it fails
         try:
-            kwp_client.diagnostic_session_control(args.target_mode)
-            print(f"Valid passowrd {password} for mode {hex(args.target_mode)}")
-            kwp_client.diagnostic_session_control(SESSION_TYPE.DIAGNOSTIC)
+            self.exchanges += 1
+            self.kwp_client.diagnostic_session_control(self.target_mode)
+            valid.append(hex(self.target_mode))
+
+            self.exchanges += 1
+            self.kwp_client.diagnostic_session_control(SESSION_TYPE.DIAGNOSTIC)
         except NegativeResponseError:
             pass
 
-        # Keep channel alive
-        tp20.can_send(b"\xa3")
-        tp20.can_recv()
+        return valid
+
+    def run(self, checkpoint: SearchCheckpoint, progress: Optional[Callable[[int], Any]] = None) -> List[Dict[str, Any]]:
+        """Try every password from checkpoint.next. The channel is opened again when
+        the ECU stops responding, and the candidate is retried"""
+        if self.kwp_client is None:
+            self.connect()
+
+        reconnects = 0
+        while checkpoint.next < checkpoint.end:
+            password = checkpoint.next
+            start = time.monotonic()
+            try:
+                valid = self.try_password(password)
+                assert self.kwp_client is not None
+                self.kwp_client.transport.keep_alive()
+            except MessageTimeoutError:
+                reconnects += 1
+                if reconnects > MAX_RECONNECTS:
+                    checkpoint.save()
+                    raise
+
+                print(f"\nTimeout at {password}, reconnecting")
+                checkpoint.reconnects += 1
+                self.connect()
+                continue
+
+            reconnects = 0
+            self.rtts.append(time.monotonic() - start)
+            if valid:
+                print(f"\nValid password {password} for {', '.join(valid)}")
+                checkpoint.found.append({"password": password, "valid": valid})
+
+            checkpoint.next = password + 1
+            if checkpoint.next % CHECKPOINT_INTERVAL == 0:
+                checkpoint.save()
+            if progress is not None:
+                progress(1)
+
+        checkpoint.save()
+        return checkpoint.found
+
+    def stats(self) -> Dict[str, Any]:
+        """Round trip time per candidate and KWP2000 exchanges"""
+        rtts = sorted(self.rtts)
+        if not rtts:
+            return {}
+        return {
+            "candidates": len(rtts),
+            "exchanges_per_candidate": self.exchanges / len(rtts),
+            "resets": self.resets,
+            "rtt_mean_ms": sum(rtts) / len(rtts) * 1000,
+            "rtt_p50_ms": rtts[len(rtts) // 2] * 1000,
+            "rtt_p95_ms": rtts[int(len(rtts) * 0.95)] * 1000,
+            "rtt_max_ms": rtts[-1] * 1000,
+        }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--known-password", default=40168, type=int, help="Kwown password")
+    parser.add_argument("--target-mode", default=0x86, type=lambda x: int(x, 0), help="Target diagnostics mode")
+    parser.add_argument("--max-attempts", default=3, type=int, help="failed logins after which the ECU refuses seeds")
+    parser.add_argument("--start", default=0, type=int, help="first password to try")
+    parser.add_argument("--end", default=0x10000, type=int, help="stop before this password")
+    parser.add_argument("--checkpoint", default="brute_force.json", help="progress file, the search resumes from it")
+    parser.add_argument("--bus", default=0, type=int, help="CAN bus number to use")
+    args = parser.parse_args()
+
+    checkpoint = SearchCheckpoint(args.checkpoint, args.start, args.end)
+    if checkpoint.load():
+        print(f"Resuming at {checkpoint.next}, found so far: {checkpoint.found}")
+
+    p = Panda()
+    p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
+
+    search = PasswordSearch(p, args.known_password, args.target_mode, args.max_attempts, args.bus)
+    progress = tqdm(total=args.end - args.start, initial=checkpoint.next - args.start)
+    try:
+        found = search.run(checkpoint, progress.update)
+    finally:
+        progress.close()
+        checkpoint.save()
+        print(json.dumps(search.stats(), indent=2))
+
+    print(f"Found {found}")
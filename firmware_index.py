@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Index of a directory of firmware dumps. For every file the index keeps its
+hash, hashes of the ASW and calibration regions, the detected version and
+whether its checksums are valid. Files are only read again when their size
+or modification time changed, lookups never touch the binaries.
+
+./firmware_index.py firmware --version 3501 --valid
+./firmware_index.py firmware --lookup dump.bin
+"""
+import hashlib
+import json
+import os
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional
+
+from patcher import checksums, detect_version, patches, verify_checksums
+
+INDEX_VERSION = 1
+
+# [start, end) of the regions hashed separately
+REGIONS = {
+    "asw": (0x0A000, 0x5C000),
+    "calibration": (0x5C000, 0x5F000),
+}
+
+
+def describe(fw: bytes) -> Dict[str, Any]:
+    """Returns the index entry for an image, without file information"""
+    view = memoryview(fw)
+    entry: Dict[str, Any] = {
+        "sha256": hashlib.sha256(view).hexdigest(),
+        "regions": {name: hashlib.sha256(view[start:end]).hexdigest() for name, (start, end) in REGIONS.items() if end <= len(fw)},
+        "version": None,
+        "part_number": None,
+        "software_version": None,
+        "patched": None,
+        "checksums_valid": None,
+    }
+
+    detected = detect_version(fw)
+    if detected is not None:
+        version, patched = detected
+        addr, orig, _ = patches[version][0]
+        part_number, software_version = bytes(view[addr : addr + len(orig)]).split(b"\x00", 1)
+        entry["version"] = version
+        entry["part_number"] = part_number.decode("latin-1").strip()
+        entry["software_version"] = software_version.decode("latin-1")
+        entry["patched"] = patched
+        entry["checksums_valid"] = verify_checksums(fw, checksums[version])
+
+    return entry
+
+
+class FirmwareIndex:
+    def __init__(self, root: str, path: Optional[str] = None):
+        """Index of the .bin files below root, stored in path (root/index.json by default)"""
+        self.root = root
+        self.path = path or os.path.join(root, "index.json")
+        self.files: Dict[str, Dict[str, Any]] = {}
+
+    def load(self) -> bool:
+        """Load the index from disk, returns False if there is none or it is outdated"""
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as f:
+            state = json.load(f)
+
+        if state.get("index_version") != INDEX_VERSION:
+            return False
+
+        self.files = state["files"]
+        return True
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"index_version": INDEX_VERSION, "files": self.files}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def refresh(self) -> List[str]:
+        """Index new and changed files and forget removed ones. Returns the files that were read"""
+        seen = set()
+        read = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in sorted(filenames):
+                if not filename.endswith(".bin"):
+                    continue
+
+                full_path = os.path.join(dirpath, filename)
+                name = os.path.relpath(full_path, self.root)
+                seen.add(name)
+
+                st = os.stat(full_path)
+                entry = self.files.get(name)
+                if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                    continue
+
+                with open(full_path, "rb") as f:
+                    entry = describe(f.read())
+                entry["size"] = st.st_size
+                entry["mtime_ns"] = st.st_mtime_ns
+                self.files[name] = entry
+                read.append(name)
+
+        for name in set(self.files) - seen:
+            del self.files[name]
+
+        return read
+
+    def find(self, sha256: str) -> List[str]:
+        """Files with the given content hash"""
+        return sorted(name for name, entry in self.files.items() if entry["sha256"] == sha256)
+
+    def query(self, version: Optional[str] = None, valid: Optional[bool] = None, patched: Optional[bool] = None) -> List[str]:
+        """Files matching all of the given properties"""
+        found = []
+        for name, entry in sorted(self.files.items()):
+            if version is not None and entry["version"] != version:
+                continue
+            if valid is not None and entry["checksums_valid"] != valid:
+                continue
+            if patched is not None and entry["patched"] != patched:
+                continue
+            found.append(name)
+        return found
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("root", help="directory with firmware files")
+    parser.add_argument("--index", help="index file, defaults to index.json in the firmware directory")
+    parser.add_argument("--version", help="only list files of this version")
+    parser.add_argument("--valid", action="store_true", help="only list files with valid checksums")
+    parser.add_argument("--unpatched", action="store_true", help="only list files that are not patched")
+    parser.add_argument("--lookup", help="list the indexed files with the same contents as this file")
+    args = parser.parse_args()
+
+    index = FirmwareIndex(args.root, args.index)
+    index.load()
+    read = index.refresh()
+    index.save()
+    print(f"Indexed {len(index.files)} files, {len(read)} new or changed")
+
+    if args.lookup:
+        with open(args.lookup, "rb") as f:
+            names = index.find(hashlib.sha256(f.read()).hexdigest())
+    else:
+        names = index.query(args.version, True if args.valid else None, False if args.unpatched else None)
+
+    for name in names:
+        entry = index.files[name]
+        valid = {True: "valid", False: "invalid", None: "-"}[entry["checksums_valid"]]
+        print(f"{name:<40} {entry['version'] or '-':<5} {entry['part_number'] or '-':<11} {entry['software_version'] or '-':<5} {valid:<7} {entry['sha256'][:16]}")
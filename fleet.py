@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Flash a bench of EPS racks in parallel, one panda per rack. Every connected
+panda is assigned an image and bus, each unit is handled by its own worker
+process and a report with the result of every unit is written at the end.
+
+Workflows:
+  flash             flash the assigned image
+  dump-patch-flash  dump the ECU, patch the dump and flash the sectors that changed
+"""
+import contextlib
+import importlib
+import json
+import os
+import sys
+import time
+import traceback
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from panda import Panda  # type: ignore
+from kwp2000 import ECU_IDENTIFICATION_TYPE, KWP2000Client
+from memory_reader import dump_memory, open_reader
+from metrics import Metrics
+from patcher import detect_version, patch
+from tp20 import TP20Transport
+
+flasher = importlib.import_module("03_flasher")
+
+WORKFLOWS = ["flash", "dump-patch-flash"]
+
+
+def assign_units(serials: List[str], assignments: List[str], bus: int, image: Optional[str]) -> List[Dict[str, Any]]:
+    """Returns a unit for every panda serial. assignments are SERIAL:BUS[:IMAGE]
+    strings overriding the default bus and image of a single panda"""
+    overrides = {}
+    for assignment in assignments:
+        serial, *rest = assignment.split(":", 2)
+        if serial not in serials:
+            raise ValueError(f"Panda {serial} is not connected")
+        if not rest:
+            raise ValueError(f"Assignment {assignment} has no bus, expected SERIAL:BUS[:IMAGE]")
+        overrides[serial] = {"bus": int(rest[0]), "image": rest[1] if len(rest) > 1 else image}
+
+    return [{"serial": serial, "bus": bus, "image": image, **overrides.get(serial, {})} for serial in serials]
+
+
+def decode_ident(ident: bytes) -> str:
+    return ident.decode("latin-1").strip("\x00 ")
+
+
+def dump(p: Panda, unit: Dict[str, Any], opts: Namespace, metrics: Optional[Metrics] = None) -> Tuple[str, bytes]:
+    """Dump the flash of a unit to <output dir>/<serial>.orig.bin. Returns the ECU
+    identification and the dump, padded to start at address 0"""
+    p.can_clear(0xFFFF)
+    p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
+
+    tp20 = TP20Transport(p, 0x9, bus=unit["bus"], threaded=True, metrics=metrics)
+    try:
+        kwp_client = KWP2000Client(tp20)
+        ident = decode_ident(kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT))
+
+        reader = open_reader(p, unit["bus"], kwp_client, opts.dump_start_address)
+        if reader is None:
+            raise RuntimeError("No way to read memory")
+
+        path = os.path.join(opts.output_dir, f"{unit['serial']}.orig.bin")
+        dump_memory(reader, path, opts.dump_start_address, opts.dump_end_address - opts.dump_start_address + 1)
+    finally:
+        tp20.close()
+
+    with open(path, "rb") as f:
+        return ident, b"\xff" * opts.dump_start_address + f.read()
+
+
+def unit_version(reference: bytes, version: Optional[str]) -> str:
+    """Returns the firmware version of a unit's dump. version is only needed when
+    the dump is not recognized, it must match the detected version otherwise"""
+    detected = detect_version(reference)
+    if detected is None:
+        if version is None:
+            raise ValueError("Unknown firmware version, pass --version")
+        return version
+
+    detected_version, patched = detected
+    if patched:
+        raise ValueError(f"Firmware {detected_version} is already patched")
+    if version is not None and version != detected_version:
+        raise ValueError(f"Firmware is {detected_version}, not {version}")
+    return detected_version
+
+
+def run_unit(unit: Dict[str, Any], opts: Namespace, p: Optional[Panda] = None) -> Dict[str, Any]:
+    """Run the workflow for a single unit. Output is written to <output dir>/<serial>.log.
+    Never raises, the returned report records the phase that failed and the protocol metrics"""
+    report: Dict[str, Any] = {"serial": unit["serial"], "bus": unit["bus"], "image": unit["image"], "ident": None, "result": "ok", "phase": None, "error": None}
+    timings: Dict[str, float] = {}
+    report["timings"] = timings
+    metrics = Metrics()
+    start = time.monotonic()
+
+    log_path = os.path.join(opts.output_dir, f"{unit['serial']}.log")
+    with open(log_path, "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            report["phase"] = "connect"
+            if p is None:
+                p = Panda(unit["serial"])
+            timings["connect"] = time.monotonic() - start
+
+            if opts.workflow == "dump-patch-flash":
+                report["phase"] = "dump"
+                t = time.monotonic()
+                report["ident"], reference = dump(p, unit, opts, metrics)
+                timings["dump"] = time.monotonic() - t
+
+                report["phase"] = "patch"
+                t = time.monotonic()
+                report["version"] = unit_version(reference, opts.version)
+                image = patch(reference, report["version"])
+                report["image"] = os.path.join(opts.output_dir, f"{unit['serial']}.patched.bin")
+                with open(report["image"], "wb") as f:
+                    f.write(image)
+                ranges = flasher.plan_sectors(reference, image, opts.start_address, opts.end_address, opts.sector_size)
+                timings["patch"] = time.monotonic() - t
+            else:
+                with open(unit["image"], "rb") as f:
+                    image = f.read()
+                ranges = [(opts.start_address, opts.end_address)]
+
+            report["phase"] = "flash"
+            report["ranges"] = [list(r) for r in ranges]
+            t = time.monotonic()
+            if ranges:
+                report["ident"] = decode_ident(flasher.flash(p, unit["bus"], image, ranges, opts.chunk_size, metrics=metrics))
+            timings["flash"] = time.monotonic() - t
+
+            report["phase"] = "done"
+        except Exception as e:
+            traceback.print_exc()
+            report["result"] = "failed"
+            report["error"] = f"{type(e).__name__}: {e}"
+
+    timings["total"] = time.monotonic() - start
+    report["metrics"] = metrics.snapshot()
+    return report
+
+
+def print_report(reports: List[Dict[str, Any]]):
+    print(f"\n{'serial':<26} {'bus':>3} {'result':<7} {'phase':<8} {'time':>8}  ident / error")
+    for r in reports:
+        detail = r["error"] if r["error"] else r["ident"]
+        print(f"{r['serial']:<26} {r['bus']:>3} {r['result']:<7} {r['phase']:<8} {r['timings']['total']:>7.1f}s  {detail}")
+
+    failed = sum(r["result"] != "ok" for r in reports)
+    print(f"\n{len(reports) - failed} of {len(reports)} units flashed successfully")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--workflow", default="flash", choices=WORKFLOWS)
+    parser.add_argument("--bus", default=0, type=int, help="CAN bus number used by all pandas without an assignment")
+    parser.add_argument("--input", help="image flashed by all pandas without an assignment (flash workflow)")
+    parser.add_argument("--assign", default=[], action="append", help="SERIAL:BUS[:IMAGE] for a single panda, can be repeated")
+    parser.add_argument("--version", choices=["2501", "3501"], help="firmware version, detected from each unit's dump by default (dump-patch-flash workflow)")
+    parser.add_argument("--start-address", default=0x5E000, type=int, help="start address")
+    parser.add_argument("--end-address", default=0x5EFFF, type=int, help="end address (inclusive)")
+    parser.add_argument("--dump-start-address", default=0, type=int, help="start address of the dump")
+    parser.add_argument("--dump-end-address", default=0x5FFFF, type=int, help="end address of the dump (inclusive)")
+    parser.add_argument("--chunk-size", default=0, type=int, help="bytes per transfer, defaults to the largest block the ECU accepts")
+    parser.add_argument("--sector-size", default=0x1000, type=int, help="flash sector size, only changed sectors are flashed after patching")
+    parser.add_argument("--output-dir", default="fleet", help="directory for dumps, logs and the report")
+    parser.add_argument("--yes", action="store_true", help="do not ask for confirmation")
+    args = parser.parse_args()
+
+    serials = Panda.list()
+    if not serials:
+        print("No pandas found")
+        sys.exit(1)
+
+    units = assign_units(serials, args.assign, args.bus, args.input)
+    if args.workflow == "flash":
+        for unit in units:
+            assert unit["image"] is not None, f"No image assigned to {unit['serial']}"
+            with open(unit["image"], "rb") as f:
+                assert f.read()[-4:] != b"Ende", f"Firmware {unit['image']} is not patched"
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    print(f"\n{args.workflow} on {len(units)} units:")
+    for unit in units:
+        print(f"* {unit['serial']} bus {unit['bus']} {unit['image'] or ''}")
+
+    if not args.yes:
+        print("\n[READY TO FLASH]")
+        print("WARNING! USE AT YOUR OWN RISK! THIS COULD BREAK YOUR ECU AND REQUIRE REPLACEMENT!")
+        print("before proceeding:")
+        print("* make sure every panda is connected to the unit listed above")
+        print("* ensure every unit has a stable power supply. A full flash can take up to 15 minutes")
+        resp = input("continue [y/n]")
+        if resp.lower() != "y":
+            sys.exit(1)
+
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=len(units)) as pool:
+        reports = list(pool.map(run_unit, units, [args] * len(units)))
+    elapsed = time.monotonic() - start
+
+    print_report(reports)
+    print(f"Total time {elapsed:.1f} s")
+
+    report_path = os.path.join(args.output_dir, "report.json")
+    with open(report_path, "w") as report_file:
+        json.dump({"workflow": args.workflow, "seconds": elapsed, "units": reports}, report_file, indent=2)
+    print(f"Report written to {report_path}")
+
+    if any(r["result"] != "ok" for r in reports):
+        sys.exit(1)
@@ -1,10 +1,25 @@
 #!/usr/bin/env python3
 import struct
+import time
 from enum import IntEnum
+from typing import Optional, Union
 
 from panda import Panda  # type: ignore
+from metrics import Metrics
 from tp20 import TP20Transport
 
+# Negative response codes handled by the client
+BUSY_REPEAT_REQUEST = 0x21
+RESPONSE_PENDING = 0x78
+
+# Time to wait for the response after a response pending, P2*max
+P2_STAR = 5.0
+
+# Requests answered with busy are repeated up to BUSY_RETRIES times, waiting
+# BUSY_DELAY seconds before the first retry and twice as long before every next one
+BUSY_RETRIES = 5
+BUSY_DELAY = 0.05
+
 
 class NegativeResponseError(Exception):
     def __init__(self, message, service_id, error_code):
@@ -123,75 +138,197 @@ _negative_response_codes = {
 }
 
 
-class KWP2000Client:
-    def __init__(self, transport: TP20Transport, debug: bool = False):
-        self.transport = transport
-        self.debug = debug
+def build_request(service_type: SERVICE_TYPE, subfunction: int = None, data: Union[bytes, memoryview] = None) -> bytes:
+    req = bytes([service_type])
 
-    def _kwp(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
-        req = bytes([service_type])
+    if subfunction is not None:
+        req += bytes([subfunction])
+    if data is not None:
+        req += data
 
-        if subfunction is not None:
-            req += bytes([subfunction])
-        if data is not None:
-            req += data
+    return req
 
-        if self.debug:
-            print(f"KWP TX: {req.hex()}")
 
-        self.transport.send(req)
-        resp = self.transport.recv()
+def negative_response_code(service_type: SERVICE_TYPE, resp: bytes) -> Optional[int]:
+    """Error code if resp is a negative response to service_type, None otherwise"""
+    if len(resp) > 2 and resp[0] == 0x7F and resp[1] == service_type:
+        return resp[2]
+    return None
 
-        if self.debug:
-            print(f"KWP RX: {resp.hex()}")
 
-        resp_sid = resp[0] if len(resp) > 0 else None
+def record_exchange(metrics: Metrics, service_type: SERVICE_TYPE, resp: bytes, elapsed: float):
+    """Count a request and its latency per service, and negative responses per error code"""
+    service = getattr(service_type, "name", hex(service_type))
+    metrics.inc("kwp_requests", service=service)
+    metrics.observe("kwp_request_seconds", elapsed, service=service)
+    if len(resp) > 2 and resp[0] == 0x7F:
+        metrics.inc("kwp_negative_responses", service=service, nrc=f"0x{resp[2]:02x}")
+
+
+def parse_response(service_type: SERVICE_TYPE, subfunction: int, resp: bytes) -> bytes:
+    """Check a response against the request, raises on a negative response.
+    Returns the data after the service id and sub-function id"""
+    resp_sid = resp[0] if len(resp) > 0 else None
+
+    # negative response
+    if resp_sid == 0x7F:
+        service_id = resp[1] if len(resp) > 1 else -1
+
+        try:
+            service_desc = SERVICE_TYPE(service_id).name
+        except BaseException:
+            service_desc = "NON_STANDARD_SERVICE"
+
+        error_code = resp[2] if len(resp) > 2 else -1
+
+        try:
+            error_desc = _negative_response_codes[error_code]
+        except BaseException:
+            error_desc = resp[3:].hex()
+
+        raise NegativeResponseError("{} - {}".format(service_desc, error_desc), service_id, error_code)
+
+    # positive response
+    if service_type + 0x40 != resp_sid:
+        resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
+        raise InvalidServiceIdError("invalid response service id: {}".format(resp_sid_hex))
+
+    # check subfunction
+    if subfunction is not None:
+        resp_sfn = resp[1] if len(resp) > 1 else None
+
+        if subfunction != resp_sfn:
+            resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
+            raise InvalidSubFunctionError(f"invalid response subfunction: {resp_sfn_hex}")
+
+    # return data (exclude service id and sub-function id)
+    return resp[(1 if subfunction is None else 2) :]
+
+
+def _check_security_key(access_type: ACCESS_TYPE, security_key: bytes):
+    request_seed = access_type % 2 != 0
+
+    if request_seed and len(security_key) != 0:
+        raise ValueError("security_key not allowed")
+    if not request_seed and len(security_key) == 0:
+        raise ValueError("security_key is missing")
+
+
+def _encode_transfer_request(
+    memory_address: int, uncompressed_size: int, compression_type: COMPRESSION_TYPE, encryption_type: ENCRYPTION_TYPE
+) -> bytes:
+    if memory_address > 0xFFFFFF:
+        raise ValueError(f"invalid memory_address {memory_address}")
+    if uncompressed_size > 0xFFFFFF:
+        raise ValueError(f"invalid uncompressed_size {uncompressed_size}")
+
+    addr = struct.pack(">L", memory_address)[1:]
+    size = struct.pack(">L", uncompressed_size)[1:]
+    return addr + bytes([(compression_type << 4) | encryption_type]) + size
+
 
-        # negative response
-        if resp_sid == 0x7F:
-            service_id = resp[1] if len(resp) > 1 else -1
+def _decode_block_length(ret: bytes) -> int:
+    if len(ret) == 1:
+        return struct.unpack(">B", ret)[0]
+    elif len(ret) == 2:
+        return struct.unpack(">H", ret)[0]
+    else:
+        raise ValueError(f"Invalid response {ret.hex()}")
 
-            try:
-                service_desc = SERVICE_TYPE(service_id).name
-            except BaseException:
-                service_desc = "NON_STANDARD_SERVICE"
 
-            error_code = resp[2] if len(resp) > 2 else -1
+def _encode_read_memory(memory_address: int, memory_size: int) -> bytes:
+    if memory_address > 0xFFFFFF:
+        raise ValueError(f"invalid memory_address {memory_address}")
+    if memory_size < 1 or memory_size > 0xFF:
+        raise ValueError(f"invalid memory_size {memory_size}")
 
-            try:
-                error_desc = _negative_response_codes[error_code]
-            except BaseException:
-                error_desc = resp[3:].hex()
+    return struct.pack(">L", memory_address)[1:] + bytes([memory_size])
 
-            raise NegativeResponseError("{} - {}".format(service_desc, error_desc), service_id, error_code)
 
-        # positive response
-        if service_type + 0x40 != resp_sid:
-            resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
-            raise InvalidServiceIdError("invalid response service id: {}".format(resp_sid_hex))
+def _decode_read_memory(ret: bytes, memory_size: int) -> bytes:
+    # Some ECUs echo the memory address after the data
+    if len(ret) < memory_size:
+        raise ValueError(f"Invalid response {ret.hex()}")
+    return ret[:memory_size]
 
-        # check subfunction
-        if subfunction is not None:
-            resp_sfn = resp[1] if len(resp) > 1 else None
 
-            if subfunction != resp_sfn:
-                resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
-                raise InvalidSubFunctionError(f"invalid response subfunction: {resp_sfn_hex:x}")
+def _encode_flash_range(start_address: int, end_address: int) -> bytes:
+    if start_address > 0xFFFFFF:
+        raise ValueError(f"invalid start_address {start_address}")
+    if end_address > 0xFFFFFF:
+        raise ValueError(f"invalid end_address {end_address}")
 
-        # return data (exclude service id and sub-function id)
-        return resp[(1 if subfunction is None else 2) :]
+    start = struct.pack(">L", start_address)[1:]
+    end = struct.pack(">L", end_address)[1:]
+    return start + end
+
+
+def _encode_checksum(checksum: int) -> bytes:
+    if checksum > 0xFFFF:
+        raise ValueError(f"invalid checksum {checksum}")
+
+    return struct.pack(">H", checksum)
+
+
+class KWP2000Client:
+    def __init__(
+        self, transport: TP20Transport, debug: bool = False, metrics: Optional[Metrics] = None, p2_star: float = P2_STAR, busy_retries: int = BUSY_RETRIES
+    ):
+        """Requests are recorded in metrics, by default the metrics of the transport.
+        After a response pending the response is waited for up to p2_star seconds,
+        requests answered with busy are repeated up to busy_retries times."""
+        self.transport = transport
+        self.debug = debug
+        self.metrics = metrics if metrics is not None else getattr(transport, "metrics", None)
+        self.p2_star = p2_star
+        self.busy_retries = busy_retries
+
+    def _kwp(self, service_type: SERVICE_TYPE, subfunction: int = None, data: Union[bytes, memoryview] = None) -> bytes:
+        req = build_request(service_type, subfunction, data)
+
+        start = time.monotonic()
+        delay = BUSY_DELAY
+        for retry in range(self.busy_retries + 1):
+            if retry:
+                if self.debug:
+                    print(f"ECU busy, repeating request in {delay * 1000:.0f} ms")
+                if self.metrics is not None:
+                    self.metrics.inc("kwp_busy_retries")
+                time.sleep(delay)
+                delay *= 2
+
+            resp = self._exchange(service_type, req)
+            if negative_response_code(service_type, resp) != BUSY_REPEAT_REQUEST:
+                break
+
+        if self.metrics is not None:
+            record_exchange(self.metrics, service_type, resp, time.monotonic() - start)
+
+        return parse_response(service_type, subfunction, resp)
+
+    def _exchange(self, service_type: SERVICE_TYPE, req: bytes) -> bytes:
+        """Send a request and return the response, waiting for it after a response pending"""
+        if self.debug:
+            print(f"KWP TX: {req.hex()}")
+
+        self.transport.send(req)
+        resp = self.transport.recv()
+        while negative_response_code(service_type, resp) == RESPONSE_PENDING:
+            if self.debug:
+                print(f"KWP RX: {resp.hex()}, response pending")
+            if self.metrics is not None:
+                self.metrics.inc("kwp_response_pending")
+            resp = self.transport.recv(timeout=self.p2_star)
+
+        if self.debug:
+            print(f"KWP RX: {resp.hex()}")
+        return resp
 
     def diagnostic_session_control(self, session_type: SESSION_TYPE):
         self._kwp(SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, subfunction=session_type)
 
     def security_access(self, access_type: ACCESS_TYPE, security_key: bytes = b""):
-        request_seed = access_type % 2 != 0
-
-        if request_seed and len(security_key) != 0:
-            raise ValueError("security_key not allowed")
-        if not request_seed and len(security_key) == 0:
-            raise ValueError("security_key is missing")
-
+        _check_security_key(access_type, security_key)
         return self._kwp(SERVICE_TYPE.SECURITY_ACCESS, subfunction=access_type, data=security_key)
 
     def read_ecu_identifcation(self, data_identifier_type: ECU_IDENTIFICATION_TYPE):
@@ -203,22 +340,23 @@ class KWP2000Client:
         uncompressed_size: int,
         compression_type: COMPRESSION_TYPE = COMPRESSION_TYPE.UNCOMPRESSED,
         encryption_type: ENCRYPTION_TYPE = ENCRYPTION_TYPE.UNENCRYPTED,
-    ):
-        if memory_address > 0xFFFFFF:
-            raise ValueError(f"invalid memory_address {memory_address}")
-        if uncompressed_size > 0xFFFFFF:
-            raise ValueError(f"invalid uncompressed_size {uncompressed_size}")
-
-        addr = struct.pack(">L", memory_address)[1:]
-        size = struct.pack(">L", uncompressed_size)[1:]
-        data = addr + bytes([(compression_type << 4) | encryption_type]) + size
-        ret = self._kwp(SERVICE_TYPE.REQUEST_DOWNLOAD, subfunction=None, data=data)
-        if len(ret) == 1:
-            return struct.unpack(">B", ret)[0]
-        elif len(ret) == 2:
-            return struct.unpack(">H", ret)[0]
-        else:
-            raise ValueError(f"Invalid response {ret.hex()}")
+    ) -> int:
+        data = _encode_transfer_request(memory_address, uncompressed_size, compression_type, encryption_type)
+        return _decode_block_length(self._kwp(SERVICE_TYPE.REQUEST_DOWNLOAD, subfunction=None, data=data))
+
+    def request_upload(
+        self,
+        memory_address: int,
+        uncompressed_size: int,
+        compression_type: COMPRESSION_TYPE = COMPRESSION_TYPE.UNCOMPRESSED,
+        encryption_type: ENCRYPTION_TYPE = ENCRYPTION_TYPE.UNENCRYPTED,
+    ) -> int:
+        data = _encode_transfer_request(memory_address, uncompressed_size, compression_type, encryption_type)
+        return _decode_block_length(self._kwp(SERVICE_TYPE.REQUEST_UPLOAD, subfunction=None, data=data))
+
+    def read_memory_by_address(self, memory_address: int, memory_size: int) -> bytes:
+        data = _encode_read_memory(memory_address, memory_size)
+        return _decode_read_memory(self._kwp(SERVICE_TYPE.READ_MEMORY_BY_ADDRESS, data=data), memory_size)
 
     def start_routine_by_local_identifier(self, routine_control: ROUTINE_CONTROL_TYPE, data: bytes) -> bytes:
         return self._kwp(SERVICE_TYPE.START_ROUTINE_BY_LOCAL_IDENTIFIER, routine_control, data)
@@ -227,29 +365,14 @@ class KWP2000Client:
         return self._kwp(SERVICE_TYPE.REQUEST_ROUTINE_RESULTS_BY_LOCAL_IDENTIFIER, routine_control)
 
     def erase_flash(self, start_address: int, end_address: int) -> bytes:
-        if start_address > 0xFFFFFF:
-            raise ValueError(f"invalid start_address {start_address}")
-        if end_address > 0xFFFFFF:
-            raise ValueError(f"invalid end_address {end_address}")
-
-        start = struct.pack(">L", start_address)[1:]
-        end = struct.pack(">L", end_address)[1:]
-        return self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH, start + end)
+        data = _encode_flash_range(start_address, end_address)
+        return self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH, data)
 
     def calculate_flash_checksum(self, start_address: int, end_address: int, checksum: int) -> bytes:
-        if start_address > 0xFFFFFF:
-            raise ValueError(f"invalid start_address {start_address}")
-        if end_address > 0xFFFFFF:
-            raise ValueError(f"invalid end_address {end_address}")
-        if checksum > 0xFFFF:
-            raise ValueError(f"invalid checksum {checksum}")
-
-        start = struct.pack(">L", start_address)[1:]
-        end = struct.pack(">L", end_address)[1:]
-        chk = struct.pack(">H", checksum)
-        return self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM, start + end + chk)
-
-    def transfer_data(self, data: bytes) -> bytes:
+        data = _encode_flash_range(start_address, end_address) + _encode_checksum(checksum)
+        return self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM, data)
+
+    def transfer_data(self, data: Union[bytes, memoryview] = b"") -> bytes:
         return self._kwp(SERVICE_TYPE.TRANSFER_DATA, data=data)
 
     def request_transfer_exit(self) -> bytes:
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+asyncio version of the KWP2000 client, for use with AsyncTP20Transport
+"""
+import asyncio
+import time
+from typing import Optional, Union
+
+from kwp2000 import (
+    ACCESS_TYPE,
+    BUSY_DELAY,
+    BUSY_REPEAT_REQUEST,
+    BUSY_RETRIES,
+    COMPRESSION_TYPE,
+    ECU_IDENTIFICATION_TYPE,
+    ENCRYPTION_TYPE,
+    P2_STAR,
+    RESPONSE_PENDING,
+    ROUTINE_CONTROL_TYPE,
+    SERVICE_TYPE,
+    SESSION_TYPE,
+    _check_security_key,
+    _decode_block_length,
+    _decode_read_memory,
+    _encode_checksum,
+    _encode_flash_range,
+    _encode_read_memory,
+    _encode_transfer_request,
+    build_request,
+    negative_response_code,
+    parse_response,
+    record_exchange,
+)
+from metrics import Metrics
+from panda import Panda  # type: ignore
+from tp20_async import AsyncCanReader, AsyncTP20Transport
+
+
+class AsyncKWP2000Client:
+    def __init__(
+        self, transport: AsyncTP20Transport, debug: bool = False, metrics: Optional[Metrics] = None, p2_star: float = P2_STAR, busy_retries: int = BUSY_RETRIES
+    ):
+        """See KWP2000Client, requests are recorded in the metrics of the transport by default"""
+        self.transport = transport
+        self.debug = debug
+        self.metrics = metrics if metrics is not None else transport.metrics
+        self.p2_star = p2_star
+        self.busy_retries = busy_retries
+
+    async def _kwp(self, service_type: SERVICE_TYPE, subfunction: int = None, data: Union[bytes, memoryview] = None) -> bytes:
+        req = build_request(service_type, subfunction, data)
+
+        start = time.monotonic()
+        delay = BUSY_DELAY
+        for retry in range(self.busy_retries + 1):
+            if retry:
+                if self.debug:
+                    print(f"ECU busy, repeating request in {delay * 1000:.0f} ms")
+                if self.metrics is not None:
+                    self.metrics.inc("kwp_busy_retries")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+            resp = await self._exchange(service_type, req)
+            if negative_response_code(service_type, resp) != BUSY_REPEAT_REQUEST:
+                break
+
+        if self.metrics is not None:
+            record_exchange(self.metrics, service_type, resp, time.monotonic() - start)
+
+        return parse_response(service_type, subfunction, resp)
+
+    async def _exchange(self, service_type: SERVICE_TYPE, req: bytes) -> bytes:
+        if self.debug:
+            print(f"KWP TX: {req.hex()}")
+
+        await self.transport.send(req)
+        resp = await self.transport.recv()
+        while negative_response_code(service_type, resp) == RESPONSE_PENDING:
+            if self.debug:
+                print(f"KWP RX: {resp.hex()}, response pending")
+            if self.metrics is not None:
+                self.metrics.inc("kwp_response_pending")
+            resp = await self.transport.recv(timeout=self.p2_star)
+
+        if self.debug:
+            print(f"KWP RX: {resp.hex()}")
+        return resp
+
+    async def diagnostic_session_control(self, session_type: SESSION_TYPE):
+        await self._kwp(SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, subfunction=session_type)
+
+    async def security_access(self, access_type: ACCESS_TYPE, security_key: bytes = b""):
+        _check_security_key(access_type, security_key)
+        return await self._kwp(SERVICE_TYPE.SECURITY_ACCESS, subfunction=access_type, data=security_key)
+
+    async def read_ecu_identifcation(self, data_identifier_type: ECU_IDENTIFICATION_TYPE):
+        return await self._kwp(SERVICE_TYPE.READ_ECU_IDENTIFICATION, data_identifier_type)
+
+    async def request_download(
+        self,
+        memory_address: int,
+        uncompressed_size: int,
+        compression_type: COMPRESSION_TYPE = COMPRESSION_TYPE.UNCOMPRESSED,
+        encryption_type: ENCRYPTION_TYPE = ENCRYPTION_TYPE.UNENCRYPTED,
+    ) -> int:
+        data = _encode_transfer_request(memory_address, uncompressed_size, compression_type, encryption_type)
+        return _decode_block_length(await self._kwp(SERVICE_TYPE.REQUEST_DOWNLOAD, subfunction=None, data=data))
+
+    async def request_upload(
+        self,
+        memory_address: int,
+        uncompressed_size: int,
+        compression_type: COMPRESSION_TYPE = COMPRESSION_TYPE.UNCOMPRESSED,
+        encryption_type: ENCRYPTION_TYPE = ENCRYPTION_TYPE.UNENCRYPTED,
+    ) -> int:
+        data = _encode_transfer_request(memory_address, uncompressed_size, compression_type, encryption_type)
+        return _decode_block_length(await self._kwp(SERVICE_TYPE.REQUEST_UPLOAD, subfunction=None, data=data))
+
+    async def read_memory_by_address(self, memory_address: int, memory_size: int) -> bytes:
+        data = _encode_read_memory(memory_address, memory_size)
+        return _decode_read_memory(await self._kwp(SERVICE_TYPE.READ_MEMORY_BY_ADDRESS, data=data), memory_size)
+
+    async def start_routine_by_local_identifier(self, routine_control: ROUTINE_CONTROL_TYPE, data: bytes) -> bytes:
+        return await self._kwp(SERVICE_TYPE.START_ROUTINE_BY_LOCAL_IDENTIFIER, routine_control, data)
+
+    async def request_routine_results_by_local_identifier(self, routine_control: ROUTINE_CONTROL_TYPE) -> bytes:
+        return await self._kwp(SERVICE_TYPE.REQUEST_ROUTINE_RESULTS_BY_LOCAL_IDENTIFIER, routine_control)
+
+    async def erase_flash(self, start_address: int, end_address: int) -> bytes:
+        data = _encode_flash_range(start_address, end_address)
+        return await self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH, data)
+
+    async def calculate_flash_checksum(self, start_address: int, end_address: int, checksum: int) -> bytes:
+        data = _encode_flash_range(start_address, end_address) + _encode_checksum(checksum)
+        return await self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM, data)
+
+    async def transfer_data(self, data: Union[bytes, memoryview] = b"") -> bytes:
+        return await self._kwp(SERVICE_TYPE.TRANSFER_DATA, data=data)
+
+    async def request_transfer_exit(self) -> bytes:
+        return await self._kwp(SERVICE_TYPE.REQUEST_TRANSFER_EXIT)
+
+    async def stop_communication(self) -> bytes:
+        return await self._kwp(SERVICE_TYPE.STOP_COMMUNICATION)
+
+
+async def main():
+    p = Panda()
+    p.can_clear(0xFFFF)
+    p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
+
+    async with AsyncCanReader(p) as reader:
+        tp20 = await AsyncTP20Transport.connect(reader, 0x9)
+        kwp_client = AsyncKWP2000Client(tp20, debug=True)
+        keep_alive = asyncio.create_task(tp20.keep_alive_task())
+
+        await kwp_client.diagnostic_session_control(SESSION_TYPE.DIAGNOSTIC)
+
+        ident = await kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        print(f"Part Number {ident[:10]}")
+
+        status = await kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH)
+        print("Flash status", status)
+
+        keep_alive.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
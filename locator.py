@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Locate the patches of a known version in an image of an unknown version. The
+bytes around every patch in a reference image of the known version are used
+as signatures, and all of them are searched in a single pass over the new
+image using an Aho-Corasick automaton. Prints a patch and checksum table for
+the new version that can be reviewed and added to patcher.py.
+
+./locator.py --reference firmware/2501.bin --version 2501 --input firmware/unknown.bin
+"""
+from argparse import ArgumentParser
+from collections import Counter, deque
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from patcher import Checksum, Image, Patch, checksums, crc16, patches
+
+CONTEXT_SIZE = 16
+
+
+class AhoCorasick:
+    def __init__(self, patterns: List[bytes]):
+        """Automaton matching all patterns in a single pass over the data"""
+        self.patterns = patterns
+        self.goto: List[Dict[int, int]] = [{}]
+        self.fail = [0]
+        self.out: List[List[int]] = [[]]
+
+        for i, pattern in enumerate(patterns):
+            state = 0
+            for b in pattern:
+                nxt = self.goto[state].get(b)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][b] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = nxt
+            self.out[state].append(i)
+
+        # Breadth first, so the failure state of a node is always done before the node
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for b, nxt in self.goto[state].items():
+                queue.append(nxt)
+
+                fail = self.fail[state]
+                while fail and b not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(b, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, data: Image) -> Iterator[Tuple[int, int]]:
+        """Yields (offset, pattern index) for every occurrence of every pattern"""
+        goto, fail, out, patterns = self.goto, self.fail, self.out, self.patterns
+        state = 0
+        for pos, b in enumerate(memoryview(data)):
+            while state and b not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(b, 0)
+
+            for i in out[state]:
+                yield pos + 1 - len(patterns[i]), i
+
+
+class Signature:
+    def __init__(self, patch: Patch, left: bytes, right: bytes):
+        """Bytes before (left) and after (right) a patch in the reference image"""
+        self.patch = patch
+        self.left = left
+        self.right = right
+
+    @property
+    def sides(self) -> int:
+        return bool(self.left) + bool(self.right)
+
+
+def build_signatures(reference: Image, version: str, context_size: int = CONTEXT_SIZE) -> List[Signature]:
+    signatures = []
+    for addr, orig, new in patches[version]:
+        end = addr + len(orig)
+        left = bytes(reference[max(addr - context_size, 0) : addr])
+        right = bytes(reference[end : end + context_size])
+        signatures.append(Signature((addr, orig, new), left, right))
+    return signatures
+
+
+def propose_patch(image: Image, patch: Patch, addr: int, software_number: bool) -> Patch:
+    """Patch for the bytes found at addr. When the software number differs the same
+    change is applied to it, other patches keep their new value"""
+    _, orig, new = patch
+    found = bytes(image[addr : addr + len(orig)])
+    if found == orig or new is None or not software_number:
+        return (addr, found, new)
+
+    return (addr, found, bytes((f + n - o) & 0xFF for f, o, n in zip(found, orig, new)))
+
+
+def propose_checksums(image: Image, config: List[Checksum], shift: int) -> List[Tuple[Checksum, bool]]:
+    """Checksum entries for the new image, each with whether it verifies. Entries
+    that do not verify at their old address are tried shifted like the patches"""
+    view = memoryview(image)
+    proposed = []
+    for entry in config:
+        for expected, start, end in (entry, tuple(x + shift for x in entry)):
+            if 0 <= start and end <= len(image) and expected + 2 <= len(image) and view[expected : expected + 2] == crc16(view[start:end]):
+                proposed.append(((expected, start, end), True))
+                break
+        else:
+            proposed.append((entry, False))
+    return proposed
+
+
+class PatchLocator:
+    def __init__(self, reference: Image, version: str, context_size: int = CONTEXT_SIZE):
+        """Locates the patches of version in other images, using the reference
+        image of that version. The automaton is built once and reused for every image"""
+        self.version = version
+        self.signatures = build_signatures(reference, version, context_size)
+
+        patterns = []
+        self.owners: List[Tuple[int, str]] = []
+        for i, sig in enumerate(self.signatures):
+            if sig.left:
+                patterns.append(sig.left)
+                self.owners.append((i, "left"))
+            if sig.right:
+                patterns.append(sig.right)
+                self.owners.append((i, "right"))
+        self.automaton = AhoCorasick(patterns)
+
+    def locate(self, image: Image) -> List[List[Tuple[int, float]]]:
+        """Returns the candidate addresses of every patch with their confidence,
+        best first. A candidate gets half the confidence if only one side of the
+        context matches, and half again if the bytes at the address are not the
+        original bytes of the patch. Confidence is shared between equally good candidates"""
+        hits: List[Dict[int, set]] = [{} for _ in self.signatures]
+        for offset, p in self.automaton.search(image):
+            i, side = self.owners[p]
+            sig = self.signatures[i]
+            addr = offset + len(sig.left) if side == "left" else offset - len(sig.patch[1])
+            if 0 <= addr <= len(image) - len(sig.patch[1]):
+                hits[i].setdefault(addr, set()).add(side)
+
+        view = memoryview(image)
+        located = []
+        for sig, candidates in zip(self.signatures, hits):
+            orig = sig.patch[1]
+            scored = []
+            for addr, sides in candidates.items():
+                score = len(sides) / sig.sides
+                if view[addr : addr + len(orig)] != orig:
+                    score /= 2
+                scored.append((addr, score))
+
+            scored.sort(key=lambda c: (-c[1], c[0]))
+            if scored:
+                ties = sum(score == scored[0][1] for _, score in scored)
+                scored = [(addr, score / ties) for addr, score in scored]
+            located.append(scored)
+
+        return located
+
+    def propose(self, image: Image) -> Tuple[List[Tuple[Optional[Patch], float]], List[Tuple[Checksum, bool]]]:
+        """Returns the proposed patches with their confidence (None if not found) and
+        the proposed checksums with whether they verify"""
+        proposed: List[Tuple[Optional[Patch], float]] = []
+        shifts: Counter = Counter()
+        for i, (sig, candidates) in enumerate(zip(self.signatures, self.locate(image))):
+            if not candidates:
+                proposed.append((None, 0.0))
+                continue
+
+            addr, confidence = candidates[0]
+            proposed.append((propose_patch(image, sig.patch, addr, i == 0), confidence))
+            shifts[addr - sig.patch[0]] += 1
+
+        shift = shifts.most_common(1)[0][0] if shifts else 0
+        return proposed, propose_checksums(image, checksums[self.version], shift)
+
+
+def format_table(name: str, proposed_patches: List[Tuple[Optional[Patch], float]], proposed_checksums: List[Tuple[Checksum, bool]]) -> str:
+    lines = [f'"{name}": [']
+    for patch, confidence in proposed_patches:
+        if patch is None:
+            lines.append("    # not found")
+            continue
+        addr, orig, new = patch
+        lines.append(f"    (0x{addr:08X}, {orig!r}, {new!r}),  # confidence {confidence:.2f}")
+    lines.append("],")
+
+    lines.append(f'"{name}": [')
+    for (expected, start, end), valid in proposed_checksums:
+        prefix = "" if valid else "# does not verify: "
+        lines.append(f"    {prefix}(0x{expected:06x}, 0x{start:05x}, 0x{end:05x}),")
+    lines.append("],")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--reference", required=True, help="unpatched image of a known version")
+    parser.add_argument("--version", required=True, choices=list(patches), help="version of the reference image")
+    parser.add_argument("--input", required=True, action="append", help="image of an unknown version, can be repeated")
+    parser.add_argument("--context", default=CONTEXT_SIZE, type=int, help="bytes of context on either side of a patch")
+    args = parser.parse_args()
+
+    with open(args.reference, "rb") as f:
+        locator = PatchLocator(f.read(), args.version, args.context)
+
+    for path in args.input:
+        with open(path, "rb") as f:
+            image = f.read()
+
+        proposed_patches, proposed_checksums = locator.propose(image)
+
+        # Name the new version after its software number, if it was found
+        name = "????"
+        if proposed_patches[0][0] is not None:
+            name = proposed_patches[0][0][1].split(b"\x00")[-1].decode("latin-1")
+
+        print(f"\n{path}")
+        print(format_table(name, proposed_patches, proposed_checksums))
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Readers for ECU memory. All readers yield chunks of memory from stream(),
+the KWP2000 readers transfer as many bytes per request as the ECU allows.
+dump_memory writes a stream to a file that can be resumed after a failure.
+"""
+import hashlib
+import json
+import os
+from typing import Any, Callable, Generator, List, Optional, Tuple, Union
+
+from kwp2000 import KWP2000Client, NegativeResponseError
+from tp20 import MessageTimeoutError
+
+CCP_CHUNK_SIZE = 4
+CHECKPOINT_BLOCK_SIZE = 0x1000
+VERIFY_BLOCK_SIZE = 0x100
+
+
+class CcpReader:
+    name = "ccp"
+
+    def __init__(self, client: Any, chunk_size: int = CCP_CHUNK_SIZE):
+        """Read memory using CCP uploads. The client must already be connected"""
+        self.client = client
+        self.chunk_size = chunk_size
+        self.address: Optional[int] = None
+
+    def stream(self, address: int, size: int) -> Generator[bytes, None, None]:
+        if address != self.address:
+            self.client.set_memory_transfer_address(0, 0, address)
+
+        end = address + size
+        while address < end:
+            n = min(self.chunk_size, end - address)
+            dat = self.client.upload(n)[:n]
+            address += n
+
+            # The memory transfer address is incremented by the ECU
+            self.address = address
+            yield dat
+
+
+class KwpReadMemoryReader:
+    name = "read_memory_by_address"
+
+    def __init__(self, kwp_client: KWP2000Client, block_size: int = 0xFF):
+        """Read memory using READ_MEMORY_BY_ADDRESS requests of block_size bytes"""
+        self.kwp_client = kwp_client
+        self.block_size = block_size
+
+    def probe(self, address: int) -> bool:
+        """Find the largest block size the ECU accepts, halving it on every
+        negative response. Returns False if reading is not supported at all"""
+        while self.block_size > 0:
+            try:
+                self.kwp_client.read_memory_by_address(address, self.block_size)
+                return True
+            except NegativeResponseError:
+                self.block_size //= 2
+        return False
+
+    def stream(self, address: int, size: int) -> Generator[bytes, None, None]:
+        end = address + size
+        while address < end:
+            n = min(self.block_size, end - address)
+            yield self.kwp_client.read_memory_by_address(address, n)
+            address += n
+
+
+class KwpUploadReader:
+    name = "request_upload"
+
+    def __init__(self, kwp_client: KWP2000Client):
+        """Read memory using REQUEST_UPLOAD followed by TRANSFER_DATA requests"""
+        self.kwp_client = kwp_client
+        self.block_size = 0
+
+    def probe(self, address: int) -> bool:
+        """An upload that fails after it started is ended, so another reader can be probed next"""
+        stream = self.stream(address, 1)
+        try:
+            for _ in stream:
+                pass
+            return True
+        except (NegativeResponseError, MessageTimeoutError, ValueError):
+            return False
+        finally:
+            stream.close()
+
+    def stream(self, address: int, size: int) -> Generator[bytes, None, None]:
+        self.block_size = self.kwp_client.request_upload(address, size)
+
+        remaining = size
+        try:
+            while remaining > 0:
+                dat = self.kwp_client.transfer_data()
+                if not dat:
+                    raise ValueError("ECU returned no data")
+
+                dat = dat[:remaining]
+                remaining -= len(dat)
+                yield dat
+        except BaseException:
+            # Closed before the end or failed, the ECU stays in the upload until it is told otherwise
+            try:
+                self.kwp_client.request_transfer_exit()
+            except (NegativeResponseError, MessageTimeoutError):
+                pass
+            raise
+
+        self.kwp_client.request_transfer_exit()
+
+
+Reader = Union[CcpReader, KwpReadMemoryReader, KwpUploadReader]
+
+
+def kwp_reader(kwp_client: KWP2000Client, address: int) -> Optional[Union[KwpReadMemoryReader, KwpUploadReader]]:
+    """Returns the fastest KWP2000 reader the ECU supports, or None"""
+    upload = KwpUploadReader(kwp_client)
+    if upload.probe(address):
+        return upload
+
+    read = KwpReadMemoryReader(kwp_client)
+    if read.probe(address):
+        return read
+
+    return None
+
+
+def open_reader(p: Any, bus: int, kwp_client: KWP2000Client, address: int, mode: str = "auto") -> Optional[Reader]:
+    """Returns a KWP2000 reader if the ECU supports one, otherwise connects using
+    CCP unless mode is kwp. Returns None if no reader is available"""
+    reader: Optional[Reader] = None
+    if mode in ("auto", "kwp"):
+        print("\nProbing KWP2000 memory read support...")
+        reader = kwp_reader(kwp_client, address)
+        if reader is None:
+            print("ECU does not support reading memory using KWP2000")
+            if mode == "kwp":
+                return None
+
+    if reader is None:
+        try:
+            from panda.ccp import CcpClient, BYTE_ORDER  # type: ignore
+        except ImportError:
+            from panda.python.ccp import CcpClient, BYTE_ORDER  # type: ignore
+
+        # CCP polls the panda itself, a background reader would take its replies
+        kwp_client.transport.reader.stop()
+
+        print("\nConnecting using CCP...")
+        client = CcpClient(p, 1746, 1747, byte_order=BYTE_ORDER.LITTLE_ENDIAN, bus=bus)
+        client.connect(0x0)
+        reader = CcpReader(client)
+
+    return reader
+
+
+def verify_memory(
+    reader: Reader,
+    image: Any,
+    ranges: List[Tuple[int, int]],
+    block_size: int = VERIFY_BLOCK_SIZE,
+    progress: Optional[Callable[[int], Any]] = None,
+) -> Optional[List[Tuple[int, int, int]]]:
+    """Read back the (start, end) address ranges (inclusive) and compare them with
+    image in blocks of block_size bytes, stopping at the first block that differs.
+    Returns None if everything matches, otherwise (address, read, expected) for
+    every byte that differs in that block"""
+    view = memoryview(image)
+    for start, end in ranges:
+        address = start
+        block = bytearray()
+        stream = reader.stream(start, end - start + 1)
+        try:
+            for dat in stream:
+                block += dat
+                if progress is not None:
+                    progress(len(dat))
+
+                while len(block) >= block_size or (block and address + len(block) > end):
+                    n = min(block_size, len(block))
+                    if block[:n] != view[address : address + n]:
+                        return [(address + i, block[i], view[address + i]) for i in range(n) if block[i] != view[address + i]]
+
+                    del block[:n]
+                    address += n
+        finally:
+            # Ends an upload the mismatch interrupted
+            stream.close()
+
+    return None
+
+
+class DumpCheckpoint:
+    def __init__(self, path: str, start: int, size: int, block_size: int = CHECKPOINT_BLOCK_SIZE):
+        """Sidecar file keeping the digest of every block written to a dump"""
+        self.path = path
+        self.start = start
+        self.size = size
+        self.block_size = block_size
+        self.digests: List[str] = []
+
+    @property
+    def done(self) -> int:
+        """Number of bytes covered by the checkpoint"""
+        return min(len(self.digests) * self.block_size, self.size)
+
+    def load(self) -> bool:
+        """Load an existing checkpoint, returns False if there is none"""
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as f:
+            state = json.load(f)
+
+        if (state["start"], state["size"], state["block_size"]) != (self.start, self.size, self.block_size):
+            raise ValueError(f"Checkpoint {self.path} is for a different address range, remove it to start over")
+
+        self.digests = state["digests"]
+        return True
+
+    def save(self):
+        state = {"start": self.start, "size": self.size, "block_size": self.block_size, "digests": self.digests}
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def verify(self, f) -> int:
+        """Check the blocks in the output file against their digests. Everything
+        from the first block that does not match is discarded. Returns the number
+        of verified bytes, which is where the dump has to continue"""
+        f.seek(0)
+        for i, digest in enumerate(self.digests):
+            if hashlib.sha256(f.read(self.block_size)).hexdigest() != digest:
+                del self.digests[i:]
+                break
+
+        f.seek(self.done)
+        f.truncate()
+        return self.done
+
+    def add(self, block: bytes):
+        self.digests.append(hashlib.sha256(block).hexdigest())
+        self.save()
+
+
+def dump_memory(
+    reader: Reader,
+    path: str,
+    start: int,
+    size: int,
+    resume: bool = True,
+    block_size: int = CHECKPOINT_BLOCK_SIZE,
+    progress: Optional[Callable[[int], Any]] = None,
+) -> int:
+    """Read size bytes starting at start into path. Data is written in blocks of
+    block_size bytes, and a checkpoint is stored next to the output after every
+    block. When resume is set an interrupted dump continues at the first
+    incomplete block. Returns the number of bytes read from the ECU"""
+    checkpoint = DumpCheckpoint(path + ".checkpoint", start, size, block_size)
+    if not (resume and checkpoint.load() and os.path.exists(path)):
+        checkpoint.digests = []
+
+    with open(path, "r+b" if checkpoint.digests else "wb") as f:
+        done = checkpoint.verify(f)
+        if progress is not None:
+            progress(done)
+
+        def write_block(block: bytes):
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+            checkpoint.add(block)
+
+        block = bytearray()
+        for dat in reader.stream(start + done, size - done) if done < size else []:
+            block += dat
+            if progress is not None:
+                progress(len(dat))
+
+            while len(block) >= block_size:
+                write_block(bytes(block[:block_size]))
+                del block[:block_size]
+
+        if block:
+            write_block(bytes(block))
+
+    checkpoint.remove()
+    return size - done
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Counters and latency histograms for the protocol layers. Pass a Metrics object
+to TP20Transport and KWP2000Client to enable them, without one the only cost
+is a check for None.
+"""
+import bisect
+import json
+import threading
+from typing import Any, Dict, List, Tuple
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """(upper bound, observations <= upper bound) for every bucket, ending with +Inf"""
+        result = []
+        total = 0
+        for bound, n in zip([str(b) for b in self.buckets] + ["+Inf"], self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+
+def _key(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        """Safe to update from several threads, e.g. the keep alive thread of a
+        transport while the main thread is transferring"""
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: Any):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "counters": {_key(name, labels): value for (name, labels), value in sorted(self.counters.items())},
+                "histograms": {
+                    _key(name, labels): {"count": h.count, "sum": h.sum, "buckets": dict(h.cumulative())}
+                    for (name, labels), h in sorted(self.histograms.items())
+                },
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        typed = set()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, h.cumulative(), h.sum, h.count) for key, h in sorted(self.histograms.items())]
+
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name}_total counter")
+                typed.add(name)
+            lines.append(f"{_key(name + '_total', labels)} {value}")
+
+        for (name, labels), cumulative, total, count in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, n in cumulative:
+                lines.append(f"{_key(name + '_bucket', labels + (('le', bound),))} {n}")
+            lines.append(f"{_key(name + '_sum', labels)} {total}")
+            lines.append(f"{_key(name + '_count', labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write the metrics to path, in the Prometheus format if it ends in .prom, otherwise as JSON"""
+        with open(path, "w") as f:
+            f.write(self.to_prometheus() if path.endswith(".prom") else self.to_json())
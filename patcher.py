@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Firmware patches and checksums. All functions work in place on a single
+mutable image, CRCs are computed over memoryviews so no part of the image
+is copied.
+
+    fw = bytearray(dump)
+    patch_image(fw, "2501")
+"""
+import bisect
+import mmap
+import struct
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import crcmod
+
+Image = Union[bytes, bytearray, memoryview, mmap.mmap]
+Patch = Tuple[int, bytes, Optional[bytes]]
+Checksum = Tuple[int, int, int]
+Range = Tuple[int, int]
+
+# fmt: off
+
+# (addr, orig, new (optional) )
+patches: Dict[str, List[Patch]] = {
+    "2501": [
+        (0x0005E7A8, b"1K0909144E \x002501", b"1K0909144E \x002502"),  # Software number and version
+        (0x0005E221, b"\x64", b"\x00"),  # Disengage countdown
+        (0x0005E283, b"\x32", b"\x00"),  # Min speed
+        (0x0005FFFC, b"Ende", b"\xff\xff\xff\xff"),  # End of FW marker
+    ],
+    "3501": [
+        (0x0005D828, b"1K0909144R \x003501", b"1K0909144R \x003502"),  # Software number and version
+        (0x0005D289, b"\x64", b"\x00"),  # Disengage countdown
+        (0x0005D2FA, b"\x14", b"\x00"),  # Min speed
+        (0x0005FFFC, b"Ende", b"\xff\xff\xff\xff"),  # End of FW marker
+    ]
+}
+
+# (checksum addr, start, end)
+checksums: Dict[str, List[Checksum]] = {
+    "2501": [
+        (0x05EFFC, 0x5E000, 0x5EFFC),
+    ],
+    "3501": [
+        #ASW: A000 - 5C000
+        (0x05fef8, 0x0a000, 0x0afff),
+        (0x05fefa, 0x0afff, 0x0bffe),
+        (0x05fefc, 0x0bffe, 0x0cffd),
+        (0x05fefe, 0x0cffd, 0x0dffc),
+        (0x05ff00, 0x0dffc, 0x0effb),
+        (0x05ff02, 0x0effb, 0x0fffa),
+        (0x05ff04, 0x0fffa, 0x10ff9),
+        (0x05ff06, 0x10ff9, 0x11ff8),
+        (0x05ff08, 0x11ff8, 0x12ff7),
+        (0x05ff0a, 0x12ff7, 0x13ff6),
+        (0x05ff0c, 0x13ff6, 0x14ff5),
+        (0x05ff0e, 0x14ff5, 0x15ff4),
+        (0x05ff10, 0x15ff4, 0x16ff3),
+        (0x05ff12, 0x16ff3, 0x17ff2),
+        (0x05ff14, 0x17ff2, 0x18ff1),
+        (0x05ff16, 0x18ff1, 0x19ff0),
+        (0x05ff18, 0x19ff0, 0x1afef),
+        (0x05ff1a, 0x1afef, 0x1bfee),
+        (0x05ff1c, 0x1bfee, 0x1cfed),
+        (0x05ff1e, 0x1cfed, 0x1dfec),
+        (0x05ff20, 0x1dfec, 0x1efeb),
+        (0x05ff22, 0x1efeb, 0x1ffea),
+        (0x05ff24, 0x1ffea, 0x20fe9),
+        (0x05ff26, 0x20fe9, 0x21fe8),
+        (0x05ff28, 0x21fe8, 0x22fe7),
+        (0x05ff2a, 0x22fe7, 0x23fe6),
+        (0x05ff2c, 0x23fe6, 0x24fe5),
+        (0x05ff2e, 0x24fe5, 0x25fe4),
+        (0x05ff30, 0x25fe4, 0x26fe3),
+        (0x05ff32, 0x26fe3, 0x27fe2),
+        (0x05ff34, 0x27fe2, 0x28fe1),
+        (0x05ff36, 0x28fe1, 0x29fe0),
+        (0x05ff38, 0x29fe0, 0x2afdf),
+        (0x05ff3a, 0x2afdf, 0x2bfde),
+        (0x05ff3c, 0x2bfde, 0x2cfdd),
+        (0x05ff3e, 0x2cfdd, 0x2dfdc),
+        (0x05ff40, 0x2dfdc, 0x2efdb),
+        (0x05ff42, 0x2efdb, 0x2ffda),
+        (0x05ff44, 0x2ffda, 0x30fd9),
+        (0x05ff46, 0x30fd9, 0x31fd8),
+        (0x05ff48, 0x31fd8, 0x32fd7),
+        (0x05ff4a, 0x32fd7, 0x33fd6),
+        (0x05ff4c, 0x33fd6, 0x34fd5),
+        (0x05ff4e, 0x34fd5, 0x35fd4),
+        (0x05ff50, 0x35fd4, 0x36fd3),
+        (0x05ff52, 0x36fd3, 0x37fd2),
+        (0x05ff54, 0x37fd2, 0x38fd1),
+        (0x05ff56, 0x38fd1, 0x39fd0),
+        (0x05ff58, 0x39fd0, 0x3afcf),
+        (0x05ff5a, 0x3afcf, 0x3bfce),
+        (0x05ff5c, 0x3bfce, 0x3cfcd),
+        (0x05ff5e, 0x3cfcd, 0x3dfcc),
+        (0x05ff60, 0x3dfcc, 0x3efcb),
+        (0x05ff62, 0x3efcb, 0x3ffca),
+        (0x05ff64, 0x3ffca, 0x40fc9),
+        (0x05ff66, 0x40fc9, 0x41fc8),
+        (0x05ff68, 0x41fc8, 0x42fc7),
+        (0x05ff6a, 0x42fc7, 0x43fc6),
+        (0x05ff6c, 0x43fc6, 0x44fc5),
+        (0x05ff6e, 0x44fc5, 0x45fc4),
+        (0x05ff70, 0x45fc4, 0x46fc3),
+        (0x05ff72, 0x46fc3, 0x47fc2),
+        (0x05ff74, 0x47fc2, 0x48fc1),
+        (0x05ff76, 0x48fc1, 0x49fc0),
+        (0x05ff78, 0x49fc0, 0x4afbf),
+        (0x05ff7a, 0x4afbf, 0x4bfbe),
+        (0x05ff7c, 0x4bfbe, 0x4cfbd),
+        (0x05ff7e, 0x4cfbd, 0x4dfbc),
+        (0x05ff80, 0x4dfbc, 0x4efbb),
+        (0x05ff82, 0x4efbb, 0x4ffba),
+        (0x05ff84, 0x4ffba, 0x50fb9),
+        (0x05ff86, 0x50fb9, 0x51fb8),
+        (0x05ff88, 0x51fb8, 0x52fb7),
+        (0x05ff8a, 0x52fb7, 0x53fb6),
+        (0x05ff8c, 0x53fb6, 0x54fb5),
+        (0x05ff8e, 0x54fb5, 0x55fb4),
+        (0x05ff90, 0x55fb4, 0x56fb3),
+        (0x05ff92, 0x56fb3, 0x57fb2),
+        (0x05ff94, 0x57fb2, 0x58fb1),
+        (0x05ff96, 0x58fb1, 0x59fb0),
+        (0x05ff98, 0x59fb0, 0x5afaf),
+        (0x05ff9a, 0x5afaf, 0x5bfae),
+        (0x05ff9c, 0x5bfae, 0x5c000),
+        #Calibration: 5C000 - 5EFFE
+        (0x05DFFC, 0x5C000, 0x5CFFF),
+        (0x05DFFE, 0x5CFFF, 0x5DFFC),
+        (0x05EFFE, 0x5E000, 0x5EFFE),
+    ]
+}
+# fmt: on
+
+_crc16_xmodem = crcmod.mkCrcFun(0x11021, rev=False, initCrc=0x0000, xorOut=0x0000)
+
+
+def crc16(dat: Image) -> bytes:
+    """CRC16 XMODEM of dat as stored in the firmware (big endian)"""
+    return struct.pack(">H", _crc16_xmodem(dat))
+
+
+def crc16_update(dat: Image, crc: int = 0) -> int:
+    """CRC16 XMODEM continuing from crc, for data that is processed in parts"""
+    return _crc16_xmodem(dat, crc)
+
+
+def compute_checksums(fw: Image, config: List[Checksum]) -> List[bytes]:
+    """Returns the checksum of every block in config"""
+    view = memoryview(fw)
+    return [crc16(view[start:end]) for _, start, end in config]
+
+
+def verify_checksums(fw: Image, config: List[Checksum]) -> bool:
+    view = memoryview(fw)
+    for expected, start, end in config:
+        if view[expected : expected + 2] != crc16(view[start:end]):
+            return False
+
+    return True
+
+
+def update_checksums(fw: bytearray, config: List[Checksum]):
+    """Store the checksum of every block in config. All checksums are computed
+    before any is written, so a checksum never covers another updated checksum"""
+    for (expected, _, _), crc in zip(config, compute_checksums(fw, config)):
+        fw[expected : expected + 2] = crc
+
+
+class ChecksumIndex:
+    def __init__(self, config: List[Checksum]):
+        """Interval index over the blocks of a checksum table, mapping a modified
+        address range to the checksums that have to be recomputed"""
+        self.config = config
+        self.order = sorted(range(len(config)), key=lambda i: config[i][1])
+        self.starts = [config[i][1] for i in self.order]
+
+        # Largest block end among the first n blocks sorted by start, lets a
+        # lookup stop as soon as no earlier block can reach the range
+        self.max_ends = []
+        max_end = 0
+        for i in self.order:
+            max_end = max(max_end, config[i][2])
+            self.max_ends.append(max_end)
+
+    def blocks(self, start: int, end: int) -> List[int]:
+        """Indices into config of the blocks overlapping [start, end)"""
+        found = []
+        n = bisect.bisect_left(self.starts, end)
+        while n > 0 and self.max_ends[n - 1] > start:
+            n -= 1
+            i = self.order[n]
+            if self.config[i][2] > start:
+                found.append(i)
+        return sorted(found)
+
+    def affected(self, ranges: Iterable[Range]) -> List[int]:
+        """Indices of the blocks overlapping any of the [start, end) ranges, followed
+        by the blocks covering their checksums, in the order they have to be updated"""
+        found: List[int] = []
+        seen = set()
+        pending = list(ranges)
+        while pending:
+            level = []
+            for start, end in pending:
+                for i in self.blocks(start, end):
+                    if i not in seen:
+                        seen.add(i)
+                        level.append(i)
+
+            level.sort()
+            found += level
+            pending = [(self.config[i][0], self.config[i][0] + 2) for i in level]
+        return found
+
+    def dirty(self, fw: Image, ranges: Optional[Iterable[Range]] = None) -> List[Checksum]:
+        """Returns the blocks with a wrong checksum, optionally only those affected by ranges"""
+        view = memoryview(fw)
+        indices = range(len(self.config)) if ranges is None else self.affected(ranges)
+        dirty = []
+        for i in indices:
+            expected, start, end = self.config[i]
+            if view[expected : expected + 2] != crc16(view[start:end]):
+                dirty.append(self.config[i])
+        return dirty
+
+    def update(self, fw: bytearray, ranges: Iterable[Range]) -> List[Checksum]:
+        """Recompute only the checksums affected by changes to ranges, returns the
+        updated blocks. A checksum stored inside another block is written before
+        that block is recomputed. Without such chains this gives the same result
+        as update_checksums"""
+        view = memoryview(fw)
+        updated = []
+        for i in self.affected(ranges):
+            expected, start, end = self.config[i]
+            fw[expected : expected + 2] = crc16(view[start:end])
+            updated.append(self.config[i])
+        view.release()
+        return updated
+
+
+def detect_version(fw: Image) -> Optional[Tuple[str, bool]]:
+    """Find the version of an image by its software number, which is the first
+    patch of every version. Returns the version and whether it is already patched"""
+    view = memoryview(fw)
+    for version, version_patches in patches.items():
+        addr, orig, new = version_patches[0]
+        cur = view[addr : addr + len(orig)]
+        if cur == orig:
+            return version, False
+        if cur == new:
+            return version, True
+    return None
+
+
+@lru_cache(maxsize=None)
+def checksum_index(version: str) -> ChecksumIndex:
+    return ChecksumIndex(checksums[version])
+
+
+def apply_patches(fw: bytearray, version: str) -> List[Range]:
+    """Replace the original values of every patch for version, without updating
+    checksums. Returns the [start, end) ranges that were changed"""
+    changed = []
+    for addr, orig, new in patches[version]:
+        length = len(orig)
+        cur = fw[addr : addr + length]
+
+        assert cur == orig, f"Unexpected values in input FW {cur.hex()} expected {orig.hex()}"
+
+        if new is not None:
+            assert len(new) == length
+            fw[addr : addr + length] = new
+            changed.append((addr, addr + length))
+    return changed
+
+
+def patch_image(fw: bytearray, version: str, verify: bool = True):
+    """Patch an unmodified image for version in place and update the checksums of
+    the patched blocks. verify checks all checksums of the input first"""
+    index = checksum_index(version)
+    length = len(fw)
+
+    if verify:
+        assert verify_checksums(fw, index.config)
+    changed = apply_patches(fw, version)
+    index.update(fw, changed)
+
+    assert not index.dirty(fw, changed)
+    assert len(fw) == length
+
+
+def patch(fw_in: Image, version: str, verify: bool = True) -> bytes:
+    """Returns a patched copy of fw_in"""
+    fw = bytearray(fw_in)
+    patch_image(fw, version, verify)
+    return bytes(fw)
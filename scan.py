@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Find the TP 2.0 modules on a bus. Channel setup requests for a range of logical
+addresses are sent on 0x200 in paced bursts, and the replies on 0x200 + module
+are collected while the next burst goes out, so a module that does not exist
+costs one frame instead of a timeout. Every channel that was opened is closed
+again. With --ident the identification of every module found is read.
+
+./scan.py --bus 0 --start 0x00 --end 0xff --ident
+"""
+import struct
+import time
+from argparse import ArgumentParser
+from typing import Any, Dict, Iterable, Optional
+
+from panda import Panda  # type: ignore
+from kwp2000 import ECU_IDENTIFICATION_TYPE, KWP2000Client
+from tp20 import BROADCAST_ADDR, CanReader, MessageTimeoutError, TP20Transport
+
+# Channel setup requests sent in one USB transfer, and the time to collect replies before the next burst
+SCAN_BURST = 16
+SCAN_BURST_INTERVAL = 0.01
+
+
+def scan_modules(
+    panda: Panda,
+    modules: Iterable[int] = range(0x100),
+    bus: int = 0,
+    rx_addr: int = 0x300,
+    timeout: float = 0.1,
+    burst: int = SCAN_BURST,
+    burst_interval: float = SCAN_BURST_INTERVAL,
+    reader: Optional[CanReader] = None,
+    debug: bool = False,
+) -> Dict[int, Dict[str, Any]]:
+    """Send a channel setup request to every module, asking it to transmit on rx_addr.
+    Replies are collected until timeout seconds after the last burst. Returns
+    {module: {"tx_addr", "rx_addr"}} for every module that accepted the channel,
+    modules refusing it get their "status" instead. Each channel is closed with a
+    disconnect as soon as its reply arrives. Pass the reader shared with other
+    transports on the panda, rx_addr must not be used by one of them"""
+    if reader is None:
+        reader = CanReader(panda)
+
+    modules = list(modules)
+    pending = set(modules)
+    found: Dict[int, Dict[str, Any]] = {}
+    closed = 0
+
+    reader.attach(bus, rx_addr, scan_modules)
+    try:
+        for module in modules:
+            reader.clear(bus, BROADCAST_ADDR + module)
+        reader.clear(bus, rx_addr)
+
+        def collect(until: float):
+            nonlocal closed
+            while pending:
+                if reader.thread is None:
+                    reader.poll()
+
+                for module in list(pending):
+                    msg = reader.pop(bus, BROADCAST_ADDR + module)
+                    if msg is None:
+                        continue
+
+                    dat = msg[1]
+                    if len(dat) != 7:
+                        if debug:
+                            print(f"Unexpected reply from {hex(module)}: {dat.hex()}")
+                        continue
+
+                    pending.discard(module)
+                    status, rx, tx, _ = struct.unpack("<xBHHB", dat)
+                    if debug:
+                        print(f"Module {hex(module)} replied {dat.hex()}")
+                    if status != 0xD0:
+                        found[module] = {"status": status}
+                        continue
+
+                    found[module] = {"tx_addr": tx, "rx_addr": rx}
+                    reader.can_send(tx, b"\xa8", bus, int(timeout * 1000))
+                    closed += 1
+
+                if time.monotonic() >= until:
+                    return
+                time.sleep(reader.poll_interval)
+
+        for i in range(0, len(modules), burst):
+            setups = [bytes([module, 0xC0, 0x00, 0x10]) + struct.pack("<H", rx_addr) + b"\x01" for module in modules[i : i + burst]]
+            reader.can_send_many([(BROADCAST_ADDR, None, dat, bus) for dat in setups], int(timeout * 1000))
+            collect(time.monotonic() + burst_interval)
+        collect(time.monotonic() + timeout)
+
+        # Wait for the disconnect replies, so they do not end up on the next channel using rx_addr
+        deadline = time.monotonic() + timeout
+        while closed:
+            try:
+                if reader.get(bus, rx_addr, deadline - time.monotonic())[1] == b"\xa8":
+                    closed -= 1
+            except MessageTimeoutError:
+                break
+    finally:
+        reader.clear(bus, rx_addr)
+        reader.detach(bus, rx_addr, scan_modules)
+
+    return dict(sorted(found.items()))
+
+
+def read_identifications(panda: Panda, found: Dict[int, Dict[str, Any]], bus: int = 0, reader: Optional[CanReader] = None):
+    """Read the ECU identification of every module that accepted a channel into found[module]["ident"].
+    Modules that fail get None and the reason in found[module]["error"], the others are still read"""
+    if reader is None:
+        reader = CanReader(panda)
+
+    for module, info in found.items():
+        if "tx_addr" not in info:
+            continue
+
+        info["ident"] = None
+        try:
+            transport = TP20Transport(panda, module, bus=bus, reader=reader)
+        except Exception as e:
+            info["error"] = f"channel setup failed: {e!r}"
+            continue
+
+        try:
+            info["ident"] = KWP2000Client(transport).read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        except Exception as e:
+            info["error"] = repr(e)
+        finally:
+            transport.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--bus", default=0, type=int, help="CAN bus number to use")
+    parser.add_argument("--start", default=0x00, type=lambda x: int(x, 0), help="first logical address to try")
+    parser.add_argument("--end", default=0xFF, type=lambda x: int(x, 0), help="last logical address to try (inclusive)")
+    parser.add_argument("--burst", default=SCAN_BURST, type=int, help="channel setup requests sent at once")
+    parser.add_argument("--timeout", default=0.1, type=float, help="time to wait for replies after the last burst")
+    parser.add_argument("--ident", action="store_true", help="read the identification of every module found")
+    parser.add_argument("--debug", action="store_true", help="print every reply")
+    args = parser.parse_args()
+
+    p = Panda()
+    p.can_clear(0xFFFF)
+    p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
+
+    reader = CanReader(p)
+    start = time.monotonic()
+    found = scan_modules(p, range(args.start, args.end + 1), args.bus, timeout=args.timeout, burst=args.burst, reader=reader, debug=args.debug)
+    print(f"Scanned {args.end - args.start + 1} addresses in {time.monotonic() - start:.2f} s, {len(found)} modules replied")
+
+    if args.ident:
+        read_identifications(p, found, args.bus, reader)
+
+    for module, info in found.items():
+        if "tx_addr" not in info:
+            print(f"{module:02X}  refused channel, status {info['status']:02X}")
+            continue
+
+        line = f"{module:02X}  TX {info['tx_addr']:03X}  RX {info['rx_addr']:03X}"
+        if info.get("ident") is not None:
+            line += "  " + info["ident"].decode("latin-1").strip("\x00 ")
+        elif "error" in info:
+            line += f"  no identification, {info['error']}"
+        print(line)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import asyncio
+import unittest
+
+from kwp2000 import ECU_IDENTIFICATION_TYPE, SESSION_TYPE, NegativeResponseError
+from kwp2000_async import AsyncKWP2000Client
+from metrics import Metrics
+from panda_sim import SimEcu, SimPanda
+from tp20_async import AsyncCanReader, AsyncTP20Transport
+
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.image = bytes(range(256)) * 0x600
+        self.ecus = [
+            SimEcu(self.image, module=0x01, tx_addr=0x740, latency=0.0, t3=0x01, ident=b"06A906032HN"),
+            SimEcu(self.image, module=0x09, tx_addr=0x741, latency=0.0, t3=0x01),
+        ]
+        self.panda = SimPanda()
+        for ecu in self.ecus:
+            self.panda.attach(ecu)
+
+    async def test_read_ecu_identification(self):
+        async with AsyncCanReader(self.panda) as reader:
+            kwp_client = AsyncKWP2000Client(await AsyncTP20Transport.connect(reader, 0x9))
+            ident = await kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+            self.assertEqual(ident, self.ecus[1].ident)
+
+    async def test_concurrent_channels(self):
+        async with AsyncCanReader(self.panda) as reader:
+            transports = await asyncio.gather(
+                AsyncTP20Transport.connect(reader, 0x1, rx_addr=0x300),
+                AsyncTP20Transport.connect(reader, 0x9, rx_addr=0x301),
+            )
+            self.assertEqual([t.tx_addr for t in transports], [0x740, 0x741])
+
+            clients = [AsyncKWP2000Client(t) for t in transports]
+            reads = await asyncio.gather(*(c.read_memory_by_address(0x5E000, 0x80) for c in clients))
+            idents = await asyncio.gather(*(c.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT) for c in clients))
+
+        self.assertEqual(reads, [self.image[0x5E000:0x5E080]] * 2)
+        self.assertEqual(idents, [ecu.ident for ecu in self.ecus])
+
+    async def test_negative_response(self):
+        self.ecus[1].unsupported.add(0x23)
+        async with AsyncCanReader(self.panda) as reader:
+            kwp_client = AsyncKWP2000Client(await AsyncTP20Transport.connect(reader, 0x9))
+            with self.assertRaises(NegativeResponseError):
+                await kwp_client.read_memory_by_address(0x5E000, 0x10)
+
+    async def test_rx_addr(self):
+        async with AsyncCanReader(self.panda) as reader:
+            transport = AsyncTP20Transport(reader, rx_addr=0x301)
+            await transport.open_channel(0x9)
+            self.assertEqual(self.ecus[1].rx_addr, 0x301)
+            self.assertEqual((await AsyncTP20Transport.connect(reader, 0x1)).rx_addr, 0x300)
+
+    async def test_metrics_and_reconnect(self):
+        self.ecus[1].reset_time = 0.2
+        metrics = Metrics()
+        async with AsyncCanReader(self.panda) as reader:
+            transport = await AsyncTP20Transport.connect(reader, 0x9, metrics=metrics)
+            kwp_client = AsyncKWP2000Client(transport)
+            await kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+
+            self.assertGreaterEqual(await transport.reconnect(), 0.2)
+            self.assertEqual(transport.reconnects, 1)
+            self.assertEqual(await kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), self.ecus[1].ident)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]['kwp_requests{service="READ_ECU_IDENTIFICATION"}'], 1)
+        self.assertGreater(snapshot["counters"]["tp20_frames_sent"], 0)
+        self.assertEqual(snapshot["histograms"]["tp20_reconnect_seconds"]["count"], 1)
+
+    async def test_stop_shuts_down_executor(self):
+        async with AsyncCanReader(self.panda) as reader:
+            await AsyncTP20Transport.connect(reader, 0x9)
+            executor = reader.executor
+
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import os
+import unittest
+
+spec = importlib.util.spec_from_file_location("benchmark", os.path.join(os.path.dirname(__file__), "..", "extras", "benchmark.py"))
+assert spec is not None
+benchmark = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(benchmark)  # type: ignore
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_runs(self):
+        # Keeps the stand-ins in line with the transport and client
+        results = benchmark.bench_tp20(1) + benchmark.bench_kwp(1) + benchmark.bench_patcher(1) + benchmark.bench_flasher(1, 0x100)
+        self.assertEqual(len(results), 15)
+        self.assertTrue(all(result["ops"] == 1 for result in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
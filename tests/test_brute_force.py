@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import os
+import tempfile
+import unittest
+
+from panda_sim import SimEcu, SimPanda
+
+spec = importlib.util.spec_from_file_location("brute_force", os.path.join(os.path.dirname(__file__), "..", "extras", "brute_force_pasword.py"))
+assert spec is not None
+brute_force = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(brute_force)  # type: ignore
+
+
+class TestPasswordSearch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "search.json")
+
+        self.ecu = SimEcu(b"", latency=0.0, t3=0x01, password=37, login_password=40168, max_attempts=3)
+        self.panda = SimPanda()
+        self.panda.attach(self.ecu)
+
+    def search(self):
+        return brute_force.PasswordSearch(self.panda, 40168, 0x86, max_attempts=3)
+
+    def test_search(self):
+        checkpoint = brute_force.SearchCheckpoint(self.path, 0, 64)
+        search = self.search()
+        found = search.run(checkpoint)
+
+        self.assertEqual(found, [{"password": 37, "valid": ["login", "0x86"]}])
+        self.assertEqual(len(search.rtts), 64)
+        self.assertLess(search.stats()["exchanges_per_candidate"], 3.5)
+        self.assertLessEqual(self.ecu.attempts, 3)
+
+    def test_resume(self):
+        checkpoint = brute_force.SearchCheckpoint(self.path, 0, 64)
+        checkpoint.next = 32
+        checkpoint.save()
+
+        checkpoint = brute_force.SearchCheckpoint(self.path, 0, 64)
+        self.assertTrue(checkpoint.load())
+        search = self.search()
+        search.run(checkpoint)
+        self.assertEqual(len(search.rtts), 32)
+        self.assertEqual(checkpoint.found[0]["password"], 37)
+
+        checkpoint = brute_force.SearchCheckpoint(self.path, 0, 64)
+        checkpoint.load()
+        self.assertEqual(checkpoint.next, 64)
+
+    def test_reconnect(self):
+        def progress(n: int):
+            # ECU drops the channel after a few candidates
+            if checkpoint.next == 34:
+                self.ecu.rx_addr = None
+
+        checkpoint = brute_force.SearchCheckpoint(self.path, 30, 40)
+        found = self.search().run(checkpoint, progress)
+
+        self.assertEqual(found, [{"password": 37, "valid": ["login", "0x86"]}])
+        self.assertEqual(checkpoint.reconnects, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
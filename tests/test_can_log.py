@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from can_log import RX, TX, CanLog, RecordingPanda, ReplayMismatchError, ReplayPanda
+from kwp2000 import ECU_IDENTIFICATION_TYPE, KWP2000Client
+from panda_sim import SimEcu, SimPanda
+from tp20 import TP20Transport
+
+
+class TestCanLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "session.canlog")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        log = CanLog.create(self.path)
+        log.append(TX, 0, 0x200, b"\x09\xc0\x00\x10\x00\x03\x01", t=0.5)
+        log.append(RX, 1, 0x209, b"", t=0.75)
+        log.flush()
+
+        # A partial record left by a killed recording is ignored
+        with open(self.path, "ab") as f:
+            f.write(b"\x00" * 5)
+
+        loaded = CanLog.load(self.path)
+        self.assertEqual(list(loaded.frames()), [(0.5, TX, 0, 0x200, b"\x09\xc0\x00\x10\x00\x03\x01"), (0.75, RX, 1, 0x209, b"")])
+        self.assertEqual(list(loaded.frames(start=0.6)), [(0.75, RX, 1, 0x209, b"")])
+
+    def record_session(self) -> bytes:
+        ecu = SimEcu(bytes(0x60000), latency=0.0, t3=0x01)
+        sim = SimPanda()
+        sim.attach(ecu)
+
+        panda = RecordingPanda(sim, CanLog.create(self.path))
+        kwp_client = KWP2000Client(TP20Transport(panda, 0x9))
+        ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        panda.close()
+        return ident
+
+    def test_replay(self):
+        ident = self.record_session()
+
+        replay = ReplayPanda(CanLog.load(self.path))
+        kwp_client = KWP2000Client(TP20Transport(replay, 0x9))
+        self.assertEqual(kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), ident)
+        self.assertTrue(replay.done)
+
+    def test_replay_mismatch(self):
+        self.record_session()
+
+        replay = ReplayPanda(CanLog.load(self.path))
+        with self.assertRaises(ReplayMismatchError):
+            TP20Transport(replay, 0x1)
+
+        replay = ReplayPanda(CanLog.load(self.path), strict=False)
+        replay.can_send(0x200, b"\x01\xc0\x00\x10\x00\x03\x01", 0)
+        self.assertEqual(replay.mismatches, [(0, 0, 0x200, b"\x01\xc0\x00\x10\x00\x03\x01")])
+        self.assertEqual(replay.can_recv()[0][0], 0x209)
+
+
+if __name__ == "__main__":
+    unittest.main()
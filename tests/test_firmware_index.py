@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+import patcher
+from firmware_index import FirmwareIndex
+
+
+class TestFirmwareIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = self.tmp.name
+
+        fw = bytearray(range(256)) * (0x60000 // 256)
+        for addr, orig, _ in patcher.patches["3501"]:
+            fw[addr : addr + len(orig)] = orig
+        patcher.update_checksums(fw, patcher.checksums["3501"])
+        self.orig = bytes(fw)
+
+        self.write("orig.bin", self.orig)
+        self.write("dumps/patched.bin", patcher.patch(self.orig, "3501"))
+        self.write("dumps/broken.bin", self.orig[:0x10000] + b"\xff" + self.orig[0x10001:])
+        self.write("unknown.bin", bytes(0x60000))
+        self.write("notes.txt", b"not a firmware")
+
+    def write(self, name: str, dat: bytes):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(dat)
+
+    def test_refresh(self):
+        index = FirmwareIndex(self.root)
+        self.assertEqual(len(index.refresh()), 4)
+
+        entry = index.files["orig.bin"]
+        self.assertEqual(entry["version"], "3501")
+        self.assertEqual(entry["part_number"], "1K0909144R")
+        self.assertEqual(entry["software_version"], "3501")
+        self.assertFalse(entry["patched"])
+        self.assertTrue(entry["checksums_valid"])
+        self.assertEqual(entry["sha256"], hashlib.sha256(self.orig).hexdigest())
+
+        patched = index.files[os.path.join("dumps", "patched.bin")]
+        self.assertEqual(patched["software_version"], "3502")
+        self.assertNotEqual(patched["regions"]["calibration"], entry["regions"]["calibration"])
+        self.assertEqual(patched["regions"]["asw"], entry["regions"]["asw"])
+
+        self.assertIsNone(index.files["unknown.bin"]["version"])
+
+    def test_query(self):
+        index = FirmwareIndex(self.root)
+        index.refresh()
+
+        self.assertEqual(index.query(version="3501", valid=True), [os.path.join("dumps", "patched.bin"), "orig.bin"])
+        self.assertEqual(index.query(valid=False), [os.path.join("dumps", "broken.bin")])
+        self.assertEqual(index.query(version="3501", patched=False, valid=True), ["orig.bin"])
+        self.assertEqual(index.find(hashlib.sha256(self.orig).hexdigest()), ["orig.bin"])
+
+    def test_incremental(self):
+        index = FirmwareIndex(self.root)
+        index.refresh()
+        index.save()
+
+        index = FirmwareIndex(self.root)
+        self.assertTrue(index.load())
+        self.assertEqual(index.refresh(), [])
+
+        self.write("orig.bin", bytes(0x60000))
+        os.remove(os.path.join(self.root, "unknown.bin"))
+        self.assertEqual(index.refresh(), ["orig.bin"])
+        self.assertNotIn("unknown.bin", index.files)
+        self.assertIsNone(index.files["orig.bin"]["version"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import importlib
+import unittest
+
+import patcher
+
+flasher = importlib.import_module("03_flasher")
+
+
+class TestTransfer(unittest.TestCase):
+    def test_iter_chunks(self):
+        data = bytearray(range(256)) * 4
+        checksum = flasher.FlashChecksum()
+        chunks = list(flasher.iter_chunks(data, 0xFE, checksum))
+
+        self.assertEqual([len(c) for c in chunks], [0xFE] * 4 + [8])
+        self.assertTrue(all(c.obj is data for c in chunks))
+        self.assertEqual(b"".join(chunks), data)
+        self.assertEqual(checksum.sum, sum(data) & 0xFFFF)
+        self.assertEqual(checksum.crc.to_bytes(2, "big"), patcher.crc16(data))
+
+
+class TestPlanSectors(unittest.TestCase):
+    def setUp(self):
+        self.reference = bytes(0x6000)
+
+    def patch(self, *addresses: int) -> bytes:
+        image = bytearray(self.reference)
+        for addr in addresses:
+            image[addr] = 0xFF
+        return bytes(image)
+
+    def test_unchanged(self):
+        self.assertEqual(flasher.plan_sectors(self.reference, self.reference, 0, 0x5FFF, 0x1000), [])
+
+    def test_changed_sectors(self):
+        image = self.patch(0x1000, 0x4FFF)
+        self.assertEqual(flasher.plan_sectors(self.reference, image, 0, 0x5FFF, 0x1000), [(0x1000, 0x1FFF), (0x4000, 0x4FFF)])
+
+    def test_adjacent_sectors_merged(self):
+        image = self.patch(0x1FFF, 0x2000, 0x3800)
+        self.assertEqual(flasher.plan_sectors(self.reference, image, 0, 0x5FFF, 0x1000), [(0x1000, 0x3FFF)])
+
+    def test_outside_range(self):
+        image = self.patch(0x0, 0x5000)
+        self.assertEqual(flasher.plan_sectors(self.reference, image, 0x1000, 0x4FFF, 0x1000), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
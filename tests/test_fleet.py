@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+
+import fleet
+import patcher
+from panda_sim import SimEcu, SimPanda
+
+
+class TestAssignUnits(unittest.TestCase):
+    def test_defaults(self):
+        units = fleet.assign_units(["a", "b"], [], 0, "patched.bin")
+        self.assertEqual(units, [{"serial": "a", "bus": 0, "image": "patched.bin"}, {"serial": "b", "bus": 0, "image": "patched.bin"}])
+
+    def test_assignment(self):
+        units = fleet.assign_units(["a", "b"], ["b:1:other.bin", "a:2"], 0, "patched.bin")
+        self.assertEqual(units, [{"serial": "a", "bus": 2, "image": "patched.bin"}, {"serial": "b", "bus": 1, "image": "other.bin"}])
+
+    def test_unknown_serial(self):
+        with self.assertRaises(ValueError):
+            fleet.assign_units(["a"], ["c:1"], 0, None)
+
+
+class TestRunUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        image = bytearray(0x60000)
+        for addr, orig, _ in patcher.patches["2501"]:
+            image[addr : addr + len(orig)] = orig
+        patcher.update_checksums(image, patcher.checksums["2501"])
+        self.image = bytes(image)
+
+        self.ecu = SimEcu(self.image, latency=0.0, t3=0x01, max_block_len=0x400)
+        self.panda = SimPanda()
+        self.panda.attach(self.ecu)
+
+    def opts(self, workflow: str) -> Namespace:
+        return Namespace(
+            workflow=workflow,
+            version=None,
+            start_address=0x5E000,
+            end_address=0x5EFFF,
+            dump_start_address=0x5E000,
+            dump_end_address=0x5FFFF,
+            chunk_size=0,
+            sector_size=0x1000,
+            output_dir=self.tmp.name,
+        )
+
+    def test_dump_patch_flash(self):
+        report = fleet.run_unit({"serial": "sim", "bus": 0, "image": None}, self.opts("dump-patch-flash"), self.panda)
+
+        self.assertEqual(report["result"], "ok", report["error"])
+        self.assertEqual(report["phase"], "done")
+        self.assertEqual(report["ranges"], [[0x5E000, 0x5EFFF]])
+        self.assertTrue(report["ident"].startswith("1K0909144E"))
+        self.assertIn("dump", report["timings"])
+        self.assertEqual(report["version"], "2501")
+
+        patched = patcher.patch(self.image, "2501")
+        self.assertEqual(self.ecu.image[0x5E000:0x5F000], patched[0x5E000:0x5F000])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "sim.log")))
+
+    def test_unit_version(self):
+        self.assertEqual(fleet.unit_version(self.image, None), "2501")
+        with self.assertRaises(ValueError):
+            fleet.unit_version(self.image, "3501")
+        with self.assertRaises(ValueError):
+            fleet.unit_version(patcher.patch(self.image, "2501"), None)
+        with self.assertRaises(ValueError):
+            fleet.unit_version(bytes(0x60000), None)
+        self.assertEqual(fleet.unit_version(bytes(0x60000), "3501"), "3501")
+
+    def test_failed_phase(self):
+        self.ecu.unsupported.add(0x34)
+        report = fleet.run_unit({"serial": "sim", "bus": 0, "image": None}, self.opts("dump-patch-flash"), self.panda)
+
+        self.assertEqual(report["result"], "failed")
+        self.assertEqual(report["phase"], "flash")
+        self.assertIn("NegativeResponseError", report["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
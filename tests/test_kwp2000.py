@@ -32,6 +32,16 @@ class TestKWP2000Client(unittest.TestCase):
         self.assertEqual(self.kwp.request_download(0xA000, 0x10000), 0x100)
         self.transport.send.assert_called_once_with(b"\x34\x00\xa0\x00\x00\x01\x00\x00")
 
+    def test_request_upload(self):
+        self.transport.recv = Mock(return_value=b"\x75\xff")
+        self.assertEqual(self.kwp.request_upload(0xA000, 0x10000), 0xFF)
+        self.transport.send.assert_called_once_with(b"\x35\x00\xa0\x00\x00\x01\x00\x00")
+
+    def test_read_memory_by_address(self):
+        self.transport.recv = Mock(return_value=b"\x63\x12\x34\x00\xa0\x00")
+        self.assertEqual(self.kwp.read_memory_by_address(0xA000, 2), b"\x12\x34")
+        self.transport.send.assert_called_once_with(b"\x23\x00\xa0\x00\x02")
+
     def test_erase_flash(self):
         self.transport.recv = Mock(return_value=b"\x71\xc4")
         self.kwp.erase_flash(0xA000, 0x5FFFF)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import random
+import unittest
+
+import patcher
+from locator import AhoCorasick, PatchLocator
+
+
+class TestAhoCorasick(unittest.TestCase):
+    def test_search(self):
+        patterns = [b"he", b"she", b"his", b"hers", b"s"]
+        data = b"ushers said his"
+        expected = sorted((i, p) for p, pattern in enumerate(patterns) for i in range(len(data)) if data.startswith(pattern, i))
+        self.assertEqual(sorted(AhoCorasick(patterns).search(data)), expected)
+
+
+class TestPatchLocator(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        fw = bytearray(rng.getrandbits(8) for _ in range(0x60000))
+        for addr, orig, _ in patcher.patches["2501"]:
+            fw[addr : addr + len(orig)] = orig
+        patcher.update_checksums(fw, patcher.checksums["2501"])
+        self.reference = bytes(fw)
+        self.locator = PatchLocator(self.reference, "2501")
+
+    def test_same_version(self):
+        proposed, proposed_checksums = self.locator.propose(self.reference)
+        self.assertEqual([patch for patch, _ in proposed], patcher.patches["2501"])
+        self.assertEqual([confidence for _, confidence in proposed], [1.0] * 4)
+        self.assertEqual(proposed_checksums, [(entry, True) for entry in patcher.checksums["2501"]])
+
+    def test_shifted_variant(self):
+        # Calibration moved by 0x40 bytes, new software version and min speed
+        fw = bytearray(self.reference)
+        fw[0x5E000:0x5E000] = bytes(0x40)
+        del fw[0x5F800:0x5F840]
+        fw[0x5E7E8 + 12 : 0x5E7E8 + 16] = b"2601"
+        fw[0x5E2C3] = 0x28
+        patcher.update_checksums(fw, [(0x5F03C, 0x5E040, 0x5F03C)])
+
+        proposed, proposed_checksums = self.locator.propose(fw)
+        self.assertEqual(proposed[0][0], (0x5E7E8, b"1K0909144E \x002601", b"1K0909144E \x002602"))
+        self.assertEqual(proposed[1], ((0x5E261, b"\x64", b"\x00"), 1.0))
+        self.assertEqual(proposed[2], ((0x5E2C3, b"\x28", b"\x00"), 0.5))
+        self.assertEqual(proposed[3], ((0x5FFFC, b"Ende", b"\xff\xff\xff\xff"), 1.0))
+        self.assertEqual(proposed_checksums, [((0x5F03C, 0x5E040, 0x5F03C), True)])
+
+    def test_not_found(self):
+        proposed, proposed_checksums = self.locator.propose(b"\xff" * 0x60000)
+        self.assertEqual(proposed[0], (None, 0.0))
+        self.assertFalse(proposed_checksums[0][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from memory_reader import KwpUploadReader, dump_memory, verify_memory
+from tp20 import MessageTimeoutError
+
+
+class ImageReader:
+    def __init__(self, image: bytes, fail_at: int = -1):
+        self.image = image
+        self.fail_at = fail_at
+        self.read = 0
+
+    def stream(self, address: int, size: int):
+        for i in range(address, address + size, 100):
+            if self.fail_at >= 0 and i >= self.fail_at:
+                raise TimeoutError("Lost connection")
+
+            dat = self.image[i : min(i + 100, address + size)]
+            self.read += len(dat)
+            yield dat
+
+
+class TestDumpMemory(unittest.TestCase):
+    def setUp(self):
+        self.image = os.urandom(0x3000)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "dump.bin")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_output(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_dump(self):
+        self.assertEqual(dump_memory(ImageReader(self.image), self.path, 0, len(self.image), block_size=0x1000), len(self.image))
+        self.assertEqual(self.read_output(), self.image)
+        self.assertFalse(os.path.exists(self.path + ".checkpoint"))
+
+    def test_resume(self):
+        with self.assertRaises(TimeoutError):
+            dump_memory(ImageReader(self.image, fail_at=0x2100), self.path, 0, len(self.image), block_size=0x1000)
+        self.assertEqual(len(self.read_output()), 0x2000)
+
+        reader = ImageReader(self.image)
+        self.assertEqual(dump_memory(reader, self.path, 0, len(self.image), block_size=0x1000), 0x1000)
+        self.assertEqual(self.read_output(), self.image)
+
+    def test_resume_corrupted_block(self):
+        with self.assertRaises(TimeoutError):
+            dump_memory(ImageReader(self.image, fail_at=0x2100), self.path, 0, len(self.image), block_size=0x1000)
+
+        with open(self.path, "r+b") as f:
+            f.seek(0x1800)
+            f.write(b"\x00")
+
+        self.assertEqual(dump_memory(ImageReader(self.image), self.path, 0, len(self.image), block_size=0x1000), 0x2000)
+        self.assertEqual(self.read_output(), self.image)
+
+    def test_no_resume(self):
+        with self.assertRaises(TimeoutError):
+            dump_memory(ImageReader(self.image, fail_at=0x2100), self.path, 0, len(self.image), block_size=0x1000)
+
+        self.assertEqual(dump_memory(ImageReader(self.image), self.path, 0, len(self.image), resume=False, block_size=0x1000), len(self.image))
+        self.assertEqual(self.read_output(), self.image)
+
+
+class TestVerifyMemory(unittest.TestCase):
+    def setUp(self):
+        self.image = os.urandom(0x3000)
+
+    def test_match(self):
+        reader = ImageReader(self.image)
+        self.assertIsNone(verify_memory(reader, self.image, [(0x100, 0x2FF), (0x1000, 0x1FFF)], block_size=0x80))
+        self.assertEqual(reader.read, 0x1200)
+
+    def test_first_mismatch(self):
+        flashed = bytearray(self.image)
+        for addr in (0x1234, 0x1236, 0x2000):
+            flashed[addr] ^= 0xFF
+        reader = ImageReader(bytes(flashed))
+
+        mismatch = verify_memory(reader, self.image, [(0x1000, 0x2FFF)], block_size=0x100)
+        self.assertEqual(mismatch, [(addr, flashed[addr], self.image[addr]) for addr in (0x1234, 0x1236)])
+        self.assertLess(reader.read, 0x400)
+
+
+class TestKwpUploadReader(unittest.TestCase):
+    def test_probe_failure_ends_upload(self):
+        for error in (ValueError("ECU returned no data"), MessageTimeoutError("Timed out waiting for message")):
+            kwp_client = Mock()
+            kwp_client.request_upload.return_value = 0x80
+            kwp_client.transfer_data.side_effect = error
+
+            self.assertFalse(KwpUploadReader(kwp_client).probe(0x5E000))
+            kwp_client.request_transfer_exit.assert_called_once_with()
+
+    def test_probe(self):
+        kwp_client = Mock()
+        kwp_client.request_upload.return_value = 0x80
+        kwp_client.transfer_data.return_value = b"\x01"
+
+        self.assertTrue(KwpUploadReader(kwp_client).probe(0x5E000))
+        kwp_client.request_transfer_exit.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    unittest.main()
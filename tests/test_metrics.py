@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from kwp2000 import ECU_IDENTIFICATION_TYPE, SESSION_TYPE, KWP2000Client, NegativeResponseError
+from metrics import Histogram, Metrics
+from panda_sim import SimEcu, SimPanda
+from tp20 import TP20Transport
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_buckets(self):
+        h = Histogram([0.1, 1.0])
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            h.observe(value)
+        self.assertEqual(h.cumulative(), [("0.1", 2), ("1.0", 3), ("+Inf", 4)])
+        self.assertAlmostEqual(h.sum, 2.65)
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.inc("kwp_requests", service="READ_MEMORY_BY_ADDRESS")
+        metrics.inc("kwp_requests", 2, service="READ_MEMORY_BY_ADDRESS")
+        metrics.observe("tp20_ack_wait_seconds", 0.003)
+
+        text = metrics.to_prometheus()
+        self.assertIn("# TYPE kwp_requests_total counter", text)
+        self.assertIn('kwp_requests_total{service="READ_MEMORY_BY_ADDRESS"} 3', text)
+        self.assertIn("# TYPE tp20_ack_wait_seconds histogram", text)
+        self.assertIn('tp20_ack_wait_seconds_bucket{le="0.005"} 1', text)
+        self.assertIn("tp20_ack_wait_seconds_count 1", text)
+
+    def test_threads(self):
+        metrics = Metrics()
+
+        def record():
+            for _ in range(2000):
+                metrics.inc("tp20_frames_sent")
+                metrics.observe("tp20_ack_wait_seconds", 0.001)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["tp20_frames_sent"], 8000)
+        self.assertEqual(snapshot["histograms"]["tp20_ack_wait_seconds"]["count"], 8000)
+
+    def test_write_json(self):
+        metrics = Metrics()
+        metrics.inc("tp20_frames_sent", 4)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.json")
+            metrics.write(path)
+            with open(path) as f:
+                self.assertEqual(json.load(f)["counters"], {"tp20_frames_sent": 4})
+
+
+class TestInstrumentedSession(unittest.TestCase):
+    def setUp(self):
+        self.ecu = SimEcu(bytes(0x60000), latency=0.0, t3=0x01)
+        self.panda = SimPanda()
+        self.panda.attach(self.ecu)
+
+    def test_counts_frames_and_requests(self):
+        metrics = Metrics()
+        kwp_client = KWP2000Client(TP20Transport(self.panda, 0x9, metrics=metrics))
+        kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        with self.assertRaises(NegativeResponseError):
+            kwp_client.diagnostic_session_control(0x86)
+
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters['kwp_requests{service="READ_ECU_IDENTIFICATION"}'], 1)
+        self.assertEqual(counters['kwp_negative_responses{nrc="0x33",service="DIAGNOSTIC_SESSION_CONTROL"}'], 1)
+        self.assertGreater(counters["tp20_frames_sent"], 2)
+        self.assertGreater(counters["tp20_bytes_received"], len(self.ecu.ident))
+
+        histograms = metrics.snapshot()["histograms"]
+        self.assertEqual(histograms["tp20_ack_wait_seconds"]["count"], 2)
+        self.assertEqual(histograms['kwp_request_seconds{service="READ_ECU_IDENTIFICATION"}']["count"], 1)
+
+    def test_disabled(self):
+        kwp_client = KWP2000Client(TP20Transport(self.panda, 0x9))
+        self.assertIsNone(kwp_client.metrics)
+        kwp_client.diagnostic_session_control(SESSION_TYPE.DIAGNOSTIC)
+
+
+if __name__ == "__main__":
+    unittest.main()
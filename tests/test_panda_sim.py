@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import importlib
+import struct
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from kwp2000 import ACCESS_TYPE, ECU_IDENTIFICATION_TYPE, SESSION_TYPE, KWP2000Client, NegativeResponseError
+from memory_reader import KwpReadMemoryReader, KwpUploadReader, kwp_reader, verify_memory
+from panda_sim import SimEcu, SimPanda, compute_programming_key
+from tp20 import CanReader, MessageTimeoutError, TP20Transport
+
+flasher = importlib.import_module("03_flasher")
+
+
+class TestSimulatedEcu(unittest.TestCase):
+    def setUp(self):
+        self.image = bytes(range(256)) * 0x600
+        self.ecu = SimEcu(self.image, latency=0.0, t3=0x01, max_block_len=0x400)
+        self.panda = SimPanda()
+        self.panda.attach(self.ecu)
+
+    def connect(self) -> KWP2000Client:
+        return KWP2000Client(TP20Transport(self.panda, 0x9))
+
+    def unlock(self, kwp_client: KWP2000Client):
+        seed = struct.unpack(">I", kwp_client.security_access(ACCESS_TYPE.PROGRAMMING_REQUEST_SEED))[0]
+        kwp_client.security_access(ACCESS_TYPE.PROGRAMMING_SEND_KEY, struct.pack(">I", compute_programming_key(seed)))
+
+    def test_open_channel(self):
+        tp20 = TP20Transport(self.panda, 0x9)
+        self.assertEqual(tp20.tx_addr, 0x740)
+        self.assertEqual(tp20.block_size, 0x0F)
+        self.assertAlmostEqual(tp20.t3, 0.0001)
+
+    def test_read_ecu_identification(self):
+        ident = self.connect().read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        self.assertEqual(ident, self.ecu.ident)
+
+    def test_shared_reader(self):
+        other = SimEcu(self.image, module=0x01, tx_addr=0x741, latency=0.0, t3=0x01, ident=b"06A906032HN")
+        self.panda.attach(other)
+
+        reader = CanReader(self.panda)
+        reader.start()
+        try:
+            transports = [TP20Transport(self.panda, 0x9, reader=reader), TP20Transport(self.panda, 0x1, reader=reader, rx_addr=0x301)]
+            with self.assertRaises(ValueError):
+                TP20Transport(self.panda, 0x1, reader=reader, rx_addr=0x301)
+
+            clients = [KWP2000Client(t) for t in transports]
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                reads = list(pool.map(lambda c: c.read_memory_by_address(0x5E000, 0x80), clients))
+                idents = list(pool.map(lambda c: c.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), clients))
+        finally:
+            reader.stop()
+
+        self.assertEqual([t.tx_addr for t in transports], [0x740, 0x741])
+        self.assertEqual(reads, [self.image[0x5E000:0x5E080]] * 2)
+        self.assertEqual(idents, [self.ecu.ident, other.ident])
+
+    def test_absent_module_frees_address(self):
+        reader = CanReader(self.panda)
+        with self.assertRaises(MessageTimeoutError):
+            TP20Transport(self.panda, 0x1, reader=reader)
+
+        self.assertEqual(reader.channels, {})
+        self.assertEqual(TP20Transport(self.panda, 0x9, reader=reader).tx_addr, 0x740)
+
+    def test_transfer_large_block(self):
+        kwp_client = self.connect()
+        kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+
+        kwp_client = self.connect()
+        self.unlock(kwp_client)
+        self.assertEqual(kwp_client.request_download(0x5E000, 0x3FF), 0x400)
+
+        kwp_client.transfer_data(b"\xaa" * 0x3FF)
+        kwp_client.request_transfer_exit()
+
+        self.assertEqual(self.ecu.image[0x5E000:0x5E3FF], b"\xaa" * 0x3FF)
+        self.assertEqual(self.ecu.t3_violations, 0)
+        # t3=0x01 is 0.1 ms, short enough for the blocks to be batched
+        self.assertLess(self.panda.usb_transactions, self.panda.frames_sent)
+
+    def test_kwp_reader(self):
+        reader = kwp_reader(self.connect(), 0x5E000)
+        self.assertIsInstance(reader, KwpUploadReader)
+        self.assertEqual(b"".join(reader.stream(0x5E000, 0x1000)), self.image[0x5E000:0x5F000])
+
+    def test_kwp_reader_read_memory_fallback(self):
+        self.ecu.unsupported.add(0x35)
+        self.ecu.max_read_len = 0x80
+
+        reader = kwp_reader(self.connect(), 0x5E000)
+        self.assertIsInstance(reader, KwpReadMemoryReader)
+        self.assertEqual(reader.block_size, 0x7F)
+        self.assertEqual(b"".join(reader.stream(0x5E000, 0x1000)), self.image[0x5E000:0x5F000])
+
+    def test_keep_alive(self):
+        kwp_client = self.connect()
+        tp20 = kwp_client.transport
+        tp20.keep_alive_interval = 0.01
+
+        self.assertFalse(tp20.keep_alive())
+        time.sleep(0.02)
+        self.assertTrue(tp20.keep_alive())
+
+        # The channel test response is not mistaken for the KWP2000 response
+        time.sleep(0.01)
+        ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        self.assertEqual(ident, self.ecu.ident)
+
+    def test_keep_alive_thread(self):
+        kwp_client = self.connect()
+        tp20 = kwp_client.transport
+        tp20.keep_alive_interval = 0.01
+
+        tp20.start_keep_alive()
+        time.sleep(0.1)
+        ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        tp20.close()
+
+        self.assertEqual(ident, self.ecu.ident)
+        self.assertGreater(tp20.keep_alives_sent, 0)
+
+    def test_reconnect(self):
+        self.ecu.reset_time = 0.2
+        kwp_client = self.connect()
+        tp20 = kwp_client.transport
+        kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+
+        elapsed = tp20.reconnect()
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertLess(elapsed, 0.8)
+        self.assertEqual(tp20.reconnects, 1)
+        self.assertEqual(kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), self.ecu.ident)
+
+    def test_reconnect_timeout(self):
+        tp20 = self.connect().transport
+        self.ecu.unavailable_until = time.monotonic() + 10
+        with self.assertRaises(MessageTimeoutError):
+            tp20.reconnect(timeout=0.3)
+
+    def test_busy(self):
+        self.ecu.busy[0x1A] = 2
+        self.assertEqual(self.connect().read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH), self.ecu.status)
+        self.assertEqual(self.ecu.requests[0x1A], 3)
+
+    def test_busy_retries_exhausted(self):
+        self.ecu.busy[0x1A] = 2
+        kwp_client = self.connect()
+        kwp_client.busy_retries = 1
+        with self.assertRaises(NegativeResponseError) as cm:
+            kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH)
+        self.assertEqual(cm.exception.error_code, 0x21)
+
+    def test_response_pending(self):
+        # Longer than the transport timeout, but within P2*
+        self.ecu.pending[0x1A] = 3
+        self.ecu.pending_interval = 0.15
+        self.assertEqual(self.connect().read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH), self.ecu.status)
+
+    def test_flash_range_keep_alive(self):
+        kwp_client = self.connect()
+        kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+        kwp_client.transport.reconnect()
+        self.unlock(kwp_client)
+
+        # Erase and checksum results take a while, the channel is kept open meanwhile
+        self.ecu.pending[0x33] = 4
+        self.ecu.pending_interval = 0.2
+        image = bytes([0xAA]) * 0x60000
+        flasher.flash_range(kwp_client, image, 0x5E000, 0x5EFFF)
+
+        tp20 = kwp_client.transport
+        self.assertEqual(self.ecu.image[0x5E000:0x5F000], image[0x5E000:0x5F000])
+        self.assertGreater(tp20.keep_alives_sent, 0)
+        self.assertIsNone(tp20.keep_alive_thread)
+
+    def test_verify_mismatch_ends_upload(self):
+        kwp_client = self.connect()
+        kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+        kwp_client.transport.reconnect()
+        self.unlock(kwp_client)
+
+        expected = bytearray(self.image)
+        expected[0x1010] ^= 0xFF
+        mismatch = verify_memory(KwpUploadReader(kwp_client), expected, [(0x1000, 0x4FFF)], block_size=0x100)
+        self.assertEqual(mismatch, [(0x1010, self.image[0x1010], expected[0x1010])])
+
+        # The upload was ended, so the ECU accepts the next request
+        self.assertIsNone(self.ecu.upload)
+        self.assertEqual(self.ecu.requests[0x37], 1)
+        self.assertEqual(kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), self.ecu.ident)
+
+    def test_frame_loss(self):
+        kwp_client = self.connect()
+        kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+        kwp_client.transport.reconnect()
+        self.unlock(kwp_client)
+
+        # Lost frames in both directions are sent again
+        self.ecu.loss = 0.03
+        self.assertEqual(b"".join(KwpUploadReader(kwp_client).stream(0, 0x1000)), self.image[:0x1000])
+
+        kwp_client.request_download(0x5E000, 0x7FE)
+        kwp_client.transfer_data(b"\xaa" * 0x3FF)
+        kwp_client.transfer_data(b"\x55" * 0x3FF)
+        kwp_client.request_transfer_exit()
+        self.assertEqual(self.ecu.image[0x5E000:0x5E7FE], b"\xaa" * 0x3FF + b"\x55" * 0x3FF)
+
+        self.assertGreater(self.ecu.frames_dropped, 0)
+        self.assertGreater(kwp_client.transport.retransmits + self.ecu.retransmits, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import patcher
+
+
+class TestPatcher(unittest.TestCase):
+    def setUp(self):
+        image = bytearray(range(256)) * (0x60000 // 256)
+        for addr, orig, _ in patcher.patches["3501"]:
+            image[addr : addr + len(orig)] = orig
+        patcher.update_checksums(image, patcher.checksums["3501"])
+        self.image = bytes(image)
+
+    def test_crc16(self):
+        self.assertEqual(patcher.crc16(b"123456789"), b"\x31\xc3")
+        self.assertEqual(patcher.crc16(memoryview(self.image)[0x100:0x200]), patcher.crc16(self.image[0x100:0x200]))
+
+    def test_verify_checksums(self):
+        config = patcher.checksums["3501"]
+        self.assertTrue(patcher.verify_checksums(self.image, config))
+
+        image = bytearray(self.image)
+        image[0x0B000] ^= 0xFF
+        self.assertFalse(patcher.verify_checksums(image, config))
+
+    def test_patch_image_in_place(self):
+        fw = bytearray(self.image)
+        view = memoryview(fw)
+        patcher.patch_image(fw, "3501")
+        view.release()
+
+        for addr, _, new in patcher.patches["3501"]:
+            self.assertEqual(fw[addr : addr + len(new)], new)
+        self.assertTrue(patcher.verify_checksums(fw, patcher.checksums["3501"]))
+        self.assertEqual(bytes(fw), patcher.patch(self.image, "3501"))
+
+    def test_unexpected_values(self):
+        fw = bytearray(self.image)
+        fw[0x5D289] = 0x00
+        with self.assertRaises(AssertionError):
+            patcher.apply_patches(fw, "3501")
+
+
+class TestChecksumIndex(unittest.TestCase):
+    def setUp(self):
+        self.config = patcher.checksums["3501"]
+        self.index = patcher.ChecksumIndex(self.config)
+
+    def test_blocks(self):
+        self.assertEqual(self.index.blocks(0x0AFFE, 0x0AFFF), [0])
+        self.assertEqual(self.index.blocks(0x0AFFF, 0x0B000), [1])
+        self.assertEqual(self.index.blocks(0x0AFFE, 0x0B000), [0, 1])
+        self.assertEqual(self.index.blocks(0x5D289, 0x5D28A), [self.config.index((0x05DFFE, 0x5CFFF, 0x5DFFC))])
+        self.assertEqual(self.index.blocks(0x0, 0xA000), [])
+        self.assertEqual(self.index.blocks(0x5FEF8, 0x5FFA0), [])
+
+    def test_chained(self):
+        # The checksum of the first block is stored inside the second block
+        config = [(0x100, 0x000, 0x080), (0x200, 0x080, 0x180), (0x202, 0x300, 0x400)]
+        index = patcher.ChecksumIndex(config)
+        self.assertEqual(index.affected([(0x10, 0x11)]), [0, 1])
+
+        fw = bytearray(0x400)
+        patcher.update_checksums(fw, config)
+        fw[0x10] = 0xFF
+        self.assertEqual(index.dirty(fw), [config[0]])
+
+        self.assertEqual(index.update(fw, [(0x10, 0x11)]), config[:2])
+        self.assertEqual(index.dirty(fw), [])
+
+    def test_incremental_update(self):
+        fw = bytearray(range(256)) * (0x60000 // 256)
+        patcher.update_checksums(fw, self.config)
+        full = bytearray(fw)
+
+        fw[0x30000:0x30010] = bytes(0x10)
+        full[0x30000:0x30010] = bytes(0x10)
+        self.assertEqual(self.index.dirty(fw), [self.config[38]])
+
+        self.assertEqual(self.index.update(fw, [(0x30000, 0x30010)]), [self.config[38]])
+        patcher.update_checksums(full, self.config)
+        self.assertEqual(fw, full)
+
+
+if __name__ == "__main__":
+    unittest.main()
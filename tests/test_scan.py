@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+from panda_sim import SimEcu, SimPanda
+from scan import read_identifications, scan_modules
+from tp20 import CanReader, TP20Transport
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.image = bytes(0x60000)
+        self.ecus = [
+            SimEcu(self.image, module=0x01, tx_addr=0x740, latency=0.0, t3=0x01, ident=b"06A906032HN"),
+            SimEcu(self.image, module=0x09, tx_addr=0x741, latency=0.0, t3=0x01),
+        ]
+        self.panda = SimPanda()
+        for ecu in self.ecus:
+            self.panda.attach(ecu)
+
+    def test_scan(self):
+        reader = CanReader(self.panda)
+        found = scan_modules(self.panda, reader=reader)
+        self.assertEqual(found, {0x01: {"tx_addr": 0x740, "rx_addr": 0x300}, 0x09: {"tx_addr": 0x741, "rx_addr": 0x300}})
+
+        # Every channel was closed and nothing is left for the next one on 0x300
+        self.assertEqual([ecu.rx_addr for ecu in self.ecus], [None, None])
+        self.assertEqual(self.panda.frames_sent, 256 + 2)
+        self.assertEqual(TP20Transport(self.panda, 0x9, reader=reader).tx_addr, 0x741)
+
+    def test_read_identifications(self):
+        found = scan_modules(self.panda, range(0x08, 0x10))
+        read_identifications(self.panda, found)
+        self.assertEqual(found, {0x09: {"tx_addr": 0x741, "rx_addr": 0x300, "ident": self.ecus[1].ident}})
+
+    def test_read_identifications_unresponsive_module(self):
+        reader = CanReader(self.panda)
+        found = scan_modules(self.panda, reader=reader)
+
+        # Module 0x01 went away after the scan, 0x09 is still read
+        self.ecus[0].unavailable_until = time.monotonic() + 10
+        read_identifications(self.panda, found, reader=reader)
+        self.assertIsNone(found[0x01]["ident"])
+        self.assertIn("MessageTimeoutError", found[0x01]["error"])
+        self.assertEqual(found[0x09]["ident"], self.ecus[1].ident)
+        self.assertEqual(reader.channels, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
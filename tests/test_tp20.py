@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+from unittest.mock import Mock
+
+from tp20 import MAX_BLOCK_FRAMES, CanReader, MessageTimeoutError, TP20Protocol, decode_timing, frame_blocks, retransmit_from
+
+
+class TestCanReader(unittest.TestCase):
+    def setUp(self):
+        self.panda = Mock()
+        self.reader = CanReader(self.panda, maxlen=2)
+
+    def test_stores_other_addresses(self):
+        self.panda.can_recv = Mock(side_effect=[[(0x300, 0, b"\x01", 0), (0x301, 0, b"\x02", 0)], []])
+        self.assertEqual(self.reader.get(0, 0x301, 0.1)[1], b"\x02")
+        self.assertEqual(self.reader.get(0, 0x300, 0.1)[1], b"\x01")
+
+    def test_ring_buffer_drops_oldest(self):
+        self.panda.can_recv = Mock(side_effect=[[(0x300, 0, bytes([i]), 0) for i in range(3)], []])
+        self.reader.poll()
+        self.assertEqual(self.reader.dropped, 1)
+        self.assertEqual(self.reader.get(0, 0x300, 0.1)[1], b"\x01")
+
+    def test_timeout(self):
+        self.panda.can_recv = Mock(return_value=[(0x300, 0, b"\x01", 1)])
+        with self.assertRaises(MessageTimeoutError):
+            self.reader.get(0, 0x300, 0.01)
+
+    def test_threaded(self):
+        self.panda.can_recv = Mock(side_effect=lambda: [(0x300, 0, b"\x01", 0)])
+        self.reader.start()
+        try:
+            self.assertEqual(self.reader.get(0, 0x300, 1.0)[1], b"\x01")
+        finally:
+            self.reader.stop()
+
+    def test_usb_calls_serialized(self):
+        # The reader thread and the sending thread share one USB handle
+        active = []
+        overlaps = []
+
+        def usb_call(*args, **kwargs):
+            active.append(None)
+            if len(active) > 1:
+                overlaps.append(None)
+            time.sleep(0.0001)
+            active.pop()
+            return []
+
+        self.panda.can_recv = Mock(side_effect=usb_call)
+        self.panda.can_send = Mock(side_effect=usb_call)
+        self.reader.start()
+        try:
+            for _ in range(200):
+                self.reader.can_send(0x740, b"\xa3", 0, 0)
+        finally:
+            self.reader.stop()
+        self.assertEqual(overlaps, [])
+
+
+class TestFraming(unittest.TestCase):
+    def test_frame_blocks(self):
+        blocks = frame_blocks(bytes(12), 0, 0x0F)
+        self.assertEqual(blocks, [[b"\x20\x00\x0c" + bytes(5), b"\x11" + bytes(7)]])
+
+    def test_no_block_size_is_capped(self):
+        # 242 bytes with the length are 35 frames, numbered past 15 twice
+        for block_size in (0, 0x10, 0x40):
+            blocks = frame_blocks(bytes(240), 0, block_size)
+            self.assertEqual([len(block) for block in blocks], [MAX_BLOCK_FRAMES, MAX_BLOCK_FRAMES, 5])
+
+            frames = [frame for block in blocks for frame in block]
+            self.assertEqual([frame[0] & 0xF for frame in frames], [i & 0xF for i in range(35)])
+            self.assertEqual([block[-1][0] >> 4 for block in blocks], [0x0, 0x0, 0x1])
+            self.assertTrue(all(frame[0] >> 4 == 0x2 for block in blocks for frame in block[:-1]))
+
+    def test_retransmit_from(self):
+        # Sequence numbers 10 to 15 and 0 to 8, the receiver acks with the one it expects next
+        block = frame_blocks(bytes(240), 10, 0x0F)[0]
+        self.assertEqual(retransmit_from(block, 9), [])
+        self.assertEqual(retransmit_from(block, 10), block)
+        self.assertEqual(retransmit_from(block, 2), block[8:])
+
+        short = frame_blocks(bytes(12), 14, 0x0F)[0]
+        self.assertEqual(retransmit_from(short, 0), [])
+        self.assertEqual(retransmit_from(short, 15), short[1:])
+        self.assertIsNone(retransmit_from(short, 5))
+
+
+class TestProtocol(unittest.TestCase):
+    def setUp(self):
+        self.protocol = TP20Protocol()
+        self.protocol.timing_response(bytes.fromhex("a10f8aff0aff"))
+
+    def test_timing_response(self):
+        self.assertEqual(self.protocol.block_size, 0x0F)
+        self.assertAlmostEqual(self.protocol.t1, 0.1)
+        self.assertAlmostEqual(self.protocol.t3, 0.001)
+
+    def test_data_frames(self):
+        payload = bytearray()
+        frames = frame_blocks(b"\x5a\x9b" * 6, 0, 0x0F)[0]
+        self.assertEqual(self.protocol.data_frame(payload, frames[0]), (False, False))
+        self.assertEqual(self.protocol.data_frame(payload, frames[1]), (True, True))
+        self.assertEqual(self.protocol.ack(), b"\xb2")
+        self.assertEqual(self.protocol.message(payload), b"\x5a\x9b" * 6)
+
+        # Frame 1 again is a late retransmission, it is acked but not added
+        self.assertEqual(self.protocol.data_frame(payload, frames[1]), (True, False))
+        self.assertEqual(self.protocol.sequence_errors, 1)
+
+    def test_lost_frame(self):
+        frames = frame_blocks(bytes(20), 0, 0x0F)[0]
+        payload = bytearray()
+        self.assertEqual(self.protocol.data_frame(payload, frames[1]), (False, False))
+        self.assertEqual(self.protocol.data_frame(payload, frames[2]), (False, False))
+        self.assertEqual(self.protocol.data_frame(payload, frames[3]), (True, False))
+        self.assertEqual(self.protocol.ack(), b"\xb0")
+
+    def test_ack_wait(self):
+        self.assertEqual(self.protocol.ack_wait_frame(b"\xb3"), (True, 3, False))
+        self.assertEqual(self.protocol.ack_wait_frame(b"\x93"), (False, None, False))
+        self.assertEqual(self.protocol.ack_wait_frame(b"\x1f" + bytes(7)), (False, None, True))
+        self.assertEqual(self.protocol.ack_wait_frame(b"\x10" + bytes(7)), (True, None, False))
+        self.assertEqual(self.protocol.early_frame, b"\x10" + bytes(7))
+        with self.assertRaises(RuntimeError):
+            self.protocol.ack_wait_frame(b"\xa8")
+
+    def test_block_acked(self):
+        blocks = self.protocol.blocks(bytes(240))
+        self.assertEqual(self.protocol.block_acked(blocks[0], 4), blocks[0][4:])
+        self.assertEqual(self.protocol.block_timed_out(blocks[0]), blocks[0][-1:])
+        self.assertEqual(self.protocol.retransmits, 2)
+        self.assertEqual(self.protocol.block_acked(blocks[0], 15), [])
+        self.assertEqual(self.protocol.tx_seq, 15)
+
+        # The receiver answering is only an ack for the last block
+        with self.assertRaises(RuntimeError):
+            self.protocol.block_acked(blocks[1], None)
+        self.assertEqual(self.protocol.block_acked(blocks[2], None), [])
+
+
+class TestTiming(unittest.TestCase):
+    def test_decode_timing(self):
+        self.assertAlmostEqual(decode_timing(0x8A), 0.1)
+        self.assertAlmostEqual(decode_timing(0x4A), 0.01)
+        self.assertAlmostEqual(decode_timing(0x0A), 0.001)
+        self.assertAlmostEqual(decode_timing(0xC1), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,86 +6,194 @@ Reference: https://jazdw.net/tp20
 
 import time
 import struct
-from typing import Optional, List, Tuple
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 from panda import Panda  # type: ignore
+from metrics import Metrics
 
 
 BROADCAST_ADDR = 0x200
+MAX_PAYLOAD_LEN = 0xFFFF
+
+# Timing parameters we ask for: block size 0x0f, T1 100ms, T3 1ms
+TIMING_PARAMS = b"\x0f\x8a\xff\x0a\xff"
+
+# Fraction of T1 the channel may be idle before keep_alive sends a channel test
+KEEP_ALIVE_FRACTION = 0.8
+
+# Channel setup is retried with a back-off growing from RECONNECT_MIN_DELAY to
+# RECONNECT_MAX_DELAY while the ECU restarts, for up to RECONNECT_TIMEOUT seconds
+RECONNECT_MIN_DELAY = 0.01
+RECONNECT_MAX_DELAY = 0.25
+RECONNECT_TIMEOUT = 15.0
+
+# Times a block is sent again after lost frames before giving up
+RETRANSMIT_LIMIT = 5
+
+# Acks carry a 4 bit sequence number, so a block longer than this could not tell
+# which frame the receiver expects next
+MAX_BLOCK_FRAMES = 15
+
+# Frames are handed to the panda as one batch when the ECU does not ask for a
+# longer gap than this, the panda then sends them back to back on the bus.
+# ECUs usually negotiate a T3 of a few milliseconds, then every frame is paced
+# by the host and batching does nothing
+BATCH_MAX_T3 = 0.0005
 
 
 class MessageTimeoutError(TimeoutError):
     pass
 
 
-class TP20Transport:
-    def __init__(self, panda: Panda, module: int, bus: int = 0, timeout: float = 0.1, debug: bool = False):
-        """Create TP20Transport object and open a channel"""
-        self.panda = panda
-        self.bus = bus
+# Units of the timing parameters, selected by the upper two bits
+TIMING_UNITS = [0.0001, 0.001, 0.01, 0.1]
+
+
+def decode_timing(param: int) -> float:
+    """Decode a TP 2.0 timing parameter byte into seconds. The upper two bits
+    select the unit (0.1ms, 1ms, 10ms or 100ms), the lower six bits the count"""
+    return TIMING_UNITS[param >> 6] * (param & 0x3F)
+
+
+def frame_blocks(dat: bytes, tx_seq: int, block_size: int) -> List[List[bytes]]:
+    """Split a message into TP 2.0 data frames, starting at sequence number tx_seq.
+    Frames are grouped in blocks of block_size frames, the last frame of every
+    block asks for an ack. Blocks never exceed MAX_BLOCK_FRAMES, also when the
+    receiver allows more or sets no limit with block_size 0"""
+    if block_size <= 0 or block_size > MAX_BLOCK_FRAMES:
+        block_size = MAX_BLOCK_FRAMES
+
+    # Prepend length
+    payload = struct.pack(">H", len(dat)) + dat
+
+    blocks: List[List[bytes]] = []
+    block: List[bytes] = []
+    for i in range(0, len(payload), 7):
+        last = i + 7 >= len(payload)
+        block_end = (i // 7 + 1) % block_size == 0
+
+        if last:
+            opcode = 0x10  # Last packet, waiting for ack
+        elif block_end:
+            opcode = 0x00  # Waiting for ack, more packets to follow
+        else:
+            opcode = 0x20  # Not waiting for ack, more packets to follow
+
+        block.append(bytes([opcode | tx_seq]) + payload[i : i + 7])
+        tx_seq = (tx_seq + 1) & 0xF
+
+        if last or block_end:
+            blocks.append(block)
+            block = []
+
+    return blocks
+
+
+def retransmit_from(block: List[bytes], seq: int) -> Optional[List[bytes]]:
+    """Frames of a block to send again for an ack with sequence number seq. The
+    receiver acks with the sequence number it expects next, so an ack for a
+    frame inside the block means that frame and the ones after it were lost.
+    Returns an empty list if the whole block was received, None if seq is not
+    part of the block. Only unambiguous for blocks of at most MAX_BLOCK_FRAMES"""
+    assert len(block) <= MAX_BLOCK_FRAMES
+    offset = (seq - (block[0][0] & 0xF)) & 0xF
+    if offset == len(block):
+        return []
+    if offset < len(block):
+        return block[offset:]
+    return None
+
+
+class TP20Protocol:
+    def __init__(self, timeout: float = 0.1, debug: bool = False, batch: bool = True, keep_alive_interval: Optional[float] = None, metrics: Optional[Metrics] = None):
+        """Channel state and protocol logic of TP 2.0 without any I/O: framing,
+        sequence numbers, acks and retransmissions. The transports feed it the
+        frames they receive and send the frames it returns, so the sync and
+        async transports behave the same."""
         self.timeout = timeout
-        self.msgs: List[Tuple[int, bytes]] = []
 
         self.tx_seq = 0
         self.rx_seq = 0
+        self.rx_next = 0
         self.time_between_packets = 0.0
 
-        self.debug = debug
-        self.open_channel(module)
+        # Negotiated timing parameters, filled in by timing_response
+        self.block_size = 0
+        self.t1 = timeout
+        self.t3 = 0.0
 
-    def can_recv(self, addr: Optional[int] = None) -> bytes:
-        """Receive messages until a message with the specified address
-        is received. Messages on other addresses, or a second message
-        with the specified address, will be stored and are returned
-        on subsequent calls."""
+        self.batch = batch
+        self.usb_transactions = 0
 
-        if addr is None:
-            addr = self.rx_addr
+        self.last_activity = time.monotonic()
+        self.keep_alive_interval = keep_alive_interval
+        self.keep_alives_sent = 0
+        self.reconnects = 0
+        self.retransmits = 0
+        self.sequence_errors = 0
+        self.early_frame: Optional[bytes] = None
 
-        start_time = time.monotonic()
-        while time.monotonic() - start_time < self.timeout:
-            while len(self.msgs):
-                a, dat = self.msgs.pop(0)
-                if a == addr:
-                    return dat
+        self.metrics = metrics
+        self.debug = debug
 
-            for a, _, dat, bus in self.panda.can_recv():
-                if a != addr:
-                    continue
+    def _inc(self, name: str, value: float = 1):
+        if self.metrics is not None:
+            self.metrics.inc(name, value)
 
-                if bus != self.bus:
-                    continue
+    def _observe(self, name: str, value: float):
+        if self.metrics is not None:
+            self.metrics.observe(name, value)
 
-                if self.debug:
-                    print(f"RX: {hex(a)} - {dat.hex()}")
-                self.msgs.append((a, dat))
+    @property
+    def idle_time(self) -> float:
+        """Time since the last frame was sent or received"""
+        return time.monotonic() - self.last_activity
 
-        raise MessageTimeoutError("Timed out waiting for message")
+    def keep_alive_due(self) -> bool:
+        """True if the channel has been idle for keep_alive_interval, by default close to T1"""
+        interval = self.keep_alive_interval
+        if interval is None:
+            interval = self.t1 * KEEP_ALIVE_FRACTION
+        return self.idle_time >= interval
 
-    def can_send(self, dat: bytes, addr: Optional[int] = None):
-        if addr is None:
-            addr = self.tx_addr
+    def batched(self, frames: List[bytes]) -> bool:
+        """Whether frames go to the panda in one USB transfer, see BATCH_MAX_T3"""
+        return self.batch and self.t3 <= BATCH_MAX_T3 and len(frames) >= 2
 
+    def frames_sent(self, addr: int, frames: List[bytes]):
+        """Record frames passed to the panda in one USB transfer"""
         if self.debug:
-            print(f"TX: {hex(addr)} - {dat.hex()}")
-        self.panda.can_send(addr, dat, self.bus, int(self.timeout * 1000))
-        time.sleep(self.time_between_packets)
+            for dat in frames:
+                print(f"TX: {hex(addr)} - {dat.hex()}")
+        self.usb_transactions += 1
+        self.last_activity = time.monotonic()
+        self._inc("tp20_frames_sent", len(frames))
+        self._inc("tp20_bytes_sent", sum(len(dat) for dat in frames))
+        self._inc("tp20_usb_transactions")
+
+    def frame_received(self, addr: int, dat: bytes):
+        self.last_activity = time.monotonic()
+        if self.debug:
+            print(f"RX: {hex(addr)} - {dat.hex()}")
+        self._inc("tp20_frames_received")
+        self._inc("tp20_bytes_received", len(dat))
 
-    def open_channel(self, module: int):
-        """Before communicating to an ECU we have to open a channel.
-        This is done on the broadcast address of 0x200. We expect a
-        reply on 0x200 + module logial address. We ask the destination module
-        to broadcast on 0x300. It will reply with an address for us to transmit on."""
+    def recv_timed_out(self):
+        self._inc("tp20_recv_timeouts")
 
+    @staticmethod
+    def setup_request(module: int, rx_addr: int) -> bytes:
         # Dest: <module>
         # Opcode 0xc0 (setup)
         # RX ID: V = 1 (invalid), 0x1000
-        # TX ID: 0x300 + V = 0 (valid), 0x0300
+        # TX ID: rx_addr + V = 0 (valid), e.g. 0x0300
         # Application type: 0x01
-        self.can_send(bytes([module]) + b"\xc0\x00\x10\x00\x03\x01", BROADCAST_ADDR)
+        return bytes([module, 0xC0, 0x00, 0x10]) + struct.pack("<H", rx_addr) + b"\x01"
 
-        # Channel setup response (e.g. 00d00003a80701)
-        dat = self.can_recv(BROADCAST_ADDR + module)
+    def setup_response(self, dat: bytes, rx_addr: int) -> int:
+        """Check a channel setup response (e.g. 00d00003a80701). Returns the address to transmit on"""
         if self.debug:
             print(f"Got channel setup response {dat.hex()}")
 
@@ -93,88 +201,549 @@ class TP20Transport:
         if status != 0xD0:
             raise RuntimeError(f"Failed to setup channel, got {dat.hex()}")
 
-        assert rx == 0x300  # We asked for this
-
-        self.rx_addr = rx
-        self.tx_addr = tx
+        assert rx == rx_addr  # We asked for this
+        return tx
 
-        # Set timing parameters
-        # Opcode: 0xa0 (Parameters request)
-        # Block size: 0x0f
-        # T1: 0x8a (time to wait for ack, 10ms * 10 = 100ms)
-        # T2: 0xff (always 0xff)
-        # T3: 0x0a (interval between packets, 0.1ms * 10 = 1ms)
-        # T4: 0xff (always 0xff)
-        self.can_send(b"\xa0\x0f\x8a\xff\x0a\xff")
-
-        # Receive timing parameters (e.g. a10f8aff4aff)
+    def timing_response(self, dat: bytes):
+        """Apply the timing parameters of the ECU (e.g. a10f8aff4aff) and start
+        the new channel at sequence number 0"""
         # 0x8a: 10ms * 10 = 100ms
         # 0x4a: 1ms * 10 = 10ms
-        dat = self.can_recv()
         if self.debug:
             print(f"Got timing params {dat.hex()}")
-        opcode, bs, t1, t4 = struct.unpack("<BBBxBx", dat)
+        opcode, bs, t1, t3 = struct.unpack("<BBBxBx", dat)
         assert opcode == 0xA1
 
-        # TODO: parse response
-        self.time_between_packets = 0.01
+        self.block_size = bs
+        self.t1 = decode_timing(t1)
+        self.t3 = decode_timing(t3)
+        self.time_between_packets = self.t3
+
+        if self.debug:
+            print(f"Block size {self.block_size}, T1 {self.t1 * 1000:.1f} ms, T3 {self.t3 * 1000:.1f} ms")
 
         self.tx_seq = 0
         self.rx_seq = 0
+        self.rx_next = 0
+        self.early_frame = None
 
-    def wait_for_ack(self):
+    def reconnected(self, elapsed: float, attempts: int):
+        self.reconnects += 1
+        if self.debug:
+            print(f"Reconnected after {elapsed * 1000:.0f} ms, {attempts} attempts")
+        self._observe("tp20_reconnect_seconds", elapsed)
+
+    def ack(self) -> bytes:
         """Even though both sides have their own sequence counter
-        we expect an ack with our own sequence + 1"""
-        seq = (self.tx_seq + 1) & 0xF
-        if self.can_recv() != bytes([0xB0 | seq]):
+        we send an ack with the sequence number we expect next from the
+        other side, the counter of the last frame received + 1"""
+        return bytes([0xB0 | self.rx_next])
+
+    @staticmethod
+    def channel_test_reply(dat: bytes) -> Tuple[bool, Optional[bytes]]:
+        """Handle channel tests in the received frame. Returns whether it was a
+        channel test or a response to ours, and the reply to send"""
+        if dat[0] == 0xA1:  # Channel test response
+            return True, None
+        if dat[0] == 0xA3:  # Channel test
+            return True, b"\xa1" + TIMING_PARAMS
+        return False, None
+
+    def blocks(self, dat: bytes) -> List[List[bytes]]:
+        if len(dat) > MAX_PAYLOAD_LEN:
+            raise ValueError(f"Packet longer than {MAX_PAYLOAD_LEN} bytes not supported")
+        return frame_blocks(dat, self.tx_seq, self.block_size)
+
+    def ack_wait_frame(self, dat: bytes) -> Tuple[bool, Optional[int], bool]:
+        """Handle a frame received while waiting for an ack. Returns whether the
+        wait is over, the sequence number the receiver expects next, and whether
+        to send an ack. A receiver not ready ack means we have to wait for
+        another ack. When the receiver already answers the frame is kept in
+        early_frame for recv and the sequence number is None."""
+        typ, seq = dat[0] >> 4, dat[0] & 0xF
+        if typ == 0xB:
+            return True, seq, False
+        if typ <= 0x3:
+            if seq != self.rx_next:
+                # Last frame of the previous message again, our ack was lost
+                return False, None, typ in (0x0, 0x1)
+            self.early_frame = dat
+            return True, None, False
+        if typ != 0x9:
+            raise RuntimeError("Wrong ack received")
+        self._inc("tp20_acks_not_ready")
+        return False, None, False
+
+    def block_acked(self, block: List[bytes], seq: Optional[int]) -> List[bytes]:
+        """Frames of a block to send again after its ack, see retransmit_from. seq
+        None means the receiver already answers, so its ack for the last block
+        was lost. Returns an empty list once the whole block was received"""
+        frames: Optional[List[bytes]]
+        if seq is None:
+            frames = [] if block[-1][0] >> 4 == 0x1 else None
+        else:
+            frames = retransmit_from(block, seq)
+
+        if frames is None:
             raise RuntimeError("Wrong ack received")
+        if not frames:
+            self.tx_seq = ((block[-1][0] & 0xF) + 1) & 0xF
+            return frames
+
+        self._retransmit(frames)
+        return frames
+
+    def block_timed_out(self, block: List[bytes]) -> List[bytes]:
+        """No ack within T1, the last frame or its ack was lost. Returns the frame to send again"""
+        frames = block[-1:]
+        self._retransmit(frames)
+        return frames
+
+    def _retransmit(self, frames: List[bytes]):
+        self.retransmits += 1
+        self._inc("tp20_retransmits")
+        if self.debug:
+            print(f"Sending {len(frames)} frames again")
+
+    def frame_timeouts(self, timeout: Optional[float] = None) -> Tuple[float, float]:
+        """Time to wait for the first frame of a message and for every following
+        frame. A lost frame is sent again after T1, so allow for as many
+        retransmissions as we make ourselves"""
+        frame_timeout = self.timeout + RETRANSMIT_LIMIT * self.t1
+        return (frame_timeout if timeout is None else timeout), frame_timeout
+
+    def data_frame(self, payload: bytearray, dat: bytes) -> Tuple[bool, bool]:
+        """Add a received data frame to payload. A frame with another sequence number
+        than expected means frames were lost, they are dropped until the sender
+        asks for an ack, which is answered with the sequence number of the first
+        lost frame so it sends them again. Returns whether to send an ack and
+        whether the message is complete"""
+        typ, seq = dat[0] >> 4, dat[0] & 0xF
+        if typ > 0x3:  # Late ack for a frame we sent again
+            return False, False
+
+        if seq != self.rx_next:
+            self.sequence_errors += 1
+            self._inc("tp20_sequence_errors")
+            if self.debug:
+                print(f"Expected frame {self.rx_next}, got {seq}")
+
+            if typ == 0x3:
+                raise RuntimeError(f"Frame {self.rx_next} lost and the sender does not wait for an ack")
+            return typ in (0x0, 0x1), False  # Ask for the lost frames
+
+        payload += dat[1:]
+        self.rx_seq = seq
+        self.rx_next = (seq + 1) & 0xF
+
+        # Ack if the sender waits for it, done after the last packet
+        return typ in (0x0, 0x1), typ in (0x1, 0x3)
+
+    @staticmethod
+    def message(payload: bytearray) -> bytes:
+        length = struct.unpack(">H", payload[:2])[0]
+        data = bytes(payload[2 : length + 2])
+        assert len(data) == length
+        return data
 
-    def send_ack(self):
-        """Even though both sides have their own sequence counter
-        we send an ack with the counter from the other side + 1"""
-        seq = (self.rx_seq + 1) & 0xF
-        self.can_send(bytes([0xB0 | seq]))
 
-    def send(self, dat: bytes):
-        """Sends longer string of data by dividing into smaller chunks
-        and waiting for acknowledge after the last chunk"""
-        if len(dat) > 0xFF:
-            raise ValueError("Packet longer than 255 bytes not supported")
+class CanReader:
+    def __init__(self, panda: Panda, maxlen: int = 1024, poll_interval: float = 0.001):
+        """Buffers received CAN messages in a bounded ring buffer per (bus, address),
+        together with their arrival time. Call start() to drain the panda from a
+        background thread, otherwise the buffer is filled by polling from get().
+        One reader can be shared by several transports on the same panda, each
+        attached on its own rx address. All panda calls go through the reader,
+        so the USB device is never used from two threads at once."""
+        self.panda = panda
+        self.maxlen = maxlen
+        self.poll_interval = poll_interval
+        self.msgs: Dict[Tuple[int, int], Deque[Tuple[float, bytes]]] = {}
+        self.dropped = 0
+        self.channels: Dict[Tuple[int, int], Any] = {}
+
+        self.cond = threading.Condition()
+        self.usb_lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="CanReader", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.running = False
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while self.running:
+            if not self.poll():
+                time.sleep(self.poll_interval)
+
+    def poll(self) -> int:
+        """Drain the panda once and store all messages. Returns the number of messages received"""
+        with self.usb_lock:
+            msgs = self.panda.can_recv()
+        if not msgs:
+            return 0
+
+        t = time.monotonic()
+        with self.cond:
+            for addr, _, dat, bus in msgs:
+                buf = self.msgs.get((bus, addr))
+                if buf is None:
+                    buf = self.msgs[(bus, addr)] = deque(maxlen=self.maxlen)
+                elif len(buf) == self.maxlen:
+                    self.dropped += 1
+                buf.append((t, bytes(dat)))
+            self.cond.notify_all()
+
+        return len(msgs)
+
+    def get(self, bus: int, addr: int, timeout: float) -> Tuple[float, bytes]:
+        """Returns the oldest message on (bus, addr) with its arrival time,
+        waiting up to timeout seconds for one to arrive"""
+        deadline = time.monotonic() + timeout
+        key = (bus, addr)
 
-        # Prepend length
-        payload = struct.pack(">H", len(dat)) + dat
+        while True:
+            with self.cond:
+                buf = self.msgs.get(key)
+                if buf:
+                    return buf.popleft()
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise MessageTimeoutError("Timed out waiting for message")
 
-        while payload:
-            last = len(payload) <= 7  # Wait for ack on last packet
+                if self.thread is not None:
+                    self.cond.wait(remaining)
+                    continue
 
-            to_send = bytes([(0x10 if last else 0x20) | self.tx_seq])
-            to_send += payload[:7]
+            self.poll()
+
+    def pop(self, bus: int, addr: int) -> Optional[Tuple[float, bytes]]:
+        """Returns the oldest buffered message on (bus, addr) with its arrival time,
+        or None if there is none. Does not poll the panda"""
+        with self.cond:
+            buf = self.msgs.get((bus, addr))
+            return buf.popleft() if buf else None
+
+    def clear(self, bus: Optional[int] = None, addr: Optional[int] = None):
+        """Drop buffered messages, optionally only for a single bus and/or address"""
+        with self.cond:
+            for b, a in self.msgs:
+                if (bus is None or b == bus) and (addr is None or a == addr):
+                    self.msgs[(b, a)].clear()
+
+    def attach(self, bus: int, addr: int, channel: Any):
+        """Route messages on (bus, addr) to channel. Raises ValueError if
+        another channel already receives on that address"""
+        with self.cond:
+            owner = self.channels.get((bus, addr))
+            if owner is not None and owner is not channel:
+                raise ValueError(f"Address {hex(addr)} on bus {bus} is already used by another channel")
+            self.channels[(bus, addr)] = channel
+
+    def detach(self, bus: int, addr: int, channel: Any):
+        with self.cond:
+            if self.channels.get((bus, addr)) is channel:
+                del self.channels[(bus, addr)]
+
+    def can_send(self, addr: int, dat: bytes, bus: int, timeout: int):
+        with self.usb_lock:
+            self.panda.can_send(addr, dat, bus, timeout)
+
+    def can_send_many(self, arr: List[Tuple[int, None, bytes, int]], timeout: int):
+        with self.usb_lock:
+            self.panda.can_send_many(arr, timeout=timeout)
+
+
+class TP20Transport(TP20Protocol):
+    def __init__(
+        self,
+        panda: Panda,
+        module: int,
+        bus: int = 0,
+        timeout: float = 0.1,
+        debug: bool = False,
+        threaded: bool = False,
+        batch: bool = True,
+        keep_alive_interval: Optional[float] = None,
+        metrics: Optional[Metrics] = None,
+        reader: Optional[CanReader] = None,
+        rx_addr: int = 0x300,
+    ):
+        """Create TP20Transport object and open a channel. When threaded is set
+        the panda is drained by a background thread, so no messages are lost
+        while we are sleeping between packets. When batch is set all frames
+        up to the next ack are sent in a single USB transfer if the
+        negotiated T3 is at most BATCH_MAX_T3, which real ECUs rarely
+        allow. keep_alive_interval is the idle time after
+        which keep_alive sends a channel test, by default close to T1. Frame
+        counts and ack wait times are recorded in metrics, if given.
+
+        Pass the same reader to every transport on a panda to talk to several
+        modules at once, each with its own rx_addr the module is asked to
+        transmit on. Without one the transport creates its own reader."""
+        super().__init__(timeout, debug, batch, keep_alive_interval, metrics)
+        self.panda = panda
+        self.module = module
+        self.bus = bus
 
-            self.can_send(to_send)
+        self.owns_reader = reader is None
+        self.reader = CanReader(panda) if reader is None else reader
+        if threaded:
+            self.reader.start()
+
+        # Held while sending, so a keep alive never ends up inside a message
+        self.lock = threading.RLock()
+        self.keep_alive_thread: Optional[threading.Thread] = None
+        self.keep_alive_running = False
+
+        self.rx_addr = rx_addr
+        try:
+            self.open_channel(module, rx_addr)
+        except Exception:
+            if self.owns_reader:
+                self.reader.stop()
+            raise
+
+    def close(self):
+        """Stop the keep alive and detach from the reader. The background
+        reader is stopped if the transport created it"""
+        self.stop_keep_alive()
+        self.reader.detach(self.bus, self.rx_addr, self)
+        if self.owns_reader:
+            self.reader.stop()
+
+    def keep_alive(self) -> bool:
+        """Send a channel test if the channel has been idle for keep_alive_interval.
+        The response is dropped when it is received, so it never shows up as
+        data. Returns True if a channel test was sent"""
+        with self.lock:
+            if not self.keep_alive_due():
+                return False
+
+            self.can_send(b"\xa3")
+            self.keep_alives_sent += 1
+            return True
+
+    def start_keep_alive(self):
+        """Call keep_alive from a background thread until close is called"""
+        if self.keep_alive_thread is not None:
+            return
+
+        def run():
+            while self.keep_alive_running:
+                self.keep_alive()
+                time.sleep(self.t1 * (1 - KEEP_ALIVE_FRACTION))
+
+        self.keep_alive_running = True
+        self.keep_alive_thread = threading.Thread(target=run, name="TP20KeepAlive", daemon=True)
+        self.keep_alive_thread.start()
+
+    def stop_keep_alive(self):
+        if self.keep_alive_thread is None:
+            return
+
+        self.keep_alive_running = False
+        self.keep_alive_thread.join()
+        self.keep_alive_thread = None
+
+    def can_recv(self, addr: Optional[int] = None, timeout: Optional[float] = None) -> bytes:
+        """Receive messages until a message with the specified address
+        is received. Messages on other addresses, or a second message
+        with the specified address, will be stored and are returned
+        on subsequent calls."""
 
-            if last:
-                self.wait_for_ack()
+        if addr is None:
+            addr = self.rx_addr
+        if timeout is None:
+            timeout = self.timeout
 
-            self.tx_seq = (self.tx_seq + 1) & 0xF
+        try:
+            _, dat = self.reader.get(self.bus, addr, timeout)
+        except MessageTimeoutError:
+            self.recv_timed_out()
+            raise
 
-            payload = payload[7:]
+        self.frame_received(addr, dat)
+        return dat
 
-    def recv(self) -> bytes:
-        """Receives multiple chunks of a response and combines
-        them into a single string"""
-        payload = b""
-        while True:
-            dat = self.can_recv()
-            payload += dat[1:]
+    def can_send(self, dat: bytes, addr: Optional[int] = None):
+        if addr is None:
+            addr = self.tx_addr
 
-            typ, seq = dat[0] >> 4, dat[0] & 0xF
-            self.rx_seq = seq  # TODO: Check
+        self.reader.can_send(addr, dat, self.bus, int(self.timeout * 1000))
+        self.frames_sent(addr, [dat])
+        time.sleep(self.time_between_packets)
 
-            if typ == 0x1:  # Last packet, send ack and return data
+    def can_send_many(self, frames: List[bytes]):
+        """Send frames on our tx address. They are passed to the panda in one
+        USB transfer when batching is enabled and the ECU allows back to back
+        frames, otherwise they are paced by the host"""
+        if not self.batched(frames):
+            for dat in frames:
+                self.can_send(dat)
+            return
+
+        self.reader.can_send_many([(self.tx_addr, None, dat, self.bus) for dat in frames], int(self.timeout * 1000))
+        self.frames_sent(self.tx_addr, frames)
+
+    def open_channel(self, module: int, rx_addr: Optional[int] = None):
+        """Before communicating to an ECU we have to open a channel.
+        This is done on the broadcast address of 0x200. We expect a
+        reply on 0x200 + module logial address. We ask the destination module
+        to broadcast on rx_addr, 0x300 by default. It will reply with an
+        address for us to transmit on."""
+        if rx_addr is None:
+            rx_addr = self.rx_addr
+
+        # Claim the address first, frames for another channel must not end up here
+        self.reader.attach(self.bus, rx_addr, self)
+        if rx_addr != self.rx_addr:
+            self.reader.detach(self.bus, self.rx_addr, self)
+        self.rx_addr = rx_addr
+        self.module = module
+
+        try:
+            self._setup_channel(module, rx_addr)
+        except Exception:
+            # Free the address, a module that does not answer must not block it for other channels
+            self.reader.detach(self.bus, rx_addr, self)
+            raise
+
+    def _setup_channel(self, module: int, rx_addr: int):
+        self.can_send(self.setup_request(module, rx_addr), BROADCAST_ADDR)
+        self.tx_addr = self.setup_response(self.can_recv(BROADCAST_ADDR + module), rx_addr)
+
+        # Set timing parameters
+        # Opcode: 0xa0 (Parameters request)
+        # Block size: 0x0f
+        # T1: 0x8a (time to wait for ack, 10ms * 10 = 100ms)
+        # T2: 0xff (always 0xff)
+        # T3: 0x0a (interval between packets, 0.1ms * 10 = 1ms)
+        # T4: 0xff (always 0xff)
+        self.can_send(b"\xa0" + TIMING_PARAMS)
+        self.timing_response(self.can_recv())
+
+    def reconnect(self, timeout: float = RECONNECT_TIMEOUT) -> float:
+        """Open the channel again after the ECU restarted, e.g. after switching
+        to the programming session or erasing flash. Channel setup is retried
+        with a growing back-off until it succeeds or timeout seconds have passed.
+        The transport and its reader are reused. Returns the time the ECU took
+        to come back"""
+        start = time.monotonic()
+        delay = RECONNECT_MIN_DELAY
+        attempts = 0
+        with self.lock:
+            while True:
+                time.sleep(delay)
+                attempts += 1
+
+                # Drop frames of the old channel and late replies to earlier attempts.
+                # Frames of other channels on a shared reader are kept
+                if self.owns_reader:
+                    with self.reader.usb_lock:
+                        self.panda.can_clear(0xFFFF)
+                self.reader.clear(self.bus, BROADCAST_ADDR + self.module)
+                self.reader.clear(self.bus, self.rx_addr)
+                try:
+                    self.open_channel(self.module)
+                    break
+                except Exception as e:
+                    elapsed = time.monotonic() - start
+                    if elapsed + delay > timeout:
+                        raise MessageTimeoutError(f"No channel after {attempts} attempts in {elapsed:.2f} s: {e}") from e
+                    if self.debug:
+                        print(f"Reconnect attempt {attempts} failed: {e}")
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+        elapsed = time.monotonic() - start
+        self.reconnected(elapsed, attempts)
+        return elapsed
+
+    def wait_for_ack(self) -> Optional[int]:
+        """Wait for a receiver ready ack and return its sequence number, which is
+        the sequence number the receiver expects next. Returns None if the receiver
+        already answers, see TP20Protocol.ack_wait_frame"""
+        start = time.monotonic()
+        while True:
+            done, seq, ack = self.ack_wait_frame(self.recv_frame(timeout=self.t1))
+            if ack:
                 self.send_ack()
-                break
+            if done:
+                if seq is not None:
+                    self._observe("tp20_ack_wait_seconds", time.monotonic() - start)
+                return seq
 
-        length = struct.unpack(">H", payload[:2])[0]
-        data = payload[2 : length + 2]
-        assert len(data) == length
-        return data
+    def send_ack(self):
+        with self.lock:
+            self.can_send(self.ack())
+
+    def recv_frame(self, timeout: Optional[float] = None) -> bytes:
+        """Receive the next data or ack frame on the channel. Channel tests
+        from the ECU are answered, and responses to our own channel tests
+        are dropped."""
+        if self.early_frame is not None:
+            dat, self.early_frame = self.early_frame, None
+            return dat
+
+        while True:
+            dat = self.can_recv(timeout=timeout)
+            channel_test, reply = self.channel_test_reply(dat)
+            if not channel_test:
+                return dat
+            if reply is not None:
+                with self.lock:
+                    self.can_send(reply)
+
+    def send(self, dat: bytes):
+        """Sends longer string of data by dividing into smaller chunks.
+        We ask for an acknowledge after every block of block_size chunks
+        and after the last chunk"""
+        blocks = self.blocks(dat)
+        with self.lock:
+            for block in blocks:
+                self._send_block(block)
+
+    def _send_block(self, block: List[bytes]):
+        """Send a block and wait for the ack of its last frame. Frames the receiver
+        did not get are sent again, see TP20Protocol.block_acked"""
+        frames = block
+        for _ in range(RETRANSMIT_LIMIT + 1):
+            self.can_send_many(frames)
+            try:
+                frames = self.block_acked(block, self.wait_for_ack())
+            except MessageTimeoutError:
+                frames = self.block_timed_out(block)
+            if not frames:
+                return
+
+        raise MessageTimeoutError(f"Block not acknowledged after {RETRANSMIT_LIMIT} retransmissions")
+
+    def recv(self, timeout: Optional[float] = None) -> bytes:
+        """Receives multiple chunks of a response and combines them into a single
+        string, asking for lost frames again, see TP20Protocol.data_frame. A sender
+        that gets no ack sends its last frame again every T1, so every frame is
+        waited for self.timeout plus RETRANSMIT_LIMIT times T1 (0.6 s with the
+        default timing). This includes the first frame, unless timeout is
+        given, which is then the time to wait for the first frame."""
+        first_timeout, frame_timeout = self.frame_timeouts(timeout)
+
+        payload = bytearray()
+        while True:
+            ack, done = self.data_frame(payload, self.recv_frame(timeout=frame_timeout if payload else first_timeout))
+            if ack:
+                self.send_ack()
+            if done:
+                return self.message(payload)
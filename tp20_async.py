@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+asyncio version of the VW Transport Protocol 2.0 (TP 2.0). One AsyncCanReader
+owns the panda and is shared by all channels opened on it.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from panda import Panda  # type: ignore
+from metrics import Metrics
+from tp20 import (
+    BROADCAST_ADDR,
+    KEEP_ALIVE_FRACTION,
+    RECONNECT_MAX_DELAY,
+    RECONNECT_MIN_DELAY,
+    RECONNECT_TIMEOUT,
+    RETRANSMIT_LIMIT,
+    TIMING_PARAMS,
+    MessageTimeoutError,
+    TP20Protocol,
+)
+
+
+class AsyncCanReader:
+    def __init__(self, panda: Panda, maxlen: int = 1024, poll_interval: float = 0.001):
+        """Reads the panda from a task and queues messages per (bus, address).
+        All panda calls run on a single worker thread, so the USB device is never
+        used concurrently and the event loop is never blocked."""
+        self.panda = panda
+        self.maxlen = maxlen
+        self.poll_interval = poll_interval
+        self.queues: Dict[Tuple[int, int], asyncio.Queue] = {}
+        self.dropped = 0
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="panda")
+        self.task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def call(self, fn: Callable, *args) -> Any:
+        """Run a panda call on the worker thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+        # Wait for the worker thread without blocking the loop, a new one is started on the next call
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="panda")
+
+    def _queue(self, bus: int, addr: int) -> asyncio.Queue:
+        queue = self.queues.get((bus, addr))
+        if queue is None:
+            queue = self.queues[(bus, addr)] = asyncio.Queue(self.maxlen)
+        return queue
+
+    async def _run(self):
+        while True:
+            msgs = await self.call(self.panda.can_recv)
+            if not msgs:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            t = time.monotonic()
+            for addr, _, dat, bus in msgs:
+                queue = self._queue(bus, addr)
+                if queue.full():
+                    queue.get_nowait()
+                    self.dropped += 1
+                queue.put_nowait((t, bytes(dat)))
+
+    async def get(self, bus: int, addr: int, timeout: float) -> Tuple[float, bytes]:
+        """Returns the oldest message on (bus, addr) with its arrival time,
+        waiting up to timeout seconds for one to arrive"""
+        self.start()
+        try:
+            return await asyncio.wait_for(self._queue(bus, addr).get(), timeout)
+        except asyncio.TimeoutError:
+            raise MessageTimeoutError("Timed out waiting for message")
+
+    def clear(self, bus: Optional[int] = None, addr: Optional[int] = None):
+        """Drop queued messages, optionally only for a single bus and/or address"""
+        for (b, a), queue in self.queues.items():
+            if (bus is None or b == bus) and (addr is None or a == addr):
+                while not queue.empty():
+                    queue.get_nowait()
+
+    async def can_send(self, addr: int, dat: bytes, bus: int, timeout: int):
+        await self.call(self.panda.can_send, addr, dat, bus, timeout)
+
+    async def can_send_many(self, arr: List[Tuple[int, None, bytes, int]], timeout: int):
+        await self.call(lambda: self.panda.can_send_many(arr, timeout=timeout))
+
+
+class AsyncTP20Transport(TP20Protocol):
+    def __init__(
+        self,
+        reader: AsyncCanReader,
+        bus: int = 0,
+        timeout: float = 0.1,
+        debug: bool = False,
+        batch: bool = True,
+        keep_alive_interval: Optional[float] = None,
+        metrics: Optional[Metrics] = None,
+        rx_addr: int = 0x300,
+    ):
+        """Create an AsyncTP20Transport on a shared reader. Call open_channel
+        before sending anything. Pacing and timeouts are handled by the event loop,
+        the protocol itself is TP20Protocol, the same as for TP20Transport."""
+        super().__init__(timeout, debug, batch, keep_alive_interval, metrics)
+        self.reader = reader
+        self.bus = bus
+        self.rx_addr = rx_addr
+
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, reader: AsyncCanReader, module: int, rx_addr: int = 0x300, **kwargs) -> "AsyncTP20Transport":
+        """Create a transport and open a channel to module"""
+        transport = cls(reader, rx_addr=rx_addr, **kwargs)
+        await transport.open_channel(module)
+        return transport
+
+    async def can_recv(self, addr: Optional[int] = None, timeout: Optional[float] = None) -> bytes:
+        if addr is None:
+            addr = self.rx_addr
+        if timeout is None:
+            timeout = self.timeout
+
+        try:
+            _, dat = await self.reader.get(self.bus, addr, timeout)
+        except MessageTimeoutError:
+            self.recv_timed_out()
+            raise
+
+        self.frame_received(addr, dat)
+        return dat
+
+    async def can_send(self, dat: bytes, addr: Optional[int] = None):
+        if addr is None:
+            addr = self.tx_addr
+
+        await self.reader.can_send(addr, dat, self.bus, int(self.timeout * 1000))
+        self.frames_sent(addr, [dat])
+        await asyncio.sleep(self.time_between_packets)
+
+    async def can_send_many(self, frames: List[bytes]):
+        """Send frames on our tx address in one USB transfer if the ECU allows
+        back to back frames, otherwise paced by the event loop. See BATCH_MAX_T3"""
+        if not self.batched(frames):
+            for dat in frames:
+                await self.can_send(dat)
+            return
+
+        await self.reader.can_send_many([(self.tx_addr, None, dat, self.bus) for dat in frames], int(self.timeout * 1000))
+        self.frames_sent(self.tx_addr, frames)
+
+    async def open_channel(self, module: int, rx_addr: Optional[int] = None):
+        """Open a channel, see TP20Transport.open_channel. The module is asked to
+        transmit on rx_addr, by default the one the transport was created with.
+        Use a different one for every concurrent channel."""
+        if rx_addr is None:
+            rx_addr = self.rx_addr
+        self.rx_addr = rx_addr
+        self.module = module
+
+        self.reader.clear(self.bus, BROADCAST_ADDR + module)
+        self.reader.clear(self.bus, rx_addr)
+
+        await self.can_send(self.setup_request(module, rx_addr), BROADCAST_ADDR)
+        self.tx_addr = self.setup_response(await self.can_recv(BROADCAST_ADDR + module), rx_addr)
+
+        await self.can_send(b"\xa0" + TIMING_PARAMS)
+        self.timing_response(await self.can_recv())
+
+    async def reconnect(self, timeout: float = RECONNECT_TIMEOUT) -> float:
+        """Open the channel again after the ECU restarted, see TP20Transport.reconnect.
+        Other channels on the reader are not affected"""
+        start = time.monotonic()
+        delay = RECONNECT_MIN_DELAY
+        attempts = 0
+        async with self.lock:
+            while True:
+                await asyncio.sleep(delay)
+                attempts += 1
+
+                try:
+                    await self.open_channel(self.module)
+                    break
+                except Exception as e:
+                    elapsed = time.monotonic() - start
+                    if elapsed + delay > timeout:
+                        raise MessageTimeoutError(f"No channel after {attempts} attempts in {elapsed:.2f} s: {e}") from e
+                    if self.debug:
+                        print(f"Reconnect attempt {attempts} failed: {e}")
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+        elapsed = time.monotonic() - start
+        self.reconnected(elapsed, attempts)
+        return elapsed
+
+    async def keep_alive(self) -> bool:
+        """Send a channel test if the channel has been idle, see TP20Transport.keep_alive"""
+        async with self.lock:
+            if not self.keep_alive_due():
+                return False
+
+            await self.can_send(b"\xa3")
+            self.keep_alives_sent += 1
+            return True
+
+    async def keep_alive_task(self):
+        """Keep the channel open until cancelled"""
+        while True:
+            await self.keep_alive()
+            await asyncio.sleep(self.t1 * (1 - KEEP_ALIVE_FRACTION))
+
+    async def wait_for_ack(self) -> Optional[int]:
+        """Returns the sequence number of the next receiver ready ack, see TP20Transport.wait_for_ack"""
+        start = time.monotonic()
+        while True:
+            done, seq, ack = self.ack_wait_frame(await self.recv_frame(timeout=self.t1))
+            if ack:
+                await self.send_ack()
+            if done:
+                if seq is not None:
+                    self._observe("tp20_ack_wait_seconds", time.monotonic() - start)
+                return seq
+
+    async def send_ack(self):
+        await self.can_send(self.ack())
+
+    async def recv_frame(self, timeout: Optional[float] = None) -> bytes:
+        """Receive the next data or ack frame, handling channel tests. Unlike the
+        lock in TP20Transport, our lock is not reentrant and is not taken here,
+        we only get here while sending or receiving so the channel is never idle"""
+        if self.early_frame is not None:
+            dat, self.early_frame = self.early_frame, None
+            return dat
+
+        while True:
+            dat = await self.can_recv(timeout=timeout)
+            channel_test, reply = self.channel_test_reply(dat)
+            if not channel_test:
+                return dat
+            if reply is not None:
+                await self.can_send(reply)
+
+    async def send(self, dat: bytes):
+        blocks = self.blocks(dat)
+        async with self.lock:
+            for block in blocks:
+                await self._send_block(block)
+
+    async def _send_block(self, block: List[bytes]):
+        """Send a block until all frames are acked, see TP20Transport._send_block"""
+        frames = block
+        for _ in range(RETRANSMIT_LIMIT + 1):
+            await self.can_send_many(frames)
+            try:
+                frames = self.block_acked(block, await self.wait_for_ack())
+            except MessageTimeoutError:
+                frames = self.block_timed_out(block)
+            if not frames:
+                return
+
+        raise MessageTimeoutError(f"Block not acknowledged after {RETRANSMIT_LIMIT} retransmissions")
+
+    async def recv(self, timeout: Optional[float] = None) -> bytes:
+        """Receive a message, asking for lost frames again, see TP20Transport.recv"""
+        first_timeout, frame_timeout = self.frame_timeouts(timeout)
+
+        payload = bytearray()
+        while True:
+            ack, done = self.data_frame(payload, await self.recv_frame(timeout=frame_timeout if payload else first_timeout))
+            if ack:
+                await self.send_ack()
+            if done:
+                return self.message(payload)